@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/24 11:05:21
+#   Desc    :   命令解析性能测试
+#
+""" 对比前缀表 + 组合正则与逐个正则匹配的命令解析速度::
+
+    python benchmarks/command_parse.py --number=100000 --extra=50
+
+``--extra`` 额外注册的命令数量, 用于模拟通过 entry point 注册的第三方命令.
+只测试查找处理函数的开销, 不执行命令.
+"""
+import timeit
+
+from magpie.command import Command, register
+
+COMMANDS = [u"#12 你好", u"#3 晚上一起吃饭?", u"-list", u"-glist",
+            u"-qn 5", u"-help", u"-gr 2", u"不是命令"]
+
+
+class LinearCommand(Command):
+    """ 原来逐个正则匹配的实现
+    """
+
+    def match(self, command):
+        for pattern, handler, _ in self._command_map.values():
+            sre = pattern.match(command)
+            if sre:
+                return handler, sre.groups(), sre.groupdict()
+
+
+def make_extra(cls, number):
+    """ 生成一个额外注册了 number 个命令的子类
+    """
+    attrs = {}
+    for i in range(number):
+        def handler(self, *args):
+            pass
+        attrs["extra_{0}".format(i)] = register(r"-extra{0} (\d+)"
+                                                .format(i))(handler)
+    return type(cls.__name__, (cls,), attrs)
+
+
+def bench(cls, number):
+    command = cls(None, None)
+
+    def run():
+        for item in COMMANDS:
+            command.match(item)
+
+    seconds = timeit.timeit(run, number=number)
+    return number * len(COMMANDS) / seconds
+
+
+def main():
+    from tornado import options
+
+    options.define("number", type=int, default=100000,
+                   help="Rounds of all sample commands")
+    options.define("extra", type=int, default=0,
+                   help="Extra commands to register")
+    options.parse_command_line()
+    number = options.options.number
+    extra = options.options.extra
+
+    for cls in (LinearCommand, Command):
+        if extra:
+            cls = make_extra(cls, extra)
+        print("{0:<16} {1:>12.0f} parses/sec".format(cls.__name__,
+                                                     bench(cls, number)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/03 10:21:46
+#   Desc    :   本地模拟的 WebQQ 服务
+#
+""" 模拟 WebQQ 的 HTTP 接口, 用于离线测试.
+
+调用 ``patch_requests`` 将 twqq 所有请求的地址改写为
+``http://127.0.0.1:port/<原域名><原路径>``, 登录, 好友/群/讨论组列表等接口
+返回固定的数据, 拉取消息的接口按指定的速率生成群消息.
+
+可以使用录制的数据替换生成的数据: 在 fixtures 目录中放置以接口路径最后一段
+命名的文件, 如 ``get_user_friends2.json``, ``.json`` 文件按 JSON 返回,
+其他文件原样返回.
+"""
+import os
+import json
+import time
+import random
+import inspect
+import logging
+
+from collections import deque
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler, asynchronous
+
+from twqq import requests as twqq_requests
+
+logger = logging.getLogger("magpie")
+
+POLL_TIMEOUT = 25
+
+
+def patch_requests(base):
+    """ 将 twqq 请求的地址改写到本地
+
+    :param base: 本地服务地址, 如 http://127.0.0.1:8080
+    """
+    for _, cls in inspect.getmembers(twqq_requests, inspect.isclass):
+        if not issubclass(cls, twqq_requests.WebQQRequest) or not cls.url:
+            continue
+        r = urlparse(cls.url)
+        cls.url = "{0}/{1}{2}".format(base, r.netloc, r.path)
+
+
+class Fixtures(object):
+    """ 生成好友, 群和群成员数据
+
+        :param qq: 登录的 QQ 号
+        :param groups: 群数量
+        :param members: 每个群的成员数量
+        :param friends: 好友数量
+    """
+
+    def __init__(self, qq, groups=10, members=50, friends=100):
+        self.qq = qq
+        self.groups = [(1000000 + i, 2000000 + i) for i in range(groups)]
+        self.members = dict(
+            (gcode, [3000000 + i * members + j for j in range(members)])
+            for _, gcode in self.groups)
+        self.friends = [4000000 + i for i in range(friends)]
+
+    def login2(self, params):
+        return {"retcode": 0,
+                "result": {"uin": self.qq, "status": "online",
+                           "vfwebqq": "bench_vfwebqq",
+                           "psessionid": "bench_psessionid"}}
+
+    def get_user_friends2(self, params):
+        info = [{"uin": uin, "face": 0, "flag": 0,
+                 "nick": u"好友{0}".format(i)}
+                for i, uin in enumerate(self.friends)]
+        return {"retcode": 0,
+                "result": {"info": info,
+                           "friends": [{"uin": uin, "categories": 0}
+                                       for uin in self.friends],
+                           "categories": [{"index": 0, "sort": 0,
+                                           "name": u"我的好友"}],
+                           "marknames": [], "vipinfo": []}}
+
+    def get_online_buddies2(self, params):
+        return {"retcode": 0,
+                "result": [{"uin": uin, "status": "online",
+                            "client_type": 1} for uin in self.friends]}
+
+    def get_group_name_list_mask2(self, params):
+        return {"retcode": 0,
+                "result": {"gnamelist": [{"flag": 0,
+                                          "name": u"群{0}".format(i),
+                                          "gid": gid, "code": gcode}
+                                         for i, (gid, gcode)
+                                         in enumerate(self.groups)],
+                           "gmasklist": [], "gmarklist": []}}
+
+    def get_group_info_ext2(self, params):
+        gcode = int(params.get("gcode", 0))
+        gid = dict((c, g) for g, c in self.groups).get(gcode, 0)
+        uins = self.members.get(gcode, [])
+        minfo = [{"nick": u"成员{0}".format(uin), "province": "",
+                  "gender": "male", "uin": uin, "country": "", "city": ""}
+                 for uin in uins]
+        ginfo = {"face": 0, "memo": "", "fingermemo": "", "code": gcode,
+                 "createtime": 0, "flag": 0, "level": 0,
+                 "name": u"群{0}".format(gcode), "gid": gid,
+                 "owner": uins[0] if uins else 0, "option": 2,
+                 "members": [{"muin": uin, "mflag": 0} for uin in uins],
+                 "class": 10011}
+        return {"retcode": 0,
+                "result": {"minfo": minfo, "cards": [], "stats": [],
+                           "vipinfo": [], "ginfo": ginfo}}
+
+    def get_discus_list(self, params):
+        return {"retcode": 0, "result": {"dnamelist": []}}
+
+    def group_message(self, seq, content):
+        """ 生成一条随机群的消息
+        """
+        gid, gcode = random.choice(self.groups)
+        return {"poll_type": "group_message",
+                "value": {"msg_id": seq, "from_uin": gid,
+                          "to_uin": self.qq, "msg_id2": seq,
+                          "msg_type": 43, "reply_ip": 0,
+                          "group_code": gcode,
+                          "send_uin": random.choice(self.members[gcode]),
+                          "seq": seq, "time": int(time.time()),
+                          "info_seq": gcode,
+                          "content": [["font", {"size": 10,
+                                                "color": "000000",
+                                                "style": [0, 0, 0],
+                                                "name": u"宋体"}],
+                                      content]}}
+
+
+class WebQQHandler(RequestHandler):
+
+    def initialize(self, server):
+        self.server = server
+
+    @asynchronous
+    def get(self, host, path):
+        params = dict((k, self.get_argument(k))
+                      for k in self.request.arguments)
+        self.server.handle(self, host, path, params)
+
+    post = get
+
+
+class FakeWebQQ(object):
+    """ 模拟的 WebQQ 服务
+
+        :param fixtures: ~Fixtures instance
+        :param rate: 每秒生成的消息数
+        :param batch: 每次拉取最多返回的消息数
+        :param fixtures_dir: 录制数据的目录
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    SEND_PATHS = ("send_qun_msg2", "send_buddy_msg2", "send_discu_msg2",
+                  "send_sess_msg2")
+
+    def __init__(self, fixtures, rate=100, batch=20, fixtures_dir=None,
+                 io_loop=None):
+        self.fixtures = fixtures
+        self.rate = rate
+        self.batch = batch
+        self.fixtures_dir = fixtures_dir
+        self.io_loop = io_loop or IOLoop.instance()
+        self.application = Application([(r"/([^/]+)(/.*)", WebQQHandler,
+                                         {"server": self})])
+        self.base = None
+
+        self._pending = deque()     # 等待被拉取的消息
+        self._waiting = deque()     # 等待消息的拉取请求
+        self._seq = 0
+        self._start = None
+        self._stop = None
+        self.served = {}            # 序号 => 消息被拉取的时间
+        self.sends = 0
+
+    def listen(self, port, address="127.0.0.1"):
+        self.application.listen(port, address)
+        self.base = "http://{0}:{1}".format(address, port)
+        patch_requests(self.base)
+
+    def _load(self, name):
+        if not self.fixtures_dir:
+            return None
+        for ext in (".json", ".txt"):
+            path = os.path.join(self.fixtures_dir, name + ext)
+            if os.path.exists(path):
+                with open(path) as f:
+                    body = f.read()
+                return json.loads(body) if ext == ".json" else body
+
+    def handle(self, handler, host, path, params):
+        name = path.rstrip("/").rsplit("/", 1)[-1]
+        if name == "poll2":
+            return self._poll(handler)
+
+        data = self._load(name)
+        if data is None:
+            data = self._default(host, name, params)
+        self._write(handler, data)
+
+    def _default(self, host, name, params):
+        if name in self.SEND_PATHS:
+            self.sends += 1
+            return {"retcode": 0, "result": "ok"}
+        if name == "login" and host.startswith("ui."):
+            # LoginSigRequest
+            return 'var g_login_sig=encodeURIComponent("bench_sig");'
+        if name == "check":
+            return ("ptui_checkVC('0','!BEN',"
+                    "'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01');")
+        if name == "login":
+            return (u"ptuiCB('0','0','{0}/bench/proxy','0','ok','bench');"
+                    .format(self.base))
+        if hasattr(self.fixtures, name):
+            return getattr(self.fixtures, name)(params)
+        return {"retcode": 0, "result": {}}
+
+    def _write(self, handler, data):
+        if not isinstance(data, (str, type(u""))):
+            handler.set_header("Content-Type", "application/json")
+            data = json.dumps(data)
+        handler.finish(data)
+
+    def start(self, duration):
+        """ 开始生成消息
+
+        :param duration: 生成消息的时长(秒)
+        """
+        self._start = time.time()
+        self._stop = self._start + duration
+        self._tick()
+
+    @property
+    def running(self):
+        return self._stop is not None and time.time() < self._stop
+
+    @property
+    def produced(self):
+        return self._seq
+
+    def _tick(self):
+        now = time.time()
+        if now >= self._stop:
+            return
+
+        due = int((now - self._start) * self.rate)
+        while self._seq < due:
+            self._seq += 1
+            self._pending.append(self.fixtures.group_message(
+                self._seq, u"bench {0} 测试消息".format(self._seq)))
+
+        while self._pending and self._waiting:
+            self._respond(self._waiting[0][0])
+        self.io_loop.add_timeout(now + 0.01, self._tick)
+
+    def _poll(self, handler):
+        if self._pending:
+            return self._respond(handler)
+
+        def timeout():
+            for item in list(self._waiting):
+                if item[0] is handler:
+                    self._waiting.remove(item)
+                    self._write(handler, {"retcode": 102, "errmsg": ""})
+        self._waiting.append((handler, self.io_loop.add_timeout(
+            time.time() + POLL_TIMEOUT, timeout)))
+
+    def _respond(self, handler):
+        for item in list(self._waiting):
+            if item[0] is handler:
+                self._waiting.remove(item)
+                self.io_loop.remove_timeout(item[1])
+
+        messages = []
+        while self._pending and len(messages) < self.batch:
+            messages.append(self._pending.popleft())
+
+        now = time.time()
+        for m in messages:
+            self.served[m["value"]["seq"]] = now
+        self._write(handler, {"retcode": 0, "result": messages})
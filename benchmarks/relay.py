@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/03 14:02:17
+#   Desc    :   转发性能测试
+#
+""" 使用本地模拟的 WebQQ 服务和 XMPP 流测试转发性能::
+
+    python benchmarks/relay.py --group_count=20 --members=100 --rate=500 \\
+        --duration=30 --reply_rate=5
+
+完整走一遍登录流程后, 模拟服务按 ``--rate`` 生成群消息, 经过 QQClient 的
+处理函数转发到替代 XMPP 流的 StreamSink. ``--reply_rate`` 每秒模拟控制账号
+发送的回复数, 经过 Command.parse 和发送调度器发回模拟服务.
+
+输出每秒转发的消息数, 从拉取返回到交给 XMPP 流的延迟(p50/p99)和最大常驻内存.
+"""
+import os
+import re
+import time
+import random
+import tempfile
+import resource
+
+from tornado.ioloop import IOLoop
+
+from pyxmpp2.jid import JID
+from pyxmpp2.message import Message
+
+from twqq.objects import UniqueIds
+
+from magpie.client import MagpieClient
+
+from fake_webqq import FakeWebQQ, Fixtures
+
+SEQ_RE = re.compile(r"bench (\d+)")
+
+
+class StreamSink(object):
+    """ 替代 XMPP 流, 记录每条消息交给流的时间
+    """
+
+    def __init__(self):
+        self.received = {}      # 序号 => 时间
+        self.stanzas = 0
+
+    def send(self, stanza):
+        self.stanzas += 1
+        body = getattr(stanza, "body", None)
+        if not body:
+            return
+        now = time.time()
+        for seq in SEQ_RE.findall(body):
+            self.received.setdefault(int(seq), now)
+
+
+class BenchClient(MagpieClient):
+    """ 不连接 XMPP 直接登录 WebQQ, 发送的节都交给 StreamSink
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BenchClient, self).__init__(*args, **kwargs)
+        self.sink = StreamSink()
+
+    @property
+    def stream(self):
+        return self.sink
+
+    def start(self):
+        if self.history is not None:
+            self.history.start()
+        self.online = True
+        # 本地服务无法设置 .qq.com 的 ptwebqq cookie, twqq 会使用旧值
+        self.qq.hub.ptwebqq = "bench_ptwebqq"
+        self.qq.activate()
+        self.qq.connect()
+
+    def inject(self, body):
+        """ 模拟控制账号发来的消息
+        """
+        stanza = Message(from_jid=JID(self.control_account), to_jid=self.jid,
+                         stanza_type="chat", body=body)
+        self.handle_message(stanza)
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Bench(object):
+
+    def __init__(self, options, io_loop=None):
+        self.options = options
+        self.io_loop = io_loop or IOLoop.instance()
+        self.fixtures = Fixtures(options.qq, options.group_count,
+                                 options.members, options.friends)
+        self.server = FakeWebQQ(self.fixtures, options.rate, options.batch,
+                                options.fixtures, self.io_loop)
+        self.client = None
+        self.replies = 0
+        self.start_time = None
+        self.end_time = None
+
+    def _ids_path(self):
+        """ 消息记录和过滤规则需要保存唯一ID, 没有指定时使用临时文件
+        """
+        if self.options.ids_path or not (self.options.history_dir or
+                                         self.options.rules_path):
+            return self.options.ids_path
+        return os.path.join(tempfile.mkdtemp(prefix="magpie-bench-"), "ids")
+
+    def run(self):
+        self.server.listen(self.options.port)
+        self.client = BenchClient(
+            self.options.qq, "bench", "bench@localhost", "bench",
+            "control@localhost", False,
+            coalesce_interval=self.options.coalesce_interval,
+            history_dir=self.options.history_dir,
+            ids_path=self._ids_path(),
+            rules_path=self.options.rules_path, io_loop=self.io_loop)
+        self.client.start()
+        self._wait_login()
+        self.io_loop.start()
+        self.report()
+
+    def _wait_login(self):
+        if not self.client.qq.hub.poll_and_heart:
+            self.io_loop.add_timeout(time.time() + 0.1, self._wait_login)
+            return
+
+        self.start_time = time.time()
+        self.server.start(self.options.duration)
+        if self.options.reply_rate:
+            self._reply()
+        self.io_loop.add_timeout(
+            self.start_time + self.options.duration + self.options.drain,
+            self._finish)
+
+    def _reply(self):
+        if not self.server.running:
+            return
+        _, gcode = random.choice(self.fixtures.groups)
+        self.replies += 1
+        self.client.inject(u"#{0} reply {1}".format(UniqueIds.get_id(gcode),
+                                                    self.replies))
+        self.io_loop.add_timeout(time.time() + 1.0 / self.options.reply_rate,
+                                 self._reply)
+
+    def _finish(self):
+        if self.client.coalescer is not None:
+            self.client.coalescer.flush()
+        self.end_time = time.time()
+        self.io_loop.stop()
+
+    def report(self):
+        served = self.server.served
+        received = self.client.sink.received
+        latencies = [received[seq] - served[seq]
+                     for seq in received if seq in served]
+        last = max(received.values()) if received else self.end_time
+        elapsed = max(last - self.start_time, 0.001)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        print("generated   {0:>10}".format(self.server.produced))
+        print("relayed     {0:>10}".format(len(latencies)))
+        print("stanzas     {0:>10}".format(self.client.sink.stanzas))
+        print("msgs/sec    {0:>10.1f}".format(len(latencies) / elapsed))
+        print("p50 latency {0:>10.2f} ms".format(
+            percentile(latencies, 0.5) * 1000))
+        print("p99 latency {0:>10.2f} ms".format(
+            percentile(latencies, 0.99) * 1000))
+        print("replies     {0:>10} sent, {1} acked".format(self.replies,
+                                                          self.server.sends))
+        print("max rss     {0:>10.1f} MB".format(rss / 1024.0))
+
+
+def main():
+    from tornado import options
+
+    options.define("qq", type=int, default=10000, help="Fake QQ account")
+    options.define("port", type=int, default=18080,
+                   help="Port of the fake WebQQ server")
+    # groups 是 OptionParser 的方法, 不能作为选项名
+    options.define("group_count", type=int, default=10,
+                   help="Number of groups")
+    options.define("members", type=int, default=50,
+                   help="Members of every group")
+    options.define("friends", type=int, default=100,
+                   help="Number of friends")
+    options.define("rate", type=float, default=100,
+                   help="Group messages generated per second")
+    options.define("batch", type=int, default=20,
+                   help="Max messages returned by one poll")
+    options.define("duration", type=float, default=10,
+                   help="Seconds to generate messages")
+    options.define("drain", type=float, default=2,
+                   help="Seconds to wait for pending messages at the end")
+    options.define("reply_rate", type=float, default=0,
+                   help="Replies sent by the control account per second")
+    options.define("coalesce_interval", type=float, default=0,
+                   help="Coalesce interval of the client")
+    options.define("history_dir", default=None,
+                   help="Store message history while benchmarking")
+    options.define("ids_path", default=None,
+                   help="File to store unique ids, a temporary file is used "
+                   "when history_dir or rules_path is set")
+    options.define("rules_path", default=None,
+                   help="Filter group messages with these rules")
+    options.define("fixtures", default=None,
+                   help="Directory of recorded responses")
+    options.parse_command_line()
+
+    Bench(options.options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/30 10:18:25
+#   Desc    :   重试间隔
+#
+import random
+
+
+class Backoff(object):
+    """ 带随机抖动的指数退避
+
+        :param base: 第一次重试的间隔(秒)
+        :param cap: 间隔上限(秒)
+        :param factor: 每次重试间隔的倍数
+        :param jitter: 随机抖动的比例, 0.5 表示在 [0.5, 1] 倍之间取值
+    """
+
+    def __init__(self, base=0.5, cap=60, factor=2, jitter=0.5):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def delay(self, attempts=None):
+        """ 获取第 attempts 次重试前的等待时间, 不传则使用内部计数并加一
+        """
+        if attempts is None:
+            attempts = self.attempts
+            self.attempts += 1
+        delay = min(self.cap, self.base * self.factor ** attempts)
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
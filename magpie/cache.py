@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/11 10:22:05
+#   Desc    :   按内容寻址的图片和文件缓存
+#
+""" 接收到的图片和文件按内容的 SHA256 存放在缓存目录中, 相同的内容只保存一份,
+通过本地 HTTP 服务以链接的形式发给控制账号.
+
+目录结构::
+
+    cache_dir/
+        index.json          索引, 按最近使用的顺序记录每个文件的大小和名称
+        tmp/                正在接收的文件
+        ab/abcdef...        内容, 按摘要的前两位分目录
+
+缓存总大小超过上限时从最久没有使用的开始淘汰. 索引在变化后延迟保存, 期间
+的变化合并为一次写入, 停止时调用 flush 立即保存. 聊天图片按来源(图片的
+file_path 或群图片的名称)记录对应的摘要, 同一张图片转发到多个群或者重复收到
+时不会再次下载.
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import mimetypes
+
+from collections import OrderedDict
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+from tornado import gen
+from tornado.web import StaticFileHandler, HTTPError
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+
+logger = logging.getLogger("magpie")
+
+_USER_AGENT = ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
+               " (KHTML, like Gecko) Ubuntu Chromium/28.0.1500.71 "
+               "Chrome/28.0.1500.71 Safari/537.36")
+
+
+def source_key(source):
+    """ 将图片来源转换为固定长度的键, 用于链接和索引
+    """
+    if not isinstance(source, bytes):
+        source = source.encode("utf-8")
+    return hashlib.sha1(source).hexdigest()
+
+
+class ContentCache(object):
+    """ 按内容寻址的缓存
+
+        :param directory: 缓存目录
+        :param max_bytes: 缓存总大小上限(字节), 为 0 则不限制
+        :param base_url: 生成链接使用的地址前缀
+        :param delay: 索引变化后多久保存(秒)
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    INDEX = "index.json"
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024,
+                 base_url=None, delay=5, io_loop=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.base_url = base_url
+        self.delay = delay
+        self.io_loop = io_loop or IOLoop.instance()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._items = OrderedDict()     # 摘要 => [大小, 文件名], 按使用顺序
+        self._sources = {}              # 来源键 => 摘要
+        self._refs = {}                 # 摘要 => 来源键集合
+        self._dirty = False
+        self._flush_timeout = None
+
+        self._tmp = os.path.join(directory, "tmp")
+        if not os.path.exists(self._tmp):
+            os.makedirs(self._tmp)
+        # 上次退出时没有接收完的文件
+        for name in os.listdir(self._tmp):
+            os.remove(os.path.join(self._tmp, name))
+        self._load()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, digest):
+        return digest in self._items
+
+    def _load(self):
+        path = os.path.join(self.directory, self.INDEX)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                data = json.load(f, object_pairs_hook=OrderedDict)
+        except ValueError:
+            logger.warn(u"缓存索引 {0} 已损坏, 忽略".format(path),
+                        exc_info=True)
+            return
+
+        for digest, (size, name) in data.get("items", {}).items():
+            if os.path.exists(self.path(digest)):
+                self._items[digest] = [size, name]
+                self.size += size
+        for key, digest in data.get("sources", {}).items():
+            if digest in self._items:
+                self._bind(key, digest)
+        self._evict()
+
+    def _changed(self):
+        # 不重新计时, 持续放入文件时索引最多延迟 delay 秒保存
+        if self._flush_timeout is None:
+            self._flush_timeout = self.io_loop.add_timeout(
+                self.io_loop.time() + self.delay, self._flush)
+
+    def _flush(self):
+        self._flush_timeout = None
+        try:
+            self.flush()
+        except (IOError, OSError):
+            logger.warn(u"保存缓存索引失败", exc_info=True)
+
+    def flush(self):
+        """ 保存索引, 先写临时文件再替换, 中途退出不会损坏索引
+        """
+        if self._flush_timeout is not None:
+            self.io_loop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+        if not self._dirty:
+            return
+        path = os.path.join(self.directory, self.INDEX)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"items": self._items, "sources": self._sources}, f)
+        os.rename(tmp, path)
+        self._dirty = False
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def temp_path(self):
+        """ 生成一个接收文件用的临时路径, 接收完成后通过 put_file 放入缓存
+        """
+        return os.path.join(self._tmp, uuid.uuid4().hex)
+
+    def url(self, key, name=None):
+        """ 生成下载链接
+
+        :param key: 摘要或来源键
+        :param name: 文件名, 只用于显示
+        """
+        url = u"{0}{1}".format(self.base_url or u"", key)
+        if name:
+            if not isinstance(name, bytes):
+                name = name.encode("utf-8")
+            url += u"/" + quote(name, safe="")
+        return url
+
+    def get(self, digest):
+        """ 获取缓存的文件, 并标记为最近使用
+
+        :rtype: (路径, 文件名), 不在缓存中返回 None
+        """
+        item = self._items.pop(digest, None)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items[digest] = item
+        self._dirty = True
+        return self.path(digest), item[1]
+
+    def source(self, key):
+        """ 获取来源对应的摘要
+        """
+        return self._sources.get(key)
+
+    def put(self, data, name, key=None):
+        """ 放入一段数据
+
+        :param key: 来源键
+        :rtype: 摘要
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self._items:
+            path = self.temp_path()
+            with open(path, "wb") as f:
+                f.write(data)
+            return self.put_file(path, name, digest, key)
+
+        self.get(digest)
+        if key is not None:
+            self._bind(key, digest)
+        self._changed()
+        return digest
+
+    def put_file(self, path, name, digest=None, key=None):
+        """ 放入一个文件, 文件会被移动到缓存目录, 内容已存在时直接删除
+
+        :param digest: 文件的 SHA256, 为 None 则读取文件计算
+        :rtype: 摘要
+        """
+        if digest is None:
+            checksum = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b""):
+                    checksum.update(chunk)
+            digest = checksum.hexdigest()
+
+        if digest in self._items:
+            os.remove(path)
+            self.get(digest)
+        else:
+            self.misses += 1
+            target = self.path(digest)
+            parent = os.path.dirname(target)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            os.rename(path, target)
+            size = os.path.getsize(target)
+            self._items[digest] = [size, name]
+            self.size += size
+            self._dirty = True
+
+        if key is not None:
+            self._bind(key, digest)
+        self._evict(keep=digest)
+        self._changed()
+        return digest
+
+    def _bind(self, key, digest):
+        self._sources[key] = digest
+        self._refs.setdefault(digest, set()).add(key)
+        self._dirty = True
+
+    def _evict(self, keep=None):
+        if not self.max_bytes:
+            return
+        while self.size > self.max_bytes and self._items:
+            digest = next(iter(self._items))
+            if digest == keep:
+                break
+            size, name = self._items.pop(digest)
+            self.size -= size
+            self.evicted += 1
+            self._dirty = True
+            for key in self._refs.pop(digest, ()):
+                self._sources.pop(key, None)
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+            logger.debug(u"淘汰缓存文件 {0} ({1})".format(name, digest))
+
+
+class ImageFetcher(object):
+    """ 异步下载聊天图片到缓存, 不阻塞消息处理; 同一来源只下载一次, 正在下载
+    的来源再次出现时等待同一个请求
+
+        :param hub: ~twqq.hub.RequestHub instance
+        :param cache: ContentCache instance
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    # 下载失败后多久内不再重试同一来源(秒)
+    FAILURE_TTL = 60
+
+    def __init__(self, hub, cache, io_loop=None):
+        self.hub = hub
+        self.cache = cache
+        self.io_loop = io_loop or IOLoop.instance()
+        self.fetched = 0
+        self._pending = {}      # 来源键 => [Future]
+        self._failed = {}       # 来源键 => 失败时间
+
+    def __len__(self):
+        return len(self._pending)
+
+    def offpic(self, from_uin, file_path):
+        """ 好友发送的图片
+
+        :rtype: 图片链接
+        """
+        if not file_path:
+            return u"[图片获取失败]"
+        params = {"clientid": self.hub.clientid, "f_uin": from_uin,
+                  "file_path": file_path, "psessionid": self.hub.psessionid}
+        return self._link(u"offpic:" + file_path,
+                          "http://d.web2.qq.com/channel/get_offpic2", params,
+                          os.path.basename(file_path) + ".jpg")
+
+    def cface(self, gid, from_uin, file_id, server, name, key, _type=0):
+        """ 群/讨论组中发送的图片, 图片名称由内容生成, 可以作为来源
+
+        :rtype: 图片链接
+        """
+        if not name:
+            return u"[图片获取失败]"
+        ip, _, port = (server or u"").partition(":")
+        params = {"type": _type, "fid": file_id, "gid": gid, "pic": name,
+                  "rip": ip, "rport": port, "uin": from_uin,
+                  "vfwebqq": self.hub.vfwebqq}
+        return self._link(u"cface:" + name,
+                          "http://web2.qq.com/cgi-bin/get_group_pic", params,
+                          name)
+
+    def _link(self, source, url, params, name):
+        key = source_key(source)
+        if self.cache.source(key) is None:
+            self.fetch(key, url, params, name)
+        return self.cache.url(key, name)
+
+    def fetch(self, key, url, params, name):
+        if key in self._pending:
+            return
+        now = time.time()
+        failed = self._failed.get(key)
+        if failed is not None and now - failed < self.FAILURE_TTL:
+            return
+        if len(self._failed) > 1000:
+            self._failed = dict((k, t) for k, t in self._failed.items()
+                                if now - t < self.FAILURE_TTL)
+        self._pending[key] = []
+        headers = {"User-Agent": _USER_AGENT,
+                   "Referer": "http://web2.qq.com/webqq.html"}
+        self.hub.http.get(url, params, headers=headers,
+                          callback=lambda resp: self._on_done(key, name, resp))
+
+    def _on_done(self, key, name, response):
+        digest = None
+        if response.error:
+            logger.warn(u"获取聊天图片 {0} 失败: {1}"
+                        .format(name, response.error))
+        else:
+            try:
+                digest = self.cache.put(response.body, name, key)
+                self.fetched += 1
+            except:
+                logger.warn(u"保存聊天图片 {0} 失败".format(name),
+                            exc_info=True)
+        if digest is None:
+            self._failed[key] = time.time()
+        else:
+            self._failed.pop(key, None)
+
+        for future in self._pending.pop(key, ()):
+            future.set_result(digest)
+
+    def wait(self, key):
+        """ 等待来源下载完成
+
+        :rtype: ~tornado.concurrent.Future, 结果为摘要, 失败或没有在下载的
+                来源为 None
+        """
+        future = Future()
+        digest = self.cache.source(key)
+        if digest is not None or key not in self._pending:
+            future.set_result(digest)
+        else:
+            self._pending[key].append(future)
+        return future
+
+
+class CacheHandler(StaticFileHandler):
+    """ 提供缓存中的文件下载, 链接为 /摘要/文件名 或 /来源键/文件名, 来源
+    正在下载时等待下载完成, 支持断点续传和缓存验证
+    """
+
+    def initialize(self, cache, fetcher=None):
+        super(CacheHandler, self).initialize(cache.directory)
+        self.cache = cache
+        self.fetcher = fetcher
+        self._name = None
+
+    @gen.coroutine
+    def get(self, key, include_body=True):
+        digest = key
+        if len(key) != 64:
+            if self.fetcher is not None:
+                digest = yield self.fetcher.wait(key)
+            else:
+                digest = self.cache.source(key)
+        item = self.cache.get(digest) if digest else None
+        if item is None:
+            raise HTTPError(404)
+
+        path, self._name = item
+        yield super(CacheHandler, self).get(
+            os.path.relpath(path, self.cache.directory), include_body)
+
+    def get_content_type(self):
+        mime_type, encoding = mimetypes.guess_type(self._name or u"")
+        if mime_type is None or encoding is not None:
+            return "application/octet-stream"
+        return mime_type
+
+    @classmethod
+    def get_content_version(cls, abspath):
+        # 文件名就是内容的摘要
+        return os.path.basename(abspath)
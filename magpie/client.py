@@ -7,7 +7,7 @@
 #   Desc    :   客户端
 #
 import re
-import os
+import time
 import logging
 import traceback
 
@@ -20,6 +20,7 @@ from pyxmpp2.client import Client
 from pyxmpp2.settings import XMPPSettings
 from pyxmpp2.interfaces import EventHandler, event_handler, QUIT
 from pyxmpp2.streamevents import DisconnectedEvent, ConnectedEvent
+from pyxmpp2.streamevents import AuthorizedEvent
 from pyxmpp2.roster import RosterReceivedEvent, RosterUpdatedEvent
 from pyxmpp2.interfaces import XMPPFeatureHandler
 from pyxmpp2.interfaces import presence_stanza_handler, message_stanza_handler
@@ -34,11 +35,38 @@ from twqq.requests import file_message_handler
 from twqq.requests import register_request_handler
 from twqq.requests import Login2Request, FriendInfoRequest, BuddyMsgRequest
 from twqq.requests import sess_message_handler, discu_message_handler
+from twqq.requests import WebQQRequest, GroupListRequest
+from twqq.requests import GroupMembersRequest, DiscuListRequest
+from twqq.requests import DiscuInfoRequest, GroupMsgRequest
+from twqq.requests import DiscuMsgRequest, SessMsgRequest
+from twqq.requests import FriendStatusRequest
 from twqq.objects import UniqueIds
 
+from tornado.ioloop import IOLoop
+from tornadohttpclient import TornadoHTTPClient
+
 from magpie import __version__
-from magpie.queue import InputQueue
+from magpie.queue import InputQueue, ANSWER_RE
 from magpie.command import Command
+from magpie.coalesce import MessageCoalescer
+from magpie.history import HistoryStore, INBOUND, OUTBOUND
+from magpie.session import SessionRouter
+from magpie.directory import ContactDirectory
+from magpie.search import SearchIndex
+from magpie.ids import IdTable
+from magpie.files import FileReceiver
+from magpie.cache import ContentCache, ImageFetcher, CacheHandler
+from magpie.scheduler import SendScheduler, GROUP, BUDDY, DISCU, SESS
+from magpie.metrics import Registry
+from magpie.render import Renderer, xhtml_payload
+from magpie.resume import SessionStore
+from magpie.snapshot import ContactSnapshot
+from magpie.presence import PresenceTracker, PresenceNotifier, ONLINE_STATUS
+from magpie.backoff import Backoff
+from magpie.web import WebServer, MetricsHandler, DEFAULT_PORT
+from magpie.spool import Spool
+from magpie.dedupe import DedupeFilter
+from magpie.rules import RuleSet
 
 logger = logging.getLogger("magpie")
 
@@ -49,16 +77,184 @@ AT_MSG_P = re.compile(r'^@(\d+)(.*)')
 class MagpieClient(EventHandler, XMPPFeatureHandler):
 
     """ 启动并分别连接登录 XMPP 和 WebQQ
+
+        :param coalesce_interval: 合并消息的时间窗口(秒), 为 0 则不合并
+        :param coalesce_bytes: 单个来源合并消息的字节上限
+        :param io_loop: 共享的 ~tornado.ioloop.IOLoop instance
+        :param quit_on_disconnect: XMPP 断开时是否退出主循环, 多个账号共享
+                                   主循环时应为 False
+        :param history_dir: 消息记录存储目录, 为 None 则不存储消息记录,
+                            记录按唯一ID保存, 需要同时设置 ids_path
+        :param history_segment_bytes: 消息记录单个分段的最大字节数
+        :param history_max_age: 消息记录最长保留时间(秒)
+        :param session_mode: 是否开启单独会话模式
+        :param session_domain: 单独会话模式下对应 JID 使用的域, 为 None 则
+                               使用 XMPP 账号的资源
+        :param ids_path: 保存唯一ID的文件, 为 None 则不保存, 多个账号共享
+                         唯一ID, 所以同一进程中只会加载第一次传入的文件
+        :param file_dir: 接收文件的存放目录
+        :param file_max_size: 接收文件的大小上限(字节), 为 0 则不限制
+        :param send_rate: 每个 QQ 对象每秒最多发送的消息数
+        :param account_send_rate: 整个 QQ 账号每秒最多发送的消息数
+        :param metrics_port: 输出指标的本地 HTTP 端口, 为 0 则不开启
+        :param metrics_address: 输出指标的 HTTP 监听地址
+        :param cache_dir: 图片和文件的缓存目录, 设置时图片和文件按内容存放
+                          在缓存中, 通过本地 HTTP 服务(与指标共用, 没有设置
+                          metrics_port 时使用 WEB_PORT)以链接的形式发送
+        :param cache_max_size: 缓存大小上限(字节), 为 0 则不限制
+        :param cache_url: 缓存链接的地址前缀, 默认为本地 HTTP 服务的地址,
+                          通过反向代理访问时设置
+        :param web: 共享的 ~magpie.web.WebServer instance, 多账号模式下由
+                    ~magpie.tenant.TenantManager 传入, 此时忽略
+                    metrics_port 和 metrics_address
+        :param web_prefix: 在共享的 HTTP 服务中挂载指标和缓存的路径前缀,
+                           如 ``/work``
+        :param snapshot_path: 保存联系人快照的文件, 启动时先加载快照, 名称
+                              和命令在获取到联系人之前就可以使用
+        :param fragment_size: 发往 QQ 的单条消息的最大字符数, 超过时切分为
+                              多段依次发送, 为 0 则不切分
+        :param presence_notify: 合并好友状态变化提示的时间窗口(秒), 为 0 则
+                                不提示
+        :param presence_mirror: 单独会话模式下, 是否将好友的在线状态同步为
+                                对应 JID 的 XMPP 状态, 需要设置 session_domain
+        :param rules_path: 保存消息过滤规则的文件, 为 None 则只保存在内存中,
+                           规则按唯一ID保存, 需要同时设置 ids_path
+        :param templates: {消息类型: 模板}, 见 ~magpie.render
+        :param face_style: 表情显示方式, text 或 emoji
+        :param xhtml: 是否同时发送 XHTML-IM 格式的消息
+        :param session_path: 保存 WebQQ 会话的文件, 为 None 则不保存,
+                             掉线时仍然会先尝试使用当前会话重新登录
+        :param spool_path: XMPP 断开时暂存消息的文件, 为 None 则只暂存在
+                           内存中
+        :param spool_max_age: 暂存消息的最长保存时间(秒)
+        :param prompt_timeout: 等待回答问题(如是否接收文件)的超时时间(秒)
+        :param component: ~magpie.component.ComponentStream instance, 使用组件
+                          模式连接时传入, 此时 xmpp_account 为组件域下的 JID,
+                          不需要 xmpp_pwd, 多个账号可以共享一个组件连接;
+                          分进程模式下为 ~magpie.worker.IPCLink instance
     """
 
+    # 补发暂存的消息时合并后单条消息的字节上限
+    SPOOL_MERGE_BYTES = 4096
+    # 重新连接后多久没有登录成功则再次重连(秒)
+    RECONNECT_TIMEOUT = 60
+    # 开启了缓存但没有设置 metrics_port 时本地 HTTP 服务的端口
+    WEB_PORT = DEFAULT_PORT
+    # WebQQ 状态 => XMPP 的 show
+    PRESENCE_SHOW = {"away": "away", "busy": "dnd", "silent": "dnd",
+                     "callme": "chat"}
+
     def __init__(self, QQ, QQ_PWD, xmpp_account, xmpp_pwd, control_account,
-                 debug=True, command=None):
-        self.input_queue = InputQueue(self.send_control_msg)
-        self.qq = QQClient(QQ, QQ_PWD, debug)
+                 debug=True, command=None, coalesce_interval=0,
+                 coalesce_bytes=4096, io_loop=None, quit_on_disconnect=True,
+                 history_dir=None, history_segment_bytes=16 * 1024 * 1024,
+                 history_max_age=None, session_mode=False,
+                 session_domain=None, ids_path=None, file_dir="/tmp",
+                 file_max_size=0, send_rate=1.0, account_send_rate=3.0,
+                 metrics_port=0, metrics_address="127.0.0.1",
+                 templates=None, face_style="text", xhtml=False,
+                 session_path=None, spool_path=None, spool_max_age=24 * 3600,
+                 prompt_timeout=300, component=None, cache_dir=None,
+                 cache_max_size=512 * 1024 * 1024, cache_url=None,
+                 snapshot_path=None, presence_notify=0,
+                 presence_mirror=False, fragment_size=600, rules_path=None,
+                 web=None, web_prefix=u""):
+        self.quit_on_disconnect = quit_on_disconnect
+        self.io_loop = io_loop or IOLoop.instance()
+        self.online = False
+        self.spool = Spool(spool_path, max_age=spool_max_age)
+        self.reconnect_backoff = Backoff(base=1, cap=120)
+        self._reconnect_timeout = None
+        self._stopping = False
+        self._status = None
+        self._qq_started = False
+        self.xhtml = xhtml
+        self.metrics = Registry()
+        self.xmpp_send_time = self.metrics.histogram(
+            "xmpp_send_seconds", u"XMPP 发送耗时")
+        self.relay_latency = self.metrics.histogram(
+            "relay_latency_seconds", u"从收到 Poll 返回到转发到 XMPP 的耗时")
+        check_ids_path(ids_path, history_dir=history_dir,
+                       rules_path=rules_path)
+        if ids_path:
+            install_id_table(ids_path, io_loop)
+        if history_dir:
+            self.history = HistoryStore(history_dir, history_segment_bytes,
+                                        max_age=history_max_age)
+        else:
+            self.history = None
+        self.input_queue = InputQueue(self.send_control_msg, prompt_timeout,
+                                      self.io_loop)
+        if coalesce_interval > 0:
+            self.coalescer = MessageCoalescer(self._send_control_body,
+                                              coalesce_interval,
+                                              coalesce_bytes, io_loop)
+        else:
+            self.coalescer = None
+        if cache_dir:
+            self.cache = ContentCache(cache_dir, cache_max_size,
+                                      io_loop=self.io_loop)
+        else:
+            self.cache = None
+        self.qq = QQClient(QQ, QQ_PWD, debug, send_rate, account_send_rate,
+                           io_loop, self.metrics, templates, face_style,
+                           session_path, self.cache, snapshot_path,
+                           fragment_size, rules_path)
         self.qq.set_control_msg(self.send_control_msg, self)
+        self.files = FileReceiver(self.qq.hub, self.send_control_msg,
+                                  file_dir, file_max_size, io_loop=io_loop,
+                                  cache=self.cache)
         self.command = command or Command(self, self.qq)
         self.jid = JID(xmpp_account + '/Bridge')
         self.control_account = control_account
+        self.component = component
+        if session_mode:
+            # 组件域下的 JID 都可以使用, 默认使用组件域
+            if session_domain is None and component is not None and\
+                    component.jid is not None:
+                session_domain = component.jid.domain
+            self.session = SessionRouter(self.jid, session_domain,
+                                         self._owns_contact)
+        else:
+            self.session = None
+
+        if presence_notify > 0:
+            self.presence_notifier = PresenceNotifier(
+                self.send_control_msg, self.qq.directory.friend_name,
+                presence_notify, io_loop=self.io_loop)
+            self.qq.presence.add_listener(self.presence_notifier)
+        else:
+            self.presence_notifier = None
+        self.presence_mirror = False
+        if presence_mirror:
+            if self.session is not None and self.session.domain:
+                self.presence_mirror = True
+                self.qq.presence.add_listener(self.mirror_presence)
+            else:
+                logger.warn(u"同步好友状态需要开启单独会话模式并设置 "
+                            u"session_domain")
+
+        self._register_gauges()
+        self._own_web = False
+        if web is not None:
+            self.web = web
+        elif metrics_port or self.cache is not None:
+            self.web = WebServer(metrics_port or self.WEB_PORT,
+                                 metrics_address, io_loop)
+            self._own_web = True
+        else:
+            self.web = None
+        if self.web is not None:
+            prefix = re.escape(web_prefix)
+            self.web.add_handler(prefix + r"/metrics", MetricsHandler,
+                                 {"registry": self.metrics}, owner=self)
+        if self.cache is not None:
+            self.cache.base_url = cache_url or\
+                self.web.url(web_prefix + u"/cache/")
+            self.web.add_handler(
+                prefix + r"/cache/([0-9a-f]{40}|[0-9a-f]{64})(?:/[^/]*)?",
+                CacheHandler, {"cache": self.cache, "fetcher": self.qq.images},
+                owner=self)
 
         settings = XMPPSettings(
             {"software_name": "Magpie",
@@ -71,16 +267,102 @@ class MagpieClient(EventHandler, XMPPFeatureHandler):
              "poll_interval": 10})
 
         version_provider = VersionProvider(settings)
-        mainloop = TornadoMainLoop(settings)
-        self.client = Client(self.jid, [self, version_provider],
-                             settings, mainloop)
+        self._handlers = [self, version_provider]
+        if component is not None:
+            self.client = None
+        else:
+            mainloop = TornadoMainLoop(settings, io_loop=io_loop)
+            self.client = Client(self.jid, self._handlers, settings, mainloop)
+
+    def _register_gauges(self):
+        metrics = self.metrics
+        metrics.gauge("input_queue_depth", u"等待输入的问题数",
+                      lambda: len(self.input_queue))
+        metrics.gauge("spool_depth", u"XMPP 断开时暂存的消息数",
+                      lambda: len(self.spool))
+        metrics.gauge("send_queue_depth", u"等待发送到 QQ 的消息数",
+                      lambda: len(self.qq.scheduler))
+        metrics.gauge("online_friends", u"在线好友数",
+                      lambda: len(self.qq.presence))
+        metrics.gauge("send_total", u"发送到 QQ 的消息数", self._send_counts,
+                      kind="counter")
+        metrics.gauge("send_fragmented_total", u"切分发送的长消息数",
+                      lambda: self.qq.scheduler.fragmented, kind="counter")
+        if self.coalescer is not None:
+            metrics.gauge("coalesce_pending", u"合并暂存的来源数",
+                          lambda: len(self.coalescer))
+        if self.history is not None:
+            metrics.gauge("history_queue_depth", u"等待写入的消息记录数",
+                          lambda: self.history._queue.qsize())
+        if self.cache is not None:
+            metrics.gauge("cache_bytes", u"缓存的图片和文件总大小",
+                          lambda: self.cache.size)
+            metrics.gauge("cache_requests_total", u"缓存查找次数",
+                          self._cache_counts, kind="counter")
+
+    def _send_counts(self):
+        scheduler = self.qq.scheduler
+        return {(("result", "sent"),): scheduler.sent,
+                (("result", "retried"),): scheduler.retried,
+                (("result", "failed"),): scheduler.failed}
+
+    def _cache_counts(self):
+        cache = self.cache
+        return {(("result", "hit"),): cache.hits,
+                (("result", "miss"),): cache.misses,
+                (("result", "evicted"),): cache.evicted}
 
     def run(self, timeout=None):
-        self.client.connect()
-        self.client.run()
+        self.start()
+        if self.component is not None:
+            self.io_loop.start()
+        else:
+            self.client.run()
+
+    def start(self):
+        """ 连接 XMPP, 但不启动主循环, 登录 XMPP 后会自动登录 WebQQ
+        """
+        if self.history is not None:
+            self.history.start()
+        if self._own_web:
+            self.web.start()
+        self._stopping = False
+        if self.component is not None:
+            self.component.attach(self, self._handlers)
+        else:
+            self.client.connect()
+
+    def stop(self):
+        """ 登出 WebQQ 并断开 XMPP
+        """
+        self._stopping = True
+        if self._reconnect_timeout is not None:
+            self.io_loop.remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        self.qq.activate()
+        self.qq.disconnect()
+        self.disconnect()
+        if self.history is not None:
+            self.history.stop()
+        if self._own_web:
+            self.web.stop()
+        elif self.web is not None:
+            self.web.remove_handlers(self)
+        if self.cache is not None:
+            self.cache.flush()
+        if self.qq.snapshot is not None:
+            self.qq.snapshot.flush()
+        if self.presence_notifier is not None:
+            self.presence_notifier.clear()
+        self.input_queue.clear()
+        self.spool.close()
 
     def disconnect(self):
-        self.client.disconnect()
+        if self.component is not None:
+            self.online = False
+            self.component.detach(self)
+        else:
+            self.client.disconnect()
 
     @presence_stanza_handler("subscribe")
     def handle_presence_subscribe(self, stanza):
@@ -120,16 +402,216 @@ class MagpieClient(EventHandler, XMPPFeatureHandler):
         return m
 
     def send_control_msg(self, msg):
-        logger.info(u"Send message {0} to {1}"
-                    .format(msg, self.control_account))
+        """ 立即给控制账号发送消息, 如有合并暂存的消息则先发送暂存的消息
+        """
+        if self.coalescer is not None:
+            self.coalescer.send_now(msg)
+        else:
+            self._send_control_body(msg)
+
+    def relay_msg(self, source, msg):
+        """ 转发 QQ 消息到控制账号, 开启合并时同一来源的消息会被合并发送
+
+        :param source: 消息来源, 如 ("g", group_code)
+        :param msg: 消息内容
+        """
+        if self.coalescer is not None:
+            self.coalescer.append(source, msg)
+        else:
+            self._send_control_body(msg)
+        self._observe_relay(source[0])
+
+    def _observe_relay(self, kind):
+        """ 记录从收到 Poll 返回到转发(或放入合并队列)的耗时
+        """
+        if self.qq.poll_stamp is not None:
+            self.relay_latency.observe(time.time() - self.qq.poll_stamp,
+                                       source=kind)
+
+    def _send_stanza(self, stanza):
+        """ 发送消息, XMPP 断开时放入暂存队列
+        """
+        stream = self.stream
+        if not self.online or stream is None:
+            self._spool_stanza(stanza)
+            return
+
+        start = time.time()
+        try:
+            stream.send(stanza)
+        except:
+            logger.warn(u"发送消息失败, 放入暂存队列", exc_info=True)
+            self._spool_stanza(stanza)
+            return
+        self.xmpp_send_time.observe(time.time() - start)
+
+    def _spool_stanza(self, stanza):
+        self.spool.append({"f": stanza.from_jid.as_unicode(),
+                           "to": stanza.to_jid.as_unicode(),
+                           "type": stanza.stanza_type,
+                           "body": stanza.body,
+                           "th": stanza.thread})
+
+    def _drain_spool(self):
+        """ 补发暂存的消息, 连续的发给同一对象的消息合并后发送
+        """
+        expired = self.spool.expired
+        records = self.spool.drain()
+        expired = self.spool.expired - expired
+        if not records and not expired:
+            return
+
+        tip = u"[S] XMPP 已重新连接, 补发 {0} 条消息".format(len(records))
+        if expired:
+            tip += u", 丢弃 {0} 条过期消息".format(expired)
+        self._send_stanza(self.make_message(JID(self.control_account),
+                                            "chat", tip))
+
+        merged = []
+        for record in records:
+            body = record.get("body")
+            if not body:
+                continue
+            key = (record["f"], record["to"], record.get("type", "chat"),
+                   record.get("th"))
+            size = len(body.encode("utf-8"))
+            if merged and merged[-1][0] == key and \
+                    merged[-1][2] + size < self.SPOOL_MERGE_BYTES:
+                merged[-1][1].append(body)
+                merged[-1][2] += size
+            else:
+                merged.append([key, [body], size])
+
+        for (frm, to, typ, thread), bodies, _ in merged:
+            m = Message(from_jid=JID(frm), to_jid=JID(to), stanza_type=typ,
+                        body=u"\n".join(bodies), thread=thread)
+            if self.xhtml and thread is None:
+                m.add_payload(xhtml_payload(m.body))
+            self._send_stanza(m)
+
+    def send_contact_msg(self, _id, msg):
+        """ 单独会话模式下从 id 对应的 JID 给控制账号发送消息
+        """
+        m = Message(from_jid=self.session.contact_jid(_id),
+                    to_jid=JID(self.control_account), stanza_type="chat",
+                    body=msg, thread=str(_id))
+        self._send_stanza(m)
+        self._observe_relay("session")
+
+    def _owns_contact(self, _id):
+        """ id 是否为此账号的好友, 群, 讨论组或群成员
+        """
+        uin, _type = UniqueIds.get(_id)
+        directory = self.qq.directory
+        if _type == UniqueIds.T_FRI:
+            return directory.friend_name(uin) is not None
+        elif _type == UniqueIds.T_GRP:
+            return directory.group_name(uin) is not None
+        elif _type == UniqueIds.T_DIS:
+            return directory.discu_name(uin) is not None
+        elif _type == UniqueIds.T_TMP:
+            return bool(directory.member_groups(uin))
+        return False
+
+    def handle_session_message(self, stanza, by_thread=False):
+        """ 单独会话模式下将发给对应 JID 的消息直接发送给对应的对象
+
+        :param by_thread: 按消息的 thread 查找对应的对象, 用于服务器改写了
+                          发送人的情况
+        :rtype: 已处理返回 True
+        """
+        if not by_thread:
+            _id = self.session.lookup(stanza.to_jid)
+        elif stanza.thread and not self._is_control_input(stanza.body):
+            # 通过 thread 对应时仍然可以使用命令和回答问题
+            _id = self.session.lookup_thread(stanza.thread)
+        else:
+            _id = None
+        if _id is None:
+            return False
+
+        target = self.session.target(_id)
+        if target is None:
+            self.send_control_msg(u"[S] 没有到 @{0} 的映射".format(_id))
+        else:
+            self.qq.send_message(target[0], target[1], stanza.body)
+        return True
+
+    def _is_control_input(self, body):
+        """ 是否是给机器人的输入(命令或问题的回答), 在和机器人的会话中回复时
+        会带上之前消息的 thread, 这些输入不能按 thread 发给联系人
+        """
+        return self.input_queue.need_input or\
+            ANSWER_RE.match(body.strip()) is not None or\
+            self.command.match(body) is not None
+
+    def _send_control_body(self, msg):
+        logger.info(u"Send message %s to %s", msg, self.control_account)
         m = self.make_message(JID(self.control_account), "chat", msg)
-        self.stream.send(m)
+        if self.xhtml:
+            m.add_payload(xhtml_payload(msg))
+        self._send_stanza(m)
 
     def send_status(self, statustext):
+        """ 发送状态, XMPP 断开时只记录最新的状态, 重新连接后发送
+        """
+        self._status = statustext
+        if not self.online or self.stream is None:
+            return
         to_jid = JID(self.control_account)
-        p = Presence(status=statustext, to_jid=to_jid)
+        p = Presence(from_jid=self.jid, status=statustext, to_jid=to_jid)
         self.stream.send(p)
 
+    def _contact_presence(self, uin, status, to_jid):
+        """ 生成好友对应 JID 的状态, 还没有分配唯一ID的好友返回 None
+        """
+        _id = UniqueIds.get_id(uin)
+        if _id is None:
+            return None
+        from_jid = self.session.contact_jid(_id)
+        name = self.qq.directory.friend_name(uin)
+        if status not in ONLINE_STATUS:
+            return Presence(from_jid=from_jid, to_jid=to_jid,
+                            stanza_type="unavailable", status=name)
+        return Presence(from_jid=from_jid, to_jid=to_jid,
+                        show=self.PRESENCE_SHOW.get(status), status=name)
+
+    def mirror_presence(self, uin, old, status, initial=False):
+        """ 将好友的在线状态同步为对应 JID 的状态, XMPP 断开时不暂存,
+        重新连接后重新发送全部在线好友的状态
+        """
+        if not self.online or self.stream is None:
+            return
+        presence = self._contact_presence(uin, status,
+                                          JID(self.control_account))
+        if presence is None:
+            return
+        try:
+            self.stream.send(presence)
+        except:
+            logger.warn(u"同步好友状态失败", exc_info=True)
+
+    def _mirror_all(self):
+        presence = self.qq.presence
+        for uin in presence.online():
+            self.mirror_presence(uin, None, presence.status(uin))
+
+    @presence_stanza_handler("probe")
+    def handle_presence_probe(self, stanza):
+        """ 组件模式下服务器不会代为回应状态查询
+        """
+        if self.presence_mirror:
+            _id = self.session.lookup(stanza.to_jid)
+            uin, _type = UniqueIds.get(_id) if _id is not None \
+                else (None, None)
+            if _type == UniqueIds.T_FRI:
+                presence = self._contact_presence(
+                    uin, self.qq.presence.status(uin), stanza.from_jid)
+                if presence is not None:
+                    return presence
+        return Presence(from_jid=self.jid, to_jid=stanza.from_jid,
+                        status=self._status)
+
     @presence_stanza_handler("unsubscribed")
     def handle_presence_unsubscribed(self, stanza):
         logger.info(u"{0!r} acknowledged our subscrption cancelation"
@@ -149,37 +631,108 @@ class MagpieClient(EventHandler, XMPPFeatureHandler):
         body = stanza.body
         frm = stanza.from_jid.bare().as_string()
         if frm == self.control_account:
+            self.qq.activate()
             try:
+                # 发给联系人 JID 的消息直接发送, 其他消息先作为问题的回答
+                if body and self.session is not None and\
+                        self.handle_session_message(stanza):
+                    return True
+
                 if self.input_queue.need_input:
                     if not body:
                         self.input_queue.send_tip()
                         return True
-                    self.input_queue.input(body)
-                else:
-                    if self.command.parse(body) is None:
-                        self.send_control_msg(u"你想做什么? 可以发送"
-                                              u"-help 查看帮助.")
+                    if self.input_queue.input(body):
+                        return True
+
+                if body and self.session is not None and\
+                        self.handle_session_message(stanza, by_thread=True):
+                    return True
+
+                if self.command.parse(body) is None and\
+                        not self.input_queue.answer_only(body):
+                    self.send_control_msg(u"你想做什么? 可以发送"
+                                          u"-help 查看帮助.")
             except:
                 self.send_control_msg(u"处理消息时发生错误:\n{0}"
                                       .format(traceback.format_exc()))
-        logger.info(u"receive message '{0}' from {1}"
-                         .format(body, stanza.from_jid))
+        logger.info(u"receive message '%s' from %s", body, stanza.from_jid)
         return True
 
     @event_handler(DisconnectedEvent)
     def handle_disconnected(self, event):
-        return QUIT
+        self.online = False
+        if self._stopping:
+            if self.quit_on_disconnect:
+                return QUIT
+            return
+        logger.warn(u"XMPP 连接断开, 准备重新连接")
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_timeout is not None or self._stopping:
+            return
+        delay = self.reconnect_backoff.delay()
+        logger.info(u"%.1f 秒后重新连接 XMPP", delay)
+        self._reconnect_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + delay, self._reconnect)
+
+    def _reconnect(self):
+        self._reconnect_timeout = None
+        if self._stopping or self.online:
+            return
+        try:
+            self.client.connect()
+        except:
+            logger.warn(u"连接 XMPP 失败", exc_info=True)
+        # 连接失败不一定会有断开事件, 超时后没有登录成功则再次重连
+        self._reconnect_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + self.RECONNECT_TIMEOUT,
+            self._check_reconnected)
+
+    def _check_reconnected(self):
+        self._reconnect_timeout = None
+        if not self.online:
+            self._schedule_reconnect()
+
+    @event_handler(AuthorizedEvent)
+    def handle_authorized(self, event):
+        self.online = True
+        self.reconnect_backoff.reset()
+        if self._reconnect_timeout is not None:
+            self.io_loop.remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        if self._status is not None:
+            self.send_status(self._status)
+        self._drain_spool()
+        if self.presence_mirror:
+            self._mirror_all()
 
     @event_handler(ConnectedEvent)
     def handle_connected(self, event):
         pass
 
+    def handle_component_authorized(self):
+        """ 组件握手成功, 相当于普通连接的登录成功和收到花名册
+        """
+        self.handle_authorized(AuthorizedEvent(self.jid))
+        self._start_qq()
+
+    def handle_component_disconnected(self):
+        """ 组件连接断开, 由组件连接负责重连
+        """
+        self.online = False
+
     @property
     def roster(self):
+        if self.client is None:
+            return None
         return self.client.roster
 
     @property
     def stream(self):
+        if self.component is not None:
+            return self.component
         return self.client.stream
 
     def invite_member(self, jid):
@@ -197,22 +750,254 @@ class MagpieClient(EventHandler, XMPPFeatureHandler):
 
     @event_handler(RosterReceivedEvent)
     def handle_roster_received(self, event):
-        # 登陆 WebQQ
+        self._start_qq()
+
+    def _start_qq(self):
+        # 登陆 WebQQ, 重新连接 XMPP 时 WebQQ 仍然在线
+        if self._qq_started:
+            return
+        self._qq_started = True
         logger.info("-- Connected, start connect WebQQ..")
+        self.qq.activate()
         self.qq.connect()
 
     @event_handler()
     def handle_all(self, event):
-        logger.info(u"-- {0}".format(event))
+        logger.info(u"-- %s", event)
+
+
+_id_table = None
+
+
+def check_ids_path(ids_path, **paths):
+    """ 消息记录和过滤规则按唯一ID保存, 不保存唯一ID时重启后 id 会重新分配,
+    保存的记录和规则会对应到其他对象上
+    """
+    names = sorted(name for name, path in paths.items() if path)
+    if names and not ids_path:
+        raise ValueError(u"{0} requires ids_path".format(u", ".join(names)))
+
+
+def install_id_table(path, io_loop=None):
+    """ 使用文件保存唯一ID, UniqueIds 是进程内全局的, 所以只安装一次
+    """
+    global _id_table
+    if _id_table is None:
+        _id_table = IdTable(path, io_loop)
+        _id_table.install()
+    elif _id_table.path != path:
+        logger.warn(u"已经使用 {0} 保存唯一ID, 忽略 {1}"
+                    .format(_id_table.path, path))
+    return _id_table
 
 
 class QQClient(WebQQClient):
 
+    # 等待输入验证码的时间(秒)
+    VERIFY_CODE_TIMEOUT = 600
+
+    def __init__(self, qq, pwd, debug=False, send_rate=1.0,
+                 account_send_rate=3.0, io_loop=None, metrics=None,
+                 templates=None, face_style="text", session_path=None,
+                 cache=None, snapshot_path=None, fragment_size=600,
+                 rules_path=None):
+        super(QQClient, self).__init__(qq, pwd, debug)
+        self.hub.wrap = self._wrap_activate(self.hub.wrap)
+        self.io_loop = io_loop or IOLoop.instance()
+        self._isolate_http(debug)
+        if session_path:
+            self.sessions = SessionStore(session_path)
+        else:
+            self.sessions = None
+        self.resume_backoff = Backoff(base=0.5, cap=60)
+        self._resume_timeout = None
+        self.metrics = metrics or Registry()
+        self.poll_time = self.metrics.histogram(
+            "poll_seconds", u"Poll 请求往返耗时")
+        self.handler_time = self.metrics.histogram(
+            "handler_seconds", u"QQ 消息/请求处理函数耗时")
+        self.message_count = self.metrics.counter(
+            "qq_messages_total", u"收到的 QQ 消息数")
+        self.relogin_count = self.metrics.counter(
+            "relogin_total", u"重新登录次数")
+        self.poll_stamp = None
+        self.dedupe = DedupeFilter()
+        self.metrics.gauge("qq_duplicates_total", u"丢弃的重复 QQ 消息数",
+                           self._duplicate_counts, kind="counter")
+        self.rules = RuleSet(rules_path)
+        self.metrics.gauge("qq_filtered_total", u"按规则过滤的 QQ 消息数",
+                           self._filtered_counts, kind="counter")
+        self._instrument_handlers()
+        self.hub.dispatch = self._wrap_dispatch(self.hub.dispatch)
+        self.directory = ContactDirectory(self.hub)
+        self.presence = PresenceTracker()
+        self.search = SearchIndex(self.directory)
+        if cache is not None:
+            self.images = ImageFetcher(self.hub, cache, self.io_loop)
+        else:
+            self.images = None
+        self.renderer = Renderer(self.hub, self.directory, templates,
+                                 face_style, self.images)
+        self.hub.handle_qq_msg_contents = self.renderer.contents
+        self.scheduler = SendScheduler(
+            self.hub, lambda msg: self.send_control_msg(msg), send_rate,
+            account_rate=account_send_rate, io_loop=io_loop,
+            fragment_size=fragment_size)
+        if snapshot_path:
+            self.snapshot = ContactSnapshot(snapshot_path, qq,
+                                            io_loop=self.io_loop)
+            self._warm_start()
+        else:
+            self.snapshot = None
+
+    def _warm_start(self):
+        """ 加载联系人快照, 之后获取到的最新数据照常替换快照中的数据
+        """
+        start = time.time()
+        try:
+            if not self.snapshot.load(self.hub):
+                return
+        except:
+            logger.warn(u"加载联系人快照失败", exc_info=True)
+            return
+        directory = self.directory
+        directory.update_friends()
+        if self.hub.get_friends() is not None:
+            self.presence.update_friends(self.hub.get_friends())
+        directory.update_groups()
+        directory.update_discus()
+        for did in self.snapshot.discu_details:
+            directory.update_discu(did)
+        logger.info(u"已从快照加载联系人, 用时 %.3f 秒", time.time() - start)
+
+    def activate(self):
+        """ twqq 的请求通过类属性 WebQQRequest.hub 获取 hub, 在同一个进程
+        运行多个账号时, 进入此账号的代码前需将其指向此账号的 hub
+        """
+        WebQQRequest.hub = self.hub
+
+    def _isolate_http(self, debug=False):
+        """ twqq 创建的 TornadoHTTPClient 没有使用 force_instance, 同一个
+        IOLoop 上的所有账号共享一个实例, 也就共享 CurlShare 和 Cookie, 一个
+        账号登录会覆盖其他账号的 ptwebqq. 替换为此账号独享的实例
+        """
+        http = TornadoHTTPClient(force_instance=True)
+        http.set_user_agent(self.hub.http._user_agent)
+        http.validate_cert = False
+        http.set_global_headers(dict(self.hub.http._headers))
+        http.debug = debug
+        self.hub.http = http
+
+    def _wrap_activate(self, wrap):
+        def _wrap(request, func=None):
+            callback = wrap(request, func)
+
+            def _callback(*args, **kwargs):
+                self.activate()
+                return callback(*args, **kwargs)
+            return _callback
+        return _wrap
+
+    def _instrument_handlers(self):
+        """ 给消息和请求的处理函数加上耗时统计
+        """
+        for mtype, funcs in self.msg_handlers.items():
+            self.msg_handlers[mtype] = [self._timed(func, type=mtype)
+                                        for func in funcs]
+
+        for request, funcs in self.request_handlers.items():
+            self.request_handlers[request] = [
+                self._timed(func, type=request.__name__) for func in funcs]
+
+    def _timed(self, func, **labels):
+        observe = self.handler_time.observe
+        name = func.__name__
+
+        def _func(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(time.time() - start, handler=name, **labels)
+
+        # twqq 通过处理函数的属性获取参数
+        for attr in ("_args_func", "_twqq_msg_type", "_twqq_request"):
+            if hasattr(func, attr):
+                setattr(_func, attr, getattr(func, attr))
+        _func.__name__ = name
+        return _func
+
+    def _duplicate_counts(self):
+        return dict(((("type", poll_type),), n) for poll_type, n
+                    in self.dedupe.dropped.items())
+
+    def _filtered_counts(self):
+        return dict(((("reason", reason),), n) for reason, n
+                    in self.rules.dropped.items())
+
+    def _wrap_dispatch(self, dispatch):
+        def _dispatch(qq_source):
+            self.poll_stamp = time.time()
+            messages = qq_source.get("result")
+            status = ()
+            if qq_source.get("retcode") == 0 and messages:
+                result = self.dedupe.filter(messages)
+                self.rules.set_nickname(self.hub.nickname)
+                result = self.rules.filter(result)
+                if len(result) != len(messages):
+                    qq_source = dict(qq_source, result=result)
+                # 一个消息类型可能有多个处理函数, 按消息计数
+                for m in result:
+                    self.message_count.inc(type=m.get("poll_type"))
+                status = [m.get("value", {}) for m in result
+                          if m.get("poll_type") == "buddies_status_change"]
+            try:
+                return dispatch(qq_source)
+            finally:
+                self.poll_stamp = None
+                # twqq 在 dispatch 中直接更新好友对象的状态
+                for value in status:
+                    self.presence.set_status(value.get("uin"),
+                                             value.get("status"),
+                                             value.get("client_type"))
+        return _dispatch
+
+    def connect(self):
+        """ 有保存的会话时直接使用会话登录, 失败时 twqq 会重新完整登录
+        """
+        if self.sessions is not None and self.sessions.load(self.hub):
+            logger.info(u"使用保存的会话登录 WebQQ")
+            self.hub.connecting = True
+            self.hub.stop_poll = False
+            self.hub.load_next_request(Login2Request())
+            return
+        super(QQClient, self).connect()
+
+    def resume(self, reason):
+        """ 掉线后使用当前会话重新登录(Login2Request), 连续掉线时按指数退避
+        等待, 会话失效时 twqq 会重新完整登录
+
+        :param reason: 重新登录的原因, 用于统计
+        """
+        self.relogin_count.inc(reason=reason)
+        if self._resume_timeout is not None:
+            return
+        delay = self.resume_backoff.delay()
+        logger.info(u"%.2f 秒后恢复 WebQQ 会话", delay)
+        self._resume_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + delay, self._resume)
+
+    def _resume(self):
+        self._resume_timeout = None
+        self.activate()
+        self.hub.relogin()
+
     def handle_verify_code(self, path, r, uin):
         self.verify_img_path = path
         cb = partial(self.enter_verify_code, r=r, uin=uin)
         self.input_queue.append(u"[S] 需要验证码, 请输入位于: {0} 位置的验证码"
-                                .format(path), cb)
+                                .format(path), cb,
+                                timeout=self.VERIFY_CODE_TIMEOUT)
 
     @register_request_handler(BeforeLoginRequest)
     def handle_verify_check(self, request, resp, data):
@@ -231,18 +1016,34 @@ class QQClient(WebQQClient):
             self.send_control_msg(u"[S] WebQQ 没有数据返回, 尝试重新登录")
             return
 
-        if data.get("retcode") != 0:
-            self.send_control_msg(u"[S] WebQQ 登录失败: {0}"
-                                  .format(data.get("retcode")))
+        if not isinstance(data, dict) or data.get("retcode") != 0:
+            retcode = data.get("retcode") if isinstance(data, dict) else data
+            self.send_control_msg(u"[S] WebQQ 登录失败: {0}".format(retcode))
+            if self.sessions is not None:
+                self.sessions.clear()
+            return
+
+        self.resume_backoff.reset()
+        if self.sessions is not None:
+            try:
+                self.sessions.save(self.hub)
+            except (IOError, OSError):
+                logger.warn(u"保存会话失败", exc_info=True)
+        if request.relogin:
+            self.send_control_msg(u"[S] WebQQ 会话已恢复")
+            self.xmpp_client.send_status(self.hub.nickname + u"[在线]")
 
     @register_request_handler(BuddyMsgRequest)
     def handle_buddy_msg(self, request, response, data):
+        # 发送失败先由调度器重试, 重试次数用完才重新登录
+        if self.scheduler.on_response(request, data):
+            return
+
         if data is None:
             logger.info(u"无法发送消息, 重新登录")
             self.send_control_msg(u"[S] 无法发送消息, 重新登录")
             self.xmpp_client.send_status(self.hub.nickname + u"[重新登录中..]")
-            self.disconnect()
-            self.connect()
+            self.resume("send")
 
     @register_request_handler(FriendInfoRequest)
     def handle_frind_info_erro(self, request, resp, data):
@@ -260,6 +1061,61 @@ class QQClient(WebQQClient):
             self.xmpp_client.send_status(self.hub.nickname + u"[在线]")
             self._logined = True
 
+    @register_request_handler(GroupMsgRequest)
+    def handle_group_msg(self, request, response, data):
+        self.scheduler.on_response(request, data)
+
+    @register_request_handler(DiscuMsgRequest)
+    def handle_discu_msg(self, request, response, data):
+        self.scheduler.on_response(request, data)
+
+    @register_request_handler(SessMsgRequest)
+    def handle_sess_msg(self, request, response, data):
+        self.scheduler.on_response(request, data)
+
+    @register_request_handler(FriendInfoRequest)
+    def update_friend_directory(self, request, resp, data):
+        if isinstance(data, dict) and data.get("retcode") == 0:
+            self.directory.update_friends()
+            self.presence.update_friends(self.hub.get_friends())
+            if self.snapshot is not None:
+                self.snapshot.set_friends(data.get("result", {}))
+
+    @register_request_handler(FriendStatusRequest)
+    def update_presence(self, request, resp, data):
+        if isinstance(data, dict) and data.get("retcode") == 0:
+            self.presence.replace(data.get("result", []))
+
+    @register_request_handler(GroupListRequest)
+    def update_groups_directory(self, request, resp, data):
+        self.directory.update_groups()
+        if self.snapshot is not None and isinstance(data, dict) and\
+                data.get("retcode") == 0:
+            self.snapshot.set_groups(data.get("result", {}))
+
+    @register_request_handler(GroupMembersRequest)
+    def update_group_directory(self, request, resp, data):
+        if isinstance(data, dict) and data.get("retcode") == 0:
+            self.directory.update_group(request._gcode)
+            if self.snapshot is not None:
+                self.snapshot.set_members(request._gcode,
+                                          data.get("result", {}))
+
+    @register_request_handler(DiscuListRequest)
+    def update_discus_directory(self, request, resp, data):
+        if isinstance(data, dict) and data.get("retcode") == 0:
+            self.directory.update_discus()
+            if self.snapshot is not None:
+                self.snapshot.set_discus(data.get("result", {}))
+
+    @register_request_handler(DiscuInfoRequest)
+    def update_discu_directory(self, request, resp, data):
+        if isinstance(data, dict) and data.get("retcode") == 0:
+            self.directory.update_discu(request._did)
+            if self.snapshot is not None:
+                self.snapshot.set_discu_detail(request._did,
+                                               data.get("result", {}))
+
     @kick_message_handler
     def handle_kick(self, message):
         self.send_control_msg(u"[S] QQ 在别处登录")
@@ -275,11 +1131,38 @@ class QQClient(WebQQClient):
     @group_message_handler
     def handle_group_message(self, member_nick, content, group_code,
                              send_uin, source):
-        groupname = self.hub.get_groups().get_group_name(group_code)
-        self.send_control_msg(u"[Q][{0}({1})][{2}({3})] {4}"
-                              .format(groupname, UniqueIds.get_id(group_code),
-                                      member_nick, UniqueIds.get_id(send_uin),
-                                      content))
+        if self.relay_session_msg(group_code, content, member_nick):
+            return
+
+        msg = self.renderer.group(group_code, send_uin, member_nick, content)
+        self.store_history(group_code, msg)
+        self.relay_msg(("g", group_code), msg)
+
+    def store_history(self, uin, msg, direction=INBOUND):
+        """ 存储消息记录
+
+        :param uin: 消息对应对象(群/好友/讨论组/群成员)的 uin
+        :param msg: 消息内容
+        """
+        history = self.xmpp_client.history
+        if history is not None:
+            history.append(UniqueIds.get_id(uin), msg, direction)
+
+    def relay_session_msg(self, uin, content, nick=None):
+        """ 单独会话模式下从对应的 JID 转发消息, 未开启时返回 False
+
+        :param uin: 消息对应对象的 uin
+        :param content: 消息内容
+        :param nick: 群/讨论组中发送人的昵称
+        """
+        if self.xmpp_client.session is None:
+            return False
+
+        if nick is not None:
+            content = u"{0}: {1}".format(nick, content)
+        self.store_history(uin, content)
+        self.xmpp_client.send_contact_msg(UniqueIds.get_id(uin), content)
+        return True
 
     def send_message_with_aid(self, _id, content):
         uin, _type = UniqueIds.get(int(_id))
@@ -287,35 +1170,37 @@ class QQClient(WebQQClient):
             logger.info(UniqueIds._map)
             self.send_control_msg(u"[S] 没有到 @{0} 的映射".format(_id))
             return
+        self.send_message(uin, _type, content)
+
+    def send_message(self, uin, _type, content):
+        """ 根据 uin 和类型发送消息
+        """
+        self.store_history(uin, content, OUTBOUND)
         if _type == UniqueIds.T_GRP:
-            self.hub.send_group_msg(uin, content)
+            self.scheduler.send(GROUP, uin, content)
         elif _type == UniqueIds.T_FRI:
-            self.hub.send_buddy_msg(uin, content)
+            self.scheduler.send(BUDDY, uin, content)
         elif _type == UniqueIds.T_DIS:
-            self.hub.send_discu_msg(uin, content)
+            self.scheduler.send(DISCU, uin, content)
         elif _type == UniqueIds.T_TMP:
-            groups = self.hub.get_groups()
-            for grp in groups:
-                if uin in grp:
-                    self.hub.send_sess_msg(grp.gid, uin, content)
-                    break
+            for gcode in self.directory.member_groups(uin):
+                gid = self.directory.group_gid(gcode)
+                self.scheduler.send(SESS, uin, content, gid)
+                break
 
     @sess_message_handler
     def handle_sess_message(self, qid, from_uin, content, source):
-        groups = self.hub.get_groups()
-        gcode = groups.get_gcode(qid)
-        gname = groups.get_group_name(gcode)
-        nick = self.hub.get_group_member_nick(gcode, from_uin)
-        gid = UniqueIds.get_id(gcode)
-        mid = UniqueIds.get_id(from_uin)
-        msg = u"[T][{0}({1}) 来自 {2}({3})] {4}".format(nick, mid, gname, gid,
-                                                          content)
-        self.send_control_msg(msg)
+        if self.relay_session_msg(from_uin, content):
+            return
+
+        msg = self.renderer.sess(self.directory.gcode(qid), from_uin, content)
+        self.store_history(from_uin, msg)
+        self.relay_msg(("t", from_uin), msg)
 
     @file_message_handler
     def handle_file_message(self, from_uin, to_uin, lcid, guid, is_cancel,
                             source):
-        name = self.hub.get_friends().get_show_name(from_uin)
+        name = self.directory.friend_name(from_uin)
         if is_cancel:
             tip = u"[S] {0} 取消了发送文件 {1}".format(name, guid)
             self.send_control_msg(tip)
@@ -325,43 +1210,40 @@ class QQClient(WebQQClient):
 
         def callback(msg):
             if msg.strip().lower() == "y":
-                self.hub.recv_file(guid, lcid, from_uin, self.store_file)
+                self.xmpp_client.files.receive(guid, lcid, from_uin)
                 return True, ""
             else:
-                return True, u"[S] 你取消了接收 {0} 发送的文件 {1}".format(name, tip)
+                return True, u"[S] 你取消了接收 {0} 发送的文件 {1}".format(name,
+                                                                     guid)
 
-        self.xmpp_client.input_queue.append(tip, callback)
-
-    def store_file(self, fname, data):
-        path = os.path.join("/tmp", fname)
-        with open(path, 'wb') as f:
-            f.write(data)
-
-        self.send_control_msg(u"[S] 文件已接收, 存放在: {0}".format(path))
+        self.xmpp_client.input_queue.append(tip, callback, default="n")
 
     @discu_message_handler
     def handle_discu_message(self, did, from_uin, content, source):
-        name = self.hub.get_discu().get_name(did)
-        mname = self.hub.get_discu().get_mname(did, from_uin)
-        msg = u"[D][{0}({1})][{2}({3})] {4}".format(
-            name, UniqueIds.get_id(did), mname, UniqueIds.get_id(from_uin),
-            content)
-        self.send_control_msg(msg)
+        mname = self.directory.discu_member_name(did, from_uin)
+        if self.relay_session_msg(did, content, mname):
+            return
+
+        msg = self.renderer.discu(did, from_uin, mname, content)
+        self.store_history(did, msg)
+        self.relay_msg(("d", did), msg)
 
     def send_discu_with_nick(self, nick, did, content):
         content = u"{0}: {1}".format(nick, content)
-        self.hub.send_discu_msg(did, content)
+        self.scheduler.send(DISCU, did, content)
 
     def send_group_with_nick(self, nick, group_code, content):
         content = u"{0}: {1}".format(nick, content)
-        self.hub.send_group_msg(group_code, content)
+        self.scheduler.send(GROUP, group_code, content)
 
     @buddy_message_handler
     def handle_buddy_message(self, from_uin, content, source):
-        name = self.hub.get_friends().get_show_name(from_uin)
-        self.send_control_msg(u"[F][{0}({1})] {2}"
-                              .format(name, UniqueIds.get_id(from_uin),
-                                      content))
+        if self.relay_session_msg(from_uin, content):
+            return
+
+        msg = self.renderer.buddy(from_uin, content)
+        self.store_history(from_uin, msg)
+        self.relay_msg(("f", from_uin), msg)
 
     @register_request_handler(PollMessageRequest)
     def handle_qq_errcode(self, request, resp, data):
@@ -370,11 +1252,17 @@ class QQClient(WebQQClient):
             logger.error(u"获取登出消息 {0!r}".format(data))
             self.send_control_msg("[S] 获取登出消息, 重新登录")
             self.xmpp_client.send_status(self.hub.nickname + u"[重新登录中..]")
-            self.disconnect()
-            self.connect()
+            self.resume("poll")
+
+    @register_request_handler(PollMessageRequest)
+    def observe_poll_time(self, request, resp, data):
+        request_time = getattr(resp, "request_time", None)
+        if request_time is not None:
+            self.poll_time.observe(request_time)
 
     def set_control_msg(self, cb, xmpp_client):
         self.send_control_msg = cb
+        self.relay_msg = xmpp_client.relay_msg
         self.xmpp_client = xmpp_client
         self.input_queue = xmpp_client.input_queue
 
@@ -390,22 +1278,163 @@ def main():
     options.define("debug", type=bool, default=False, help="Show debug info")
     options.define("control", default=None, help="XMPP Control Account",
                    metavar="CONTROL")
+    options.define("coalesce_interval", type=float, default=0,
+                   help="Merge QQ messages within this window(seconds)")
+    options.define("coalesce_bytes", type=int, default=4096,
+                   help="Max bytes of merged messages per source")
+    options.define("history_dir", default=None,
+                   help="Directory to store message history")
+    options.define("history_max_age", type=int, default=None,
+                   help="Seconds to keep message history")
+    options.define("session_mode", type=bool, default=False,
+                   help="Relay every QQ contact from its own JID")
+    options.define("session_domain", default=None,
+                   help="Domain of contact JIDs in session mode")
+    options.define("ids_path", default=None,
+                   help="File to keep short ids stable across restarts")
+    options.define("file_dir", default="/tmp",
+                   help="Directory to store received files")
+    options.define("file_max_size", type=int, default=0,
+                   help="Max bytes of a received file, 0 means no limit")
+    options.define("send_rate", type=float, default=1.0,
+                   help="Max messages per second sent to one QQ contact")
+    options.define("account_send_rate", type=float, default=3.0,
+                   help="Max messages per second sent by the QQ account")
+    options.define("metrics_port", type=int, default=0,
+                   help="Serve metrics on this local HTTP port")
+    options.define("templates", default=None,
+                   help="JSON file of message templates")
+    options.define("face_style", default="text",
+                   help="Show QQ faces as text or emoji")
+    options.define("xhtml", type=bool, default=False,
+                   help="Also send messages as XHTML-IM")
+    options.define("session_path", default=None,
+                   help="File to keep the WebQQ session for fast relogin")
+    options.define("spool_path", default=None,
+                   help="File to keep messages while XMPP is disconnected")
+    options.define("spool_max_age", type=int, default=24 * 3600,
+                   help="Seconds to keep messages while XMPP is disconnected")
+    options.define("snapshot_path", default=None,
+                   help="Save contacts to this file for fast start")
+    options.define("fragment_size", type=int, default=600,
+                   help="Split messages to QQ longer than this")
+    options.define("rules_path", default=None,
+                   help="JSON file of rules to filter group messages")
+    options.define("presence_notify", type=int, default=0,
+                   help="Notify friends' status changes every N seconds")
+    options.define("presence_mirror", type=bool, default=False,
+                   help="Mirror friends' status onto contact JIDs")
+    options.define("cache_dir", default=None,
+                   help="Store received images and files in this cache")
+    options.define("cache_max_size", type=int, default=512 * 1024 * 1024,
+                   help="Max bytes of the cache")
+    options.define("cache_url", default=None,
+                   help="URL prefix of cached items (behind a proxy)")
+    options.define("prompt_timeout", type=int, default=300,
+                   help="Seconds to wait for answers of questions")
+    options.define("split", type=bool, default=False,
+                   help="Run WebQQ and XMPP in separate processes")
+    options.define("ipc_path", default=None,
+                   help="Unix socket between the WebQQ and XMPP processes")
+    options.define("component", default=None,
+                   help="Connect as this external component domain")
+    options.define("component_secret", default=None,
+                   help="Shared secret of the external component")
+    options.define("component_server", default="127.0.0.1:5347",
+                   help="host:port of the server's component port")
+    options.define("config", default=None, help="Run accounts in config file",
+                   metavar="CONFIG")
     options.parse_command_line()
 
+    if options.options.config:
+        from magpie.tenant import TenantManager
+
+        manager = TenantManager.from_config(options.options.config,
+                                            getpass.getpass)
+        enable_pretty_logging()
+        manager.run()
+        return
+
     xmpp = options.options.xmpp
     qq = options.options.qq
     control = options.options.control
     debug = options.options.debug
+    domain = options.options.component
+    if domain and not xmpp and qq:
+        from magpie.component import default_jid
+
+        xmpp = default_jid(qq, domain)
     if not xmpp or not qq or not control:
         options.print_help()
         return
-
-    xmpp_pwd = getpass.getpass(u"Enter XMPP Password: ")
+    check_ids_path(options.options.ids_path,
+                   history_dir=options.options.history_dir,
+                   rules_path=options.options.rules_path)
+
+    if domain:
+        from magpie.component import ComponentStream, parse_address
+
+        xmpp_pwd = None
+        secret = options.options.component_secret or \
+            getpass.getpass(u"Enter Component Secret: ")
+        host, port = parse_address(options.options.component_server)
+    else:
+        xmpp_pwd = getpass.getpass(u"Enter XMPP Password: ")
     qq_pwd = getpass.getpass(u"Enter QQ Password: ")
 
+    templates = None
+    if options.options.templates:
+        templates = Renderer.load_templates(options.options.templates)
+
+    def make_component():
+        # 分进程模式下需要在子进程中创建
+        if domain:
+            return ComponentStream(domain, secret, host, port)
+
+    def make_client(component):
+        opts = options.options
+        return MagpieClient(qq, qq_pwd, xmpp, xmpp_pwd, control, debug,
+                            coalesce_interval=opts.coalesce_interval,
+                            coalesce_bytes=opts.coalesce_bytes,
+                            history_dir=opts.history_dir,
+                            history_max_age=opts.history_max_age,
+                            session_mode=opts.session_mode,
+                            session_domain=opts.session_domain or domain,
+                            ids_path=opts.ids_path,
+                            file_dir=opts.file_dir,
+                            file_max_size=opts.file_max_size,
+                            send_rate=opts.send_rate,
+                            account_send_rate=opts.account_send_rate,
+                            metrics_port=opts.metrics_port,
+                            templates=templates,
+                            face_style=opts.face_style,
+                            xhtml=opts.xhtml,
+                            session_path=opts.session_path,
+                            spool_path=opts.spool_path,
+                            spool_max_age=opts.spool_max_age,
+                            prompt_timeout=opts.prompt_timeout,
+                            component=component,
+                            cache_dir=opts.cache_dir,
+                            cache_max_size=opts.cache_max_size,
+                            cache_url=opts.cache_url,
+                            snapshot_path=opts.snapshot_path,
+                            presence_notify=opts.presence_notify,
+                            presence_mirror=opts.presence_mirror,
+                            fragment_size=opts.fragment_size,
+                            rules_path=opts.rules_path)
+
     enable_pretty_logging()
-    client = MagpieClient(qq, qq_pwd, xmpp, xmpp_pwd, control, debug)
-    client.run()
+    if options.options.split:
+        from magpie.worker import IPCLink, XMPPWorker, run_split
+
+        ipc_path = options.options.ipc_path or \
+            u"/tmp/magpie-{0}.sock".format(qq)
+        run_split(lambda: make_client(IPCLink(ipc_path)),
+                  lambda: XMPPWorker(xmpp, xmpp_pwd, control, ipc_path,
+                                     make_component()))
+        return
+
+    make_client(make_component()).run()
 
 
 if __name__ == "__main__":
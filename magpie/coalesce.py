@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/23 10:12:37
+#   Desc    :   合并短时间内的消息
+#
+import logging
+
+from collections import OrderedDict
+
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger("magpie")
+
+
+class MessageCoalescer(object):
+    """ 消息合并器, 将一段时间窗口内同一来源的消息合并为一条发送
+
+    消息按来源(如群, 好友, 讨论组)分组暂存, 达到时间窗口时每个来源合并为
+    一条消息按首条消息到达的顺序发出. 某个来源加入新消息后会超过字节上限时
+    先发出已经暂存的消息, 合并后的消息不会超过上限(单条消息本身超过上限时
+    单独发出).
+
+        :param send_cb: 实际发送消息的 callback
+        :param interval: 时间窗口, 单位秒
+        :param max_bytes: 单个来源暂存的字节上限
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    def __init__(self, send_cb, interval=0.2, max_bytes=4096, io_loop=None):
+        self._send_cb = send_cb
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.io_loop = io_loop or IOLoop.instance()
+        self._pending = OrderedDict()   # 来源 => [消息列表, 字节数]
+        self._timeout = None
+
+    def append(self, source, msg):
+        """ 暂存一条消息
+
+        :param source: 消息来源, 可哈希的对象, 同一来源的消息会被合并
+        :param msg: 消息内容
+        """
+        size = len(msg.encode("utf-8"))
+        item = self._pending.get(source)
+        # 合并时消息之间有一个换行
+        if item is not None and item[1] + 1 + size > self.max_bytes:
+            self.flush(source)
+            item = None
+
+        if item is not None:
+            item[0].append(msg)
+            item[1] += 1 + size
+        else:
+            item = self._pending[source] = [[msg], size]
+
+        if item[1] >= self.max_bytes:
+            self.flush(source)
+        elif self._timeout is None:
+            self._timeout = self.io_loop.add_timeout(
+                self.io_loop.time() + self.interval, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timeout = None
+        self.flush()
+
+    def flush(self, source=None):
+        """ 立即发送暂存的消息
+
+        :param source: 只发送该来源的消息, 为 None 则发送全部
+        """
+        if source is None:
+            pending, self._pending = self._pending, OrderedDict()
+            if self._timeout is not None:
+                self.io_loop.remove_timeout(self._timeout)
+                self._timeout = None
+            items = pending.values()
+        else:
+            item = self._pending.pop(source, None)
+            items = [item] if item else []
+
+        for lines, _ in items:
+            self._send_cb(u"\n".join(lines))
+
+    def send_now(self, msg):
+        """ 先发送全部暂存的消息再发送此消息, 用于系统通知等需要立即送达的消息
+        """
+        self.flush()
+        self._send_cb(msg)
+
+    def __len__(self):
+        return len(self._pending)
@@ -7,13 +7,56 @@
 #   Desc    :   命令解析
 #
 import re
+import time
+import types
 import logging
 import inspect
 
 from twqq.objects import UniqueIds
 
+from magpie.history import OUTBOUND
+from magpie.search import FRIEND, MEMBER, GROUP, DISCU
+from magpie.listing import Listing, ListCache, diff
+
+try:
+    from pkg_resources import iter_entry_points
+except ImportError:
+    iter_entry_points = None
+
 logger = logging.getLogger("magpie")
 
+ENTRY_POINT_GROUP = "magpie.commands"
+
+_REGEX_META = set(".^$*+?{}[]\\|()")
+
+
+def command_token(command):
+    """ 获取命令的前导标识, # 开头的命令标识为 #, 其他为第一个空白前的内容
+    """
+    if command.startswith("#"):
+        return "#"
+    parts = command.split(None, 1)
+    return parts[0] if parts else ""
+
+
+def pattern_token(pattern):
+    """ 获取命令正则匹配模式的前导标识, 无法确定时返回 None
+    """
+    pattern = pattern.lstrip("^")
+    if pattern.startswith("#"):
+        return "#"
+
+    for i, char in enumerate(pattern):
+        if char in _REGEX_META or char.isspace():
+            break
+    else:
+        return pattern or None
+
+    rest = pattern[i:]
+    if i and (rest[0].isspace() or rest.startswith((r"\s", "$"))):
+        return pattern[:i]
+    return None
+
 
 def register(command, replace=None):
     """ 将函数注册为命令
@@ -29,29 +72,116 @@ def register(command, replace=None):
 
 
 class Command(object):
+    """ 命令解析
+
+    命令先按前导标识(``-xxx`` 或 ``#``)在前缀表中查找, 未找到时再使用所有
+    命令组合成的一个正则匹配. 除了使用 @register 装饰成员函数外, 第三方包
+    也可以通过 ``magpie.commands`` entry point 注册被 @register 装饰的函数,
+    函数的第一个参数是此类的实例.
+    """
+    SEARCH_LIMIT = 20
+    # -history 一次最多显示的记录数
+    HISTORY_LIMIT = 100
+    # 列表命令每页的行数
+    PAGE_SIZE = 50
 
     def __init__(self, xmpp_client, qq_client):
         self.xmpp_client = xmpp_client
         self.qq_client = qq_client
+        self.lists = ListCache()
+        self._last_online = None    # 上次 -list 的在线好友, 用于 -list diff
         self._command_map = {}
+        self._prefix_map = {}
+        self._combined = None
+        self._combined_handlers = {}
         self._load_commands()
 
     def _load_commands(self):
         for _, handler in inspect.getmembers(self, callable):
             if not hasattr(handler, "_command"):
                 continue
+            self._add_command(handler)
 
-            self._command_map[handler._command] = (
-                re.compile(handler._command, flags=re.M | re.S),
-                handler, handler._replace
-            )
+        self._load_entry_points()
+        self._build_index()
+
+    def _load_entry_points(self):
+        if iter_entry_points is None:
+            return
+
+        for entry_point in iter_entry_points(ENTRY_POINT_GROUP):
+            try:
+                func = entry_point.load()
+            except:
+                logger.warn(u"加载命令 {0} 失败".format(entry_point),
+                            exc_info=True)
+                continue
+
+            if not hasattr(func, "_command"):
+                logger.warn(u"{0} 没有使用 register 注册".format(entry_point))
+                continue
+            self._add_command(types.MethodType(func, self))
+
+    def _add_command(self, handler):
+        self._command_map[handler._command] = (
+            re.compile(handler._command, flags=re.M | re.S),
+            handler, handler._replace
+        )
+
+    def _build_index(self):
+        """ 建立前缀表和组合正则
+        """
+        self._prefix_map = {}
+        alternation = []
+        self._combined_handlers = {}
+        for i, (command, (pattern, handler, _)) in enumerate(
+                self._command_map.items()):
+            token = pattern_token(command)
+            if token is not None:
+                self._prefix_map.setdefault(token, []).append(
+                    (pattern, handler))
+            name = "_c{0}".format(i)
+            alternation.append(u"(?P<{0}>{1})".format(name, command))
+            self._combined_handlers[name] = (pattern, handler)
+
+        try:
+            self._combined = re.compile(u"|".join(alternation),
+                                        flags=re.M | re.S)
+        except re.error:
+            logger.warn(u"无法组合命令正则, 使用逐个匹配", exc_info=True)
+            self._combined = None
+
+    def match(self, command):
+        """ 查找命令对应的处理函数
+
+        :param command: 命令
+        :rtype: (handler, args, kwargs) 或 None
+        """
+        for pattern, handler in self._prefix_map.get(command_token(command),
+                                                     ()):
+            sre = pattern.match(command)
+            if sre:
+                return handler, sre.groups(), sre.groupdict()
+
+        if self._combined is not None:
+            sre = self._combined.match(command)
+            if not sre:
+                return None
+            pattern, handler = self._combined_handlers[sre.lastgroup]
+            sre = pattern.match(command)
+            return handler, sre.groups(), sre.groupdict()
 
-    def parse(self, command):
         for pattern, handler, _ in self._command_map.values():
             sre = pattern.match(command)
             if sre:
-                handler(*sre.groups(), **sre.groupdict())
-                return True
+                return handler, sre.groups(), sre.groupdict()
+
+    def parse(self, command):
+        r = self.match(command)
+        if r is not None:
+            handler, args, kwargs = r
+            handler(*args, **kwargs)
+            return True
 
     @register(r'-help')
     def help_info(self):
@@ -65,63 +195,222 @@ class Command(object):
 
         self.xmpp_client.send_control_msg("\n".join(info))
 
-    @register("-list")
-    def list_online_friends(self):
-        """ 获取在线好友
+    @register(r"-list\s*(.*)", "-list [分组] [页码] | -list diff")
+    def list_online_friends(self, arg=u""):
+        """ 获取在线好友, 可以指定分组和页码, diff 只显示上次查看后的变化
+        """
+        if self.qq_client.hub.get_friends() is None:
+            self.xmpp_client.send_control_msg(u"[S] 还没有获取到好友列表")
+            return
+
+        arg = arg.strip()
+        if arg == u"diff":
+            self._list_online_diff()
+            return
+
+        category, page = self._parse_page(arg)
+        category = category or None
+        if category and category not in self._category_names():
+            self.xmpp_client.send_control_msg(u"[S] 没有分组 {0}"
+                                              .format(category))
+            return
+
+        listing = self._online_listing(category)
+        if not category:
+            self._last_online = listing.entries
+        command = u"-list {0}".format(category) if category else u"-list"
+        self._send_page(u"在线好友列表", listing, page, command)
+
+    def _list_online_diff(self):
+        listing = self._online_listing()
+        old, self._last_online = self._last_online, listing.entries
+        if old is None:
+            self.xmpp_client.send_control_msg(
+                u"[S] 当前在线 {0} 人, 之后发送 -list diff 查看变化"
+                .format(listing.count))
+            return
+
+        added, removed, changed = diff(old, listing.entries)
+        if not (added or removed or changed):
+            self.xmpp_client.send_control_msg(u"[S] 在线好友没有变化")
+            return
+
+        info = [u"在线好友变化(当前 {0} 人)".format(listing.count)]
+        info.extend(u"+ " + line for line in added)
+        info.extend(u"- " + line for line in removed)
+        info.extend(u"* " + line for line in changed)
+        self.xmpp_client.send_control_msg("\n".join(info))
+
+    def _parse_page(self, arg):
+        """ 解析 ``[内容] [页码]`` 形式的参数
+
+        :rtype: (内容, 页码)
+        """
+        parts = arg.rsplit(None, 1)
+        if parts and parts[-1].isdigit():
+            return u" ".join(parts[:-1]), max(1, int(parts[-1]))
+        return arg, 1
+
+    def _category_names(self):
+        return set(cate.name for cate in
+                   self.qq_client.hub.get_friends().categories)
+
+    def _online_listing(self, category=None):
+        directory = self.qq_client.directory
+        presence = self.qq_client.presence
+        return self.lists.get(("friends", category),
+                              (directory.version, presence.version),
+                              lambda: self._build_online(category))
+
+    def _build_online(self, category=None):
+        """ 只遍历在线的好友
         """
         friends = self.qq_client.hub.get_friends()
-        cate_map = {}
-        for cate in friends.categories:
-            cate_map[cate.index] = {"name": cate.name, "sort":  cate.sort,
-                                        "list": []}
-        logger.info(u"分组信息: {0!r}".format(cate_map))
-
-        for item in friends.info:
-            if item.status in ["online", "away"]:
-                try:
-                    cate_map[item.categories]["list"].append(item)
-                except KeyError:
-                    logger.info(u"{0} 分组错误: {1!r}".format(item.nick, cate_map),
-                                exc_info=True)
-
-        lst = [(x.get("sort"), x.get("name"), x.get("list"))
-               for x in cate_map.values()]
-
-        lst = sorted(lst, key=lambda x: x[0])
-        info = [u"在线好友列表"]
-        for _, name, _list in lst:
-            info.append(u"== {0} ==".format(name))
-            for item in _list:
+        presence = self.qq_client.presence
+        cates = dict((cate.index, cate) for cate in friends.categories)
+        if category:
+            indexes = [index for index, cate in cates.items()
+                       if cate.name == category]
+        else:
+            indexes = presence.categories()
+
+        sections = {}
+        entries = {}
+        for index in indexes:
+            lines = []
+            for uin in presence.online(index):
+                item = friends._uin_map.get(uin)
+                if item is None:
+                    continue
                 if item.markname:
                     nick = u"{0}({1})".format(item.markname, item.nick)
                 else:
                     nick = item.nick
+                line = u"({1}){0}[{2}]".format(nick, item._id,
+                                               presence.status(uin))
+                lines.append((nick, line))
+                entries[uin] = line
+            if lines:
+                lines.sort()
+                sections[index] = [line for _, line in lines]
+
+        # 不在分组信息中的好友放在最后
+        order = sorted((cates[index].sort if index in cates else
+                        float("inf"), index) for index in sections)
+        return Listing([(cates[index].name if index in cates else
+                         u"未分组", sections[index])
+                        for _, index in order], entries)
 
-                info.append(u"({1}){0}[{2}]".format(nick, item._id,
-                                                    item.status))
+    def _send_page(self, title, listing, page, command):
+        pages = listing.pages(self.PAGE_SIZE)
+        if page > pages:
+            self.xmpp_client.send_control_msg(u"[S] {0}只有 {1} 页"
+                                              .format(title, pages))
+            return
 
+        if pages == 1:
+            info = [u"{0}({1})".format(title, listing.count)]
+        else:
+            info = [u"{0}({1}) 第 {2}/{3} 页".format(title, listing.count,
+                                                   page, pages)]
+        info.extend(listing.page(page, self.PAGE_SIZE))
+        if page < pages:
+            info.append(u"发送 {0} {1} 查看下一页".format(command, page + 1))
         self.xmpp_client.send_control_msg("\n".join(info))
 
-    @register("-glist")
-    def list_groups(self):
+    @register(r"-glist\s*(\d*)", "-glist [页码]")
+    def list_groups(self, page=u""):
         """ 获取群列表
         """
-        info = [u"群列表"]
+        listing = self.lists.get("groups", self.qq_client.directory.version,
+                                 self._build_groups)
+        self._send_page(u"群列表", listing, max(1, int(page or 1)),
+                        u"-glist")
+
+    def _build_groups(self):
         groups = self.qq_client.hub.get_groups()
+        lines = []
         if groups:
-            for item in groups.groups:
-                info.append(u"({0}) {1}".format(item._id, item.name))
-        self.xmpp_client.send_control_msg("\n".join(info))
+            lines = [u"({0}) {1}".format(item._id, item.name)
+                     for item in groups.groups]
+        return Listing([(None, lines)])
 
-    @register("-dlist")
-    def list_discu(self):
+    @register(r"-dlist\s*(\d*)", "-dlist [页码]")
+    def list_discu(self, page=u""):
         """ 获取讨论组列表
         """
-        info = [u"讨论组列表"]
+        listing = self.lists.get("discus", self.qq_client.directory.version,
+                                 self._build_discus)
+        self._send_page(u"讨论组列表", listing, max(1, int(page or 1)),
+                        u"-dlist")
+
+    def _build_discus(self):
         discu = self.qq_client.hub.get_discu()
+        lines = []
         if discu:
-            for item in discu.discus:
-                info.append(u"({0}) {1}".format(item._id, item.name))
+            lines = [u"({0}) {1}".format(item._id, item.name)
+                     for item in discu.discus]
+        return Listing([(None, lines)])
+
+    @register(r"-search\s+(.+)", "-search term")
+    def search_contacts(self, term):
+        """ 按昵称/备注名/群名片/拼音搜索好友, 群成员, 群和讨论组
+        """
+        start = time.time()
+        results = self.qq_client.search.search(term, self.SEARCH_LIMIT)
+        elapsed = (time.time() - start) * 1000
+        if not results:
+            self.xmpp_client.send_control_msg(u"[S] 没有找到 {0}".format(term))
+            return
+
+        directory = self.qq_client.directory
+        info = [u"搜索 {0}: {1} 个结果({2:.1f}ms)"
+                .format(term, len(results), elapsed)]
+        for kind, owner, uin, names in results:
+            name = u"/".join(names)
+            if kind == FRIEND:
+                info.append(u"[好友] {0}({1})"
+                            .format(name, UniqueIds.get_id(uin)))
+            elif kind == MEMBER:
+                info.append(u"[群成员] {0}({1}) 来自 {2}({3})"
+                            .format(name, UniqueIds.get_id(uin),
+                                    directory.group_name(owner),
+                                    UniqueIds.get_id(owner)))
+            elif kind == GROUP:
+                info.append(u"[群] {0}({1})"
+                            .format(name, UniqueIds.get_id(uin)))
+            elif kind == DISCU:
+                info.append(u"[讨论组] {0}({1})"
+                            .format(name, UniqueIds.get_id(uin)))
+        self.xmpp_client.send_control_msg("\n".join(info))
+
+    @register(r"-members (\d+)(?:\s+(.+))?", "-members id [term]")
+    def list_members(self, _id, term=None):
+        """ 查看 id 对应群的成员, 指定 term 时只列出匹配的成员
+        """
+        gcode, _type = UniqueIds.get(int(_id))
+        if _type != UniqueIds.T_GRP:
+            self.xmpp_client.send_control_msg(u"[S] {0} 不是群".format(_id))
+            return
+
+        directory = self.qq_client.directory
+        if term:
+            members = [(u"/".join(names), uin) for _, _, uin, names in
+                       self.qq_client.search.search(
+                           term, self.SEARCH_LIMIT, MEMBER, gcode)]
+        else:
+            members = sorted((directory.member_nick(gcode, uin) or u"", uin)
+                             for uin in directory.group_members(gcode))
+        if not members:
+            self.xmpp_client.send_control_msg(
+                u"[S] {0} 没有成员信息, 可以使用 -gr {1} 刷新".format(
+                    directory.group_name(gcode), _id))
+            return
+
+        info = [u"{0} 的成员({1})".format(directory.group_name(gcode),
+                                         len(members))]
+        for nick, uin in members:
+            info.append(u"({0}) {1}".format(UniqueIds.get_id(uin), nick))
         self.xmpp_client.send_control_msg("\n".join(info))
 
     @register(r'^#(\d+)(.*)', "#id content")
@@ -130,6 +419,35 @@ class Command(object):
         """
         self.qq_client.send_message_with_aid(_id, content)
 
+    @register(r"-history (\d+)(?:\s+(\d+))?", "-history id [n]")
+    def show_history(self, _id, n=None):
+        """ 查看 id 对应对象最近 n 条(默认10条, 最多 HISTORY_LIMIT 条)消息记录
+        """
+        history = self.xmpp_client.history
+        if history is None:
+            self.xmpp_client.send_control_msg(u"[S] 没有开启消息记录存储")
+            return
+
+        n = int(n) if n else 10
+        if not 0 < n <= self.HISTORY_LIMIT:
+            self.xmpp_client.send_control_msg(
+                u"[S] 条数需要在 1 到 {0} 之间".format(self.HISTORY_LIMIT))
+            return
+
+        records = history.last(int(_id), n)
+        if not records:
+            self.xmpp_client.send_control_msg(u"[S] {0} 没有消息记录"
+                                              .format(_id))
+            return
+
+        info = [u"{0} 的消息记录".format(_id)]
+        for ts, direction, content in records:
+            when = time.strftime("%m-%d %H:%M:%S", time.localtime(ts))
+            if direction == OUTBOUND:
+                content = u"[我] " + content
+            info.append(u"{0} {1}".format(when, content))
+        self.xmpp_client.send_control_msg("\n".join(info))
+
     @register(r"-qn (\d+)", "-qn id")
     def get_qq_account(self, _id):
         """ 获取QQ号码/群号码
@@ -155,13 +473,121 @@ class Command(object):
             msg = u"获取{0}的{1}失败".format(name, tys)
         self.xmpp_client.send_control_msg(msg)
 
+    def _rule_target(self, _id):
+        """ 获取规则对应的群/讨论组名称, 不是群或讨论组时返回 None
+        """
+        uin, _type = UniqueIds.get(_id)
+        directory = self.qq_client.directory
+        if _type == UniqueIds.T_GRP:
+            return u"[群] {0}({1})".format(directory.group_name(uin), _id)
+        elif _type == UniqueIds.T_DIS:
+            return u"[讨论组] {0}({1})".format(directory.discu_name(uin), _id)
+        return None
+
+    @register(r"-mute (\d+)", "-mute id")
+    def mute(self, _id):
+        """ 屏蔽 id 对应群/讨论组的全部消息
+        """
+        name = self._rule_target(int(_id))
+        if name is None:
+            self.xmpp_client.send_control_msg(u"[S] {0} 不是群或讨论组"
+                                              .format(_id))
+            return
+        self.qq_client.rules.mute(int(_id))
+        self.xmpp_client.send_control_msg(u"[S] 已屏蔽 {0}".format(name))
+
+    @register(r"-only-mentions (\d+)", "-only-mentions id")
+    def only_mentions(self, _id):
+        """ 只转发 id 对应群/讨论组中提到自己的消息
+        """
+        name = self._rule_target(int(_id))
+        if name is None:
+            self.xmpp_client.send_control_msg(u"[S] {0} 不是群或讨论组"
+                                              .format(_id))
+            return
+        self.qq_client.rules.mention_only(int(_id))
+        self.xmpp_client.send_control_msg(u"[S] {0} 只转发提到我的消息"
+                                          .format(name))
+
+    @register(r"-unmute (\d+)", "-unmute id")
+    def unmute(self, _id):
+        """ 恢复转发 id 对应群/讨论组的全部消息
+        """
+        if self.qq_client.rules.unmute(int(_id)):
+            self.xmpp_client.send_control_msg(u"[S] 恢复转发 {0}".format(
+                self._rule_target(int(_id)) or _id))
+        else:
+            self.xmpp_client.send_control_msg(u"[S] {0} 没有被屏蔽"
+                                              .format(_id))
+
+    @register(r"-block\s+(.+)", "-block keyword")
+    def block_keyword(self, keyword):
+        """ 屏蔽包含关键词的群/讨论组消息
+        """
+        self.qq_client.rules.block(keyword.strip())
+        self.xmpp_client.send_control_msg(u"[S] 已屏蔽关键词 {0}"
+                                          .format(keyword.strip()))
+
+    @register(r"-unblock\s+(.+)", "-unblock keyword")
+    def unblock_keyword(self, keyword):
+        """ 取消屏蔽关键词
+        """
+        if self.qq_client.rules.unblock(keyword.strip()):
+            self.xmpp_client.send_control_msg(u"[S] 已取消屏蔽关键词 {0}"
+                                              .format(keyword.strip()))
+        else:
+            self.xmpp_client.send_control_msg(u"[S] 没有屏蔽关键词 {0}"
+                                              .format(keyword.strip()))
+
+    @register(r'-rules')
+    def show_rules(self):
+        """ 查看消息过滤规则
+        """
+        rules = self.qq_client.rules
+        if not len(rules):
+            self.xmpp_client.send_control_msg(u"[S] 没有过滤规则")
+            return
+
+        info = [u"过滤规则: 已检查 {0} 条消息, 过滤 {1} 条".format(
+            rules.checked, sum(rules.dropped.values()))]
+        for _id in sorted(rules.muted):
+            info.append(u"屏蔽 {0}".format(self._rule_target(_id) or _id))
+        for _id in sorted(rules.only_mentions):
+            info.append(u"只看提到我的 {0}"
+                        .format(self._rule_target(_id) or _id))
+        if rules.keywords:
+            info.append(u"屏蔽关键词: {0}"
+                        .format(u", ".join(sorted(rules.keywords))))
+        self.xmpp_client.send_control_msg("\n".join(info))
+
+    @register(r'-sendq')
+    def show_send_queue(self):
+        """ 查看发送队列
+        """
+        scheduler = self.qq_client.scheduler
+        depth = scheduler.depth()
+        info = [u"发送队列: {0} 条待发送, 已发送 {1}, 重试 {2}, 失败 {3}"
+                .format(sum(depth.values()), scheduler.sent,
+                        scheduler.retried, scheduler.failed)]
+        for (kind, target), n in sorted(depth.items(), key=lambda x: -x[1]):
+            info.append(u"({0}) {1}: {2}".format(UniqueIds.get_id(target),
+                                                 kind, n))
+        self.xmpp_client.send_control_msg("\n".join(info))
+
+    @register(r'-stats')
+    def show_stats(self):
+        """ 查看运行指标
+        """
+        summary = self.xmpp_client.metrics.summary()
+        self.xmpp_client.send_control_msg(u"运行指标\n" + summary
+                                          if summary else u"[S] 暂无指标")
+
     @register(r'-restart')
     def restart_webqq(self):
         """ 重新登录WebQQ
         """
         self.xmpp_client.send_status(u"重新登陆...")
-        self.qq_client.hub.disconnect()
-        self.qq_client.hub.connect()
+        self.qq_client.resume("command")
 
     @register(r'-stop')
     def stop_webqq(self):
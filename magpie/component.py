@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/08 14:26:10
+#   Desc    :   XMPP 外部组件连接
+#
+""" 以外部组件(XEP-0114)方式连接 XMPP 服务器.
+
+组件直接连接服务器的组件端口, 使用共享密钥握手, 不需要登录普通账号, 也没有
+花名册, 服务器一般不会对组件限速. 组件域下的任意 JID 都可以作为发送人, 多个
+账号可以共享一个组件连接, 收到的节按接收人(账号的 JID 或单独会话模式下联系人
+的 JID, 找不到时按发送人, 即控制账号)路由到对应的账号.
+
+Prosody 的配置示例::
+
+    Component "qq.example.org"
+        component_secret = "secret"
+
+pyxmpp2 的节只支持 jabber:client 和 jabber:server 名字空间, 所以收到的节
+会先转换为 jabber:client, 发送时流的默认名字空间为 jabber:component:accept,
+序列化后的节不带名字空间声明.
+"""
+import socket
+import hashlib
+import logging
+
+from xml.sax.saxutils import quoteattr
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+from pyxmpp2.jid import JID
+from pyxmpp2.etree import ElementTree
+from pyxmpp2.constants import STREAM_NS, STREAM_QNP, STANZA_CLIENT_NS
+from pyxmpp2.constants import STANZA_CLIENT_QNP
+from pyxmpp2.exceptions import NoRouteError
+from pyxmpp2.xmppparser import XMLStreamHandler, StreamReader
+from pyxmpp2.xmppserializer import XMPPSerializer
+from pyxmpp2.stanzaprocessor import StanzaProcessor, stanza_factory
+
+from magpie.backoff import Backoff
+
+logger = logging.getLogger("magpie")
+
+COMPONENT_NS = "jabber:component:accept"
+COMPONENT_QNP = "{{{0}}}".format(COMPONENT_NS)
+
+
+def parse_address(address, default_port=5347):
+    """ 解析 host:port 格式的地址
+    """
+    host, _, port = address.rpartition(":")
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+
+def default_jid(name, domain):
+    """ 账号在组件域下的默认 JID, 单独会话模式下联系人的 JID 为
+    ``<id>@<domain>``, 所以纯数字的名称(如 QQ 号)前加上 qq
+    """
+    name = u"{0}".format(name)
+    if name.isdigit():
+        name = u"qq" + name
+    return u"{0}@{1}".format(name, domain)
+
+
+class ComponentStream(XMLStreamHandler):
+    """ 组件连接, 断开后自动重连
+
+        :param jid: 组件的域, 如 qq.example.org
+        :param secret: 共享密钥
+        :param host: 服务器地址
+        :param port: 服务器的组件端口
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    # 发送空白保持连接的间隔(秒)
+    KEEPALIVE = 60
+
+    def __init__(self, jid, secret, host="127.0.0.1", port=5347,
+                 io_loop=None):
+        self.jid = JID(jid)
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.io_loop = io_loop or IOLoop.instance()
+        self.authorized = False
+        self.backoff = Backoff(base=1, cap=120)
+        self._routes = {}       # 账号 JID => (MagpieClient, StanzaProcessor)
+        self._controls = {}     # 控制账号 => 账号 JID
+        self._stream = None
+        self._reader = None
+        self._serializer = None
+        self._stream_id = None
+        self._stopping = False
+        self._retry_timeout = None
+        self._keepalive_timeout = None
+
+    def attach(self, client, handlers):
+        """ 添加一个使用此连接的账号, 没有连接时开始连接
+
+        :param client: ~magpie.client.MagpieClient instance
+        :param handlers: 处理收到的节的 XMPPFeatureHandler 列表
+        """
+        key = client.jid.bare().as_unicode()
+        processor = StanzaProcessor()
+        processor.me = client.jid
+        processor.uplink = self
+        processor.setup_stanza_handlers(handlers, "post-auth")
+        self._routes[key] = (client, processor)
+        self._controls.setdefault(client.control_account, key)
+
+        if self.authorized:
+            client.handle_component_authorized()
+        elif self._stream is None and self._retry_timeout is None:
+            self.connect()
+
+    def detach(self, client):
+        """ 移除账号, 没有账号使用时断开连接
+        """
+        key = client.jid.bare().as_unicode()
+        self._routes.pop(key, None)
+        for control, value in list(self._controls.items()):
+            if value == key:
+                del self._controls[control]
+        if not self._routes:
+            self.close()
+
+    def connect(self):
+        self._stopping = False
+        self._retry_timeout = None
+        logger.info(u"连接 XMPP 组件端口 %s:%s", self.host, self.port)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._stream = IOStream(sock, io_loop=self.io_loop)
+        self._stream.set_close_callback(self._on_close)
+        self._stream.connect((self.host, self.port), self._on_connect)
+
+    def close(self):
+        """ 断开连接并不再重连
+        """
+        self._stopping = True
+        if self._retry_timeout is not None:
+            self.io_loop.remove_timeout(self._retry_timeout)
+            self._retry_timeout = None
+        stream = self._stream
+        if stream is not None:
+            if self._serializer is not None and not stream.closed():
+                self._write(self._serializer.emit_tail())
+            stream.set_close_callback(None)
+            stream.close()
+            self._on_close()
+
+    def _on_connect(self):
+        self._reader = StreamReader(self)
+        self._serializer = XMPPSerializer(STANZA_CLIENT_NS)
+        # 只用于初始化序列化器的状态, 流头需要使用组件的名字空间
+        self._serializer.emit_head(None, None)
+        self._write(u"<?xml version='1.0'?><stream:stream xmlns={0} "
+                    u"xmlns:stream={1} to={2}>"
+                    .format(quoteattr(COMPONENT_NS), quoteattr(STREAM_NS),
+                            quoteattr(self.jid.as_unicode())))
+        self._stream.read_until_close(lambda data: None, self._on_data)
+
+    def _on_data(self, data):
+        self._reader.feed(data)
+
+    def _on_close(self):
+        authorized = self.authorized
+        self.authorized = False
+        self._stream = self._reader = self._serializer = None
+        if self._keepalive_timeout is not None:
+            self.io_loop.remove_timeout(self._keepalive_timeout)
+            self._keepalive_timeout = None
+
+        if authorized:
+            for client, _ in list(self._routes.values()):
+                self._notify(client.handle_component_disconnected)
+
+        if self._stopping or not self._routes:
+            return
+        delay = self.backoff.delay()
+        logger.warn(u"XMPP 组件连接断开, %.1f 秒后重新连接", delay)
+        self._retry_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + delay, self.connect)
+
+    def _notify(self, callback):
+        try:
+            callback()
+        except:
+            logger.warn(u"处理组件连接事件出错", exc_info=True)
+
+    def _write(self, text):
+        self._stream.write(text.encode("utf-8"))
+
+    def _keepalive(self):
+        self._keepalive_timeout = None
+        if self._stream is None:
+            return
+        self._stream.write(b" ")
+        self._keepalive_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + self.KEEPALIVE, self._keepalive)
+
+    def stream_start(self, element):
+        self._stream_id = element.get("id")
+        if not self._stream_id:
+            logger.error(u"组件流头没有 id")
+            self._stream.close()
+            return
+        digest = hashlib.sha1((self._stream_id + self.secret)
+                              .encode("utf-8")).hexdigest()
+        self._write(u"<handshake>{0}</handshake>".format(digest))
+
+    def stream_element(self, element):
+        if element.tag == COMPONENT_QNP + "handshake":
+            self._on_authorized()
+            return
+
+        if element.tag == STREAM_QNP + "error":
+            logger.error(u"XMPP 组件流错误: %s",
+                         ElementTree.tostring(element))
+            self._stream.close()
+            return
+
+        if not self.authorized:
+            return
+
+        for child in element.iter():
+            if child.tag.startswith(COMPONENT_QNP):
+                child.tag = STANZA_CLIENT_QNP + child.tag[len(COMPONENT_QNP):]
+        self.route(stanza_factory(element, return_path=self))
+
+    def stream_end(self):
+        logger.info(u"XMPP 组件流结束")
+        if self._stream is not None:
+            self._stream.close()
+
+    def stream_parse_error(self, descr):
+        logger.error(u"XMPP 组件流解析错误: %s", descr)
+        if self._stream is not None:
+            self._stream.close()
+
+    def _on_authorized(self):
+        logger.info(u"XMPP 组件 %s 握手成功", self.jid)
+        self.authorized = True
+        self.backoff.reset()
+        self._keepalive_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + self.KEEPALIVE, self._keepalive)
+        for client, _ in list(self._routes.values()):
+            self._notify(client.handle_component_authorized)
+
+    def route(self, stanza):
+        """ 将收到的节交给对应账号处理
+        """
+        entry = None
+        if stanza.to_jid:
+            entry = self._routes.get(stanza.to_jid.bare().as_unicode())
+            if entry is None:
+                entry = self._contact_route(stanza.to_jid)
+        if entry is None and stanza.from_jid:
+            key = self._controls.get(stanza.from_jid.bare().as_unicode())
+            entry = self._routes.get(key)
+
+        if entry is None:
+            if stanza.element_name != "presence" and\
+                    stanza.stanza_type not in ("error", "result"):
+                self.send(stanza.make_error_response(u"item-not-found"))
+            return
+        entry[1].process_stanza(stanza)
+
+    def _contact_route(self, jid):
+        """ 查找单独会话模式下联系人 JID 所属的账号, 多个账号都有这个联系人
+        时优先使用从这个 JID 发送过消息的账号
+        """
+        owners = []
+        for entry in self._routes.values():
+            # 分进程模式下的 XMPP 进程没有 session
+            session = getattr(entry[0], "session", None)
+            if session is None or session.lookup(jid) is None:
+                continue
+            if session.issued(jid):
+                return entry
+            owners.append(entry)
+        return owners[0] if owners else None
+
+    def send(self, stanza):
+        if not self.authorized:
+            raise NoRouteError(u"XMPP 组件未连接")
+        self._write(self._serializer.emit_stanza(stanza.get_xml()))
+
+    def uplink_receive(self, stanza):
+        self.route(stanza)
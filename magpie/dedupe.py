@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/10 09:41:26
+#   Desc    :   过滤重复的 Poll 消息
+#
+""" WebQQ 有时会在相邻的两次 Poll (尤其是重新登录前后)中返回同一条消息,
+按消息类型, 发送人, msg_id 和 seq 过滤掉时间窗口内重复的消息.
+
+记录的消息数有上限, 超过上限或超过时间窗口的记录从最早的开始淘汰, 内存
+占用不随运行时间增长.
+"""
+import time
+import logging
+
+from collections import OrderedDict
+
+logger = logging.getLogger("magpie")
+
+
+def message_key(message):
+    """ 获取 Poll 消息的去重键, 没有 msg_id 的消息(如系统消息)返回 None
+    """
+    value = message.get("value")
+    if not isinstance(value, dict) or value.get("msg_id") is None:
+        return None
+    return (message.get("poll_type"), value.get("from_uin"),
+            value.get("msg_id"), value.get("seq"))
+
+
+class DedupeFilter(object):
+    """ 有界的去重过滤器
+
+        :param max_items: 最多记录的消息数
+        :param window: 时间窗口(秒), 超过窗口的消息不再认为是重复的
+    """
+
+    def __init__(self, max_items=10000, window=600):
+        self.max_items = max_items
+        self.window = window
+        self._seen = OrderedDict()      # 去重键 => 首次收到的时间
+        self.checked = 0
+        self.dropped = {}               # 消息类型 => 丢弃数
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key, now=None):
+        """ 记录一个键
+
+        :rtype: 时间窗口内已经记录过返回 True
+        """
+        now = time.time() if now is None else now
+        self._expire(now)
+        if key in self._seen:
+            return True
+
+        self._seen[key] = now
+        while len(self._seen) > self.max_items:
+            self._seen.popitem(last=False)
+        return False
+
+    def _expire(self, now):
+        deadline = now - self.window
+        while self._seen:
+            key = next(iter(self._seen))
+            if self._seen[key] > deadline:
+                break
+            del self._seen[key]
+
+    def filter(self, messages):
+        """ 过滤一次 Poll 返回的消息列表
+
+        :rtype: 去掉重复消息后的列表
+        """
+        now = time.time()
+        result = []
+        for message in messages:
+            key = message_key(message)
+            self.checked += 1
+            if key is not None and self.seen(key, now):
+                poll_type = message.get("poll_type")
+                self.dropped[poll_type] = self.dropped.get(poll_type, 0) + 1
+                logger.info(u"丢弃重复的消息: %r", key)
+                continue
+            result.append(message)
+        return result
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/27 16:08:44
+#   Desc    :   联系人目录
+#
+import logging
+
+logger = logging.getLogger("magpie")
+
+
+class ContactDirectory(object):
+    """ 包装 hub 的好友/群/讨论组信息, 维护处理消息时需要的反向索引, 在对应
+    的信息刷新后增量更新, 处理每条消息时的查找都是 O(1) 的.
+
+        :param hub: ~twqq.hub.RequestHub instance
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.version = 0           # 每次更新加一, 用于判断缓存是否失效
+        self._listeners = []
+
+        self._friend_names = {}    # uin => 显示名
+        self._group_names = {}     # gcode => 群名称
+        self._group_gids = {}      # gcode => gid
+        self._gid_gcodes = {}      # gid => gcode
+        self._member_groups = {}   # uin => set(gcode)
+        self._member_nicks = {}    # (gcode, uin) => 群名片或昵称
+        self._group_members = {}   # gcode => set(uin)
+        self._discu_names = {}     # did => 讨论组名称
+        self._discu_members = {}   # did => {uin: 昵称}
+
+    def add_listener(self, callback):
+        """ 添加更新监听函数, 函数接收两个参数, 更新的类型和对应的键:
+
+            ("friends", None), ("groups", None), ("group", gcode),
+            ("discus", None), ("discu", did)
+        """
+        self._listeners.append(callback)
+
+    def _changed(self, kind, key=None):
+        self.version += 1
+        for callback in self._listeners:
+            try:
+                callback(kind, key)
+            except:
+                logger.warn(u"目录更新监听函数出错", exc_info=True)
+
+    def update_friends(self):
+        """ 好友列表刷新后调用
+        """
+        friends = self.hub.get_friends()
+        if friends is None:
+            return
+        names = {}
+        for item in friends.info:
+            names[item.uin] = item.markname or item.nick
+        self._friend_names = names
+        self._changed("friends")
+
+    def update_groups(self):
+        """ 群列表刷新后调用
+        """
+        groups = self.hub.get_groups()
+        if groups is None:
+            return
+        names, gids, gcodes = {}, {}, {}
+        for group in groups:
+            names[group.code] = group.name
+            gids[group.code] = group.gid
+            gcodes[group.gid] = group.code
+        self._group_names, self._group_gids = names, gids
+        self._gid_gcodes = gcodes
+
+        for gcode in list(self._group_members.keys()):
+            if gcode not in names:
+                self._drop_members(gcode)
+
+        # 群对象被重新创建, 已获取的成员信息需要重新建立
+        for group in groups:
+            if group._uin_map:
+                self._index_members(group)
+        self._changed("groups")
+
+    def update_group(self, gcode):
+        """ 群成员信息刷新后调用
+        """
+        groups = self.hub.get_groups()
+        group = groups.find_group(gcode) if groups else None
+        if group is None:
+            return
+        self._group_names[gcode] = group.name
+        self._group_gids[gcode] = group.gid
+        self._gid_gcodes[group.gid] = gcode
+        self._index_members(group)
+        self._changed("group", gcode)
+
+    def _drop_members(self, gcode):
+        for uin in self._group_members.pop(gcode, ()):
+            self._member_nicks.pop((gcode, uin), None)
+            gcodes = self._member_groups.get(uin)
+            if gcodes is not None:
+                gcodes.discard(gcode)
+                if not gcodes:
+                    del self._member_groups[uin]
+
+    def _index_members(self, group):
+        gcode = group.code
+        self._drop_members(gcode)
+        members = set()
+        for uin, info in group._uin_map.items():
+            members.add(uin)
+            self._member_nicks[(gcode, uin)] = info.card or info.nick
+            self._member_groups.setdefault(uin, set()).add(gcode)
+        self._group_members[gcode] = members
+
+    def update_discus(self):
+        """ 讨论组列表刷新后调用
+        """
+        discu = self.hub.get_discu()
+        if discu is None:
+            return
+        self._discu_names = dict((item.did, item.name)
+                                 for item in discu.discus)
+        self._discu_members = dict((did, members) for did, members
+                                   in self._discu_members.items()
+                                   if did in self._discu_names)
+        self._changed("discus")
+
+    def update_discu(self, did):
+        """ 讨论组详细信息刷新后调用
+        """
+        discu = self.hub.get_discu()
+        item = discu._did_map.get(did) if discu else None
+        if item is None:
+            return
+        self._discu_names[did] = item.name
+        self._discu_members[did] = dict((uin, info.nick) for uin, info
+                                        in item._uin_map.items())
+        self._changed("discu", did)
+
+    def friend_name(self, uin):
+        name = self._friend_names.get(uin)
+        if name is None and self.hub.get_friends():
+            name = self.hub.get_friends().get_show_name(uin)
+        return name
+
+    def group_name(self, gcode):
+        name = self._group_names.get(gcode)
+        if name is None and self.hub.get_groups():
+            name = self.hub.get_groups().get_group_name(gcode)
+        return name
+
+    def group_gid(self, gcode):
+        return self._group_gids.get(gcode)
+
+    def gcode(self, gid):
+        gcode = self._gid_gcodes.get(gid)
+        if gcode is None and self.hub.get_groups():
+            gcode = self.hub.get_groups().get_gcode(gid)
+        return gcode
+
+    def member_nick(self, gcode, uin):
+        nick = self._member_nicks.get((gcode, uin))
+        if nick is None and self.hub.get_groups():
+            nick = self.hub.get_groups().get_member_nick(gcode, uin)
+        return nick
+
+    def member_groups(self, uin):
+        """ 获取群成员所在的群的 gcode
+        """
+        return self._member_groups.get(uin, ())
+
+    def group_members(self, gcode):
+        return self._group_members.get(gcode, ())
+
+    def discu_name(self, did):
+        name = self._discu_names.get(did)
+        if name is None and self.hub.get_discu():
+            name = self.hub.get_discu().get_name(did)
+        return name
+
+    def discu_member_name(self, did, uin):
+        name = self._discu_members.get(did, {}).get(uin)
+        if name is None and self.hub.get_discu():
+            name = self.hub.get_discu().get_mname(did, uin)
+        return name
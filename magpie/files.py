@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/29 09:56:31
+#   Desc    :   接收文件
+#
+""" 流式接收文件, 接收到的数据块交给写入线程写入磁盘并计算校验和, 内存占用
+与文件大小无关. 每个文件固定由一个写入线程处理, 保证写入顺序.
+
+接收数据使用自己的 curl WRITEFUNCTION, 写入线程的队列满时返回
+WRITEFUNC_PAUSE 暂停接收, 写入线程腾出空间后恢复, IOLoop 不会等待磁盘;
+超过大小限制或写入失败时返回 0 中止请求, 不再接收剩余的数据.
+"""
+import os
+import time
+import errno
+import hashlib
+import logging
+import threading
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+import pycurl
+
+from tornado.ioloop import IOLoop
+
+from twqq.requests import FileRequest
+
+logger = logging.getLogger("magpie")
+
+_CLOSE = object()
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return u"{0:.1f}{1}".format(size, unit)
+        size /= 1024.0
+    return u"{0:.1f}GB".format(size)
+
+
+class _Transfer(object):
+    """ 一个正在接收的文件
+    """
+
+    def __init__(self, name, path, worker, digest=None):
+        self.name = name
+        self.path = path
+        self.worker = worker
+        self.received = 0
+        self.reported = 0
+        self.start_time = time.time()
+        self.aborted = False
+        self.paused = False
+        self.done = False
+        self.curl = None
+        self.fp = None
+        self.checksum = hashlib.md5()
+        self.digest = digest
+
+
+class _Writer(threading.Thread):
+    """ 写入线程, 从有界队列中取出数据块写入文件
+
+        :param queue_size: 队列长度
+        :param io_loop: ~tornado.ioloop.IOLoop instance, 队列有空间时在
+                        IOLoop 中调用等待的函数
+    """
+
+    def __init__(self, queue_size, io_loop):
+        super(_Writer, self).__init__()
+        self.setDaemon(True)
+        self.queue = Queue(queue_size)
+        self.io_loop = io_loop
+        self._waiting = []      # 队列满时等待空间的函数
+        self._lock = threading.Lock()
+
+    def wait(self, callback):
+        """ 队列满时调用, 队列有空间后在 IOLoop 中调用 callback
+        """
+        with self._lock:
+            self._waiting.append(callback)
+        # 加入等待前队列可能已经被取空, 此时写入线程不会再唤醒
+        if not self.queue.full():
+            self._wake()
+
+    def _wake(self):
+        with self._lock:
+            waiting, self._waiting = self._waiting, []
+        for callback in waiting:
+            self.io_loop.add_callback(callback)
+
+    def run(self):
+        while True:
+            transfer, chunk, callback = self.queue.get()
+            if self._waiting:
+                self._wake()
+            try:
+                if chunk is _CLOSE:
+                    self._close(transfer)
+                else:
+                    self._write(transfer, chunk)
+            except Exception as e:
+                logger.error(u"写入文件 {0} 失败".format(transfer.path),
+                             exc_info=True)
+                transfer.aborted = e
+            if callback is not None:
+                callback()
+
+    def _write(self, transfer, chunk):
+        if transfer.aborted:
+            return
+        if transfer.fp is None:
+            transfer.fp = open(transfer.path, "wb")
+        transfer.fp.write(chunk)
+        transfer.checksum.update(chunk)
+        if transfer.digest is not None:
+            transfer.digest.update(chunk)
+
+    def _close(self, transfer):
+        if transfer.fp is not None:
+            transfer.fp.close()
+        elif not transfer.aborted:
+            open(transfer.path, "wb").close()
+
+        if transfer.aborted and os.path.exists(transfer.path):
+            os.remove(transfer.path)
+
+
+class FileReceiver(object):
+    """ 接收文件
+
+        :param hub: ~twqq.hub.RequestHub instance
+        :param notify: 给控制账号发送提示的函数
+        :param directory: 存放目录
+        :param max_size: 文件大小上限, 为 0 则不限制
+        :param workers: 写入线程数
+        :param queue_size: 每个写入线程的队列长度
+        :param progress_step: 每接收多少字节发送一次进度
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+        :param cache: ~magpie.cache.ContentCache instance, 设置时文件存放在
+                      缓存中(相同内容只保存一份)并发送下载链接, 忽略 directory
+    """
+
+    def __init__(self, hub, notify, directory="/tmp", max_size=0, workers=2,
+                 queue_size=64, progress_step=1024 * 1024, io_loop=None,
+                 cache=None):
+        self.hub = hub
+        self.cache = cache
+        self.notify = notify
+        self.directory = directory
+        self.max_size = max_size
+        self.progress_step = progress_step
+        self.io_loop = io_loop or IOLoop.instance()
+        self._writers = []
+        self._next = 0
+        self._queue_size = queue_size
+        self._workers = workers
+
+        if cache is None and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _get_writer(self):
+        if not self._writers:
+            for _ in range(self._workers):
+                writer = _Writer(self._queue_size, self.io_loop)
+                writer.start()
+                self._writers.append(writer)
+
+        writer = self._writers[self._next % len(self._writers)]
+        self._next += 1
+        return writer
+
+    def _make_path(self, name):
+        """ 生成存放路径并创建空文件占用, 避免同名的文件同时接收时互相覆盖,
+        文件已存在时在文件名后加上序号
+        """
+        name = os.path.basename(name) or "unnamed"
+        path = os.path.join(self.directory, name)
+        root, ext = os.path.splitext(path)
+        i = 1
+        while True:
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                 0o644))
+                return path
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            path = u"{0}({1}){2}".format(root, i, ext)
+            i += 1
+
+    def receive(self, guid, lcid, from_uin):
+        """ 开始接收文件
+
+        :param guid: 文件名
+        :param lcid: 会话id
+        :param from_uin: 发送人uin
+        """
+        request = FileRequest(guid, lcid, from_uin)
+        if self.cache is not None:
+            transfer = _Transfer(guid, self.cache.temp_path(),
+                                 self._get_writer(), hashlib.sha256())
+        else:
+            transfer = _Transfer(guid, self._make_path(guid),
+                                 self._get_writer())
+
+        def prepare(curl):
+            transfer.curl = curl
+            curl.setopt(pycurl.WRITEFUNCTION,
+                        lambda chunk: self._on_chunk(transfer, chunk))
+
+        self.hub.http.get(request.url, request.params,
+                          headers=request.headers,
+                          prepare_curl_callback=prepare,
+                          callback=lambda resp:
+                          self._on_done(transfer, resp))
+
+    def _on_chunk(self, transfer, chunk):
+        """ curl 的 WRITEFUNCTION, 在 IOLoop 中调用
+
+        :rtype: None 表示已经处理, 0 中止请求, WRITEFUNC_PAUSE 暂停接收,
+                恢复后 curl 会再次传入同一个数据块
+        """
+        if transfer.aborted:
+            return 0
+
+        if self.max_size and transfer.received + len(chunk) > self.max_size:
+            transfer.aborted = True
+            self.io_loop.add_callback(
+                self.notify, u"[S] 文件 {0} 超过大小限制 {1}, 停止接收"
+                .format(transfer.name, format_size(self.max_size)))
+            return 0
+
+        try:
+            transfer.worker.queue.put_nowait((transfer, chunk, None))
+        except Full:
+            transfer.paused = True
+            transfer.worker.wait(lambda: self._resume(transfer))
+            return pycurl.WRITEFUNC_PAUSE
+
+        transfer.received += len(chunk)
+        if transfer.received - transfer.reported >= self.progress_step:
+            transfer.reported = transfer.received
+            self.io_loop.add_callback(
+                self.notify, u"[S] 正在接收 {0}: {1}"
+                .format(transfer.name, format_size(transfer.received)))
+
+    def _resume(self, transfer):
+        # 请求已经结束(如超时)时 curl 可能已经被其他请求使用
+        if not transfer.paused or transfer.done:
+            return
+        transfer.paused = False
+        transfer.curl.pause(pycurl.PAUSE_CONT)
+
+    def _on_done(self, transfer, response):
+        transfer.done = True
+        transfer.curl = None
+        if response.error and not transfer.aborted:
+            transfer.aborted = True
+            self.notify(u"[S] 接收文件 {0} 失败: {1}"
+                        .format(transfer.name, response.error))
+        self._close(transfer)
+
+    def _close(self, transfer):
+        def callback():
+            self.io_loop.add_callback(lambda: self._finished(transfer))
+
+        try:
+            transfer.worker.queue.put_nowait((transfer, _CLOSE, callback))
+        except Full:
+            transfer.worker.wait(lambda: self._close(transfer))
+
+    def _finished(self, transfer):
+        if transfer.aborted:
+            if isinstance(transfer.aborted, Exception):
+                self.notify(u"[S] 保存文件 {0} 失败: {1}"
+                            .format(transfer.name, transfer.aborted))
+            return
+
+        location = transfer.path
+        if self.cache is not None:
+            try:
+                digest = self.cache.put_file(transfer.path, transfer.name,
+                                             transfer.digest.hexdigest())
+            except Exception as e:
+                logger.error(u"保存文件 {0} 到缓存失败".format(transfer.name),
+                             exc_info=True)
+                self.notify(u"[S] 保存文件 {0} 失败: {1}"
+                            .format(transfer.name, e))
+                return
+            location = self.cache.url(digest, transfer.name)
+
+        elapsed = max(time.time() - transfer.start_time, 0.001)
+        self.notify(u"[S] 文件已接收, 存放在: {0}\n大小: {1}, 用时: {2:.1f}秒, "
+                    u"速度: {3}/s\nMD5: {4}"
+                    .format(location, format_size(transfer.received),
+                            elapsed, format_size(transfer.received / elapsed),
+                            transfer.checksum.hexdigest()))
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/25 14:22:50
+#   Desc    :   消息记录存储
+#
+""" 消息记录以追加的方式写入分段的日志文件, 每个分段有对应的索引文件::
+
+    00000001.log    记录: 头部 <IdBI (id, 时间戳, 方向, 长度) + utf-8 内容
+    00000001.idx    索引: 每条 3 个 uint32 (id, 记录偏移, 时间戳秒数)
+
+启动时批量读取所有索引文件, 在内存中为每个 id 维护按时间顺序的偏移数组,
+读取记录时使用 mmap 映射日志文件. 写入在单独的线程中进行, 不阻塞主循环.
+"""
+import os
+import re
+import mmap
+import time
+import struct
+import bisect
+import logging
+import threading
+
+from array import array
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+logger = logging.getLogger("magpie")
+
+INBOUND = 0
+OUTBOUND = 1
+
+_HEADER = struct.Struct("<IdBI")
+_SEGMENT_RE = re.compile(r"^(\d{8})\.log$")
+_STOP = object()
+
+
+class _ContactIndex(object):
+    """ 单个 id 的索引, 按写入顺序保存分段号, 偏移和时间戳
+    """
+    __slots__ = ("segments", "offsets", "times")
+
+    def __init__(self):
+        self.segments = array("I")
+        self.offsets = array("I")
+        self.times = array("I")
+
+    def append(self, segment, offset, ts):
+        self.segments.append(segment)
+        self.offsets.append(offset)
+        self.times.append(ts)
+
+    def drop_before(self, segment):
+        """ 删除分段号小于 segment 的索引
+        """
+        n = bisect.bisect_left(self.segments, segment)
+        if n:
+            del self.segments[:n]
+            del self.offsets[:n]
+            del self.times[:n]
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+class HistoryStore(object):
+    """ 消息记录存储
+
+        :param path: 存储目录
+        :param segment_bytes: 单个分段的最大字节数, 超过则新建分段
+        :param max_segments: 最多保留的分段数
+        :param max_age: 分段最长保留时间(秒), 为 None 则不按时间淘汰
+        :param queue_size: 写入队列长度, 队列满时丢弃新的记录
+    """
+
+    def __init__(self, path, segment_bytes=16 * 1024 * 1024, max_segments=64,
+                 max_age=None, queue_size=10000):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.max_age = max_age
+
+        self._lock = threading.RLock()
+        self._queue = Queue(queue_size)
+        self._index = {}
+        self._segments = []     # 按顺序排列的分段号
+        self._mmaps = {}        # 分段号 => mmap
+        self._log = None
+        self._idx = None
+        self._thread = None
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._load()
+
+    def _segment_path(self, segment, ext):
+        return os.path.join(self.path, "{0:08d}.{1}".format(segment, ext))
+
+    def _load(self):
+        for name in sorted(os.listdir(self.path)):
+            sre = _SEGMENT_RE.match(name)
+            if sre:
+                self._segments.append(int(sre.group(1)))
+
+        for segment in self._segments:
+            path = self._segment_path(segment, "idx")
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                words = array("I")
+                size = os.path.getsize(path) // words.itemsize
+                words.fromfile(f, size - size % 3)
+            ids, offsets, times = words[0::3], words[1::3], words[2::3]
+            for i in range(len(ids)):
+                item = self._index.get(ids[i])
+                if item is None:
+                    item = self._index[ids[i]] = _ContactIndex()
+                item.append(segment, offsets[i], times[i])
+
+        if not self._segments:
+            self._segments.append(1)
+        self._open_segment(self._segments[-1])
+
+    def _open_segment(self, segment):
+        if self._log is not None:
+            self._log.close()
+            self._idx.close()
+        self._log = open(self._segment_path(segment, "log"), "ab")
+        self._idx = open(self._segment_path(segment, "idx"), "ab")
+        self._log.seek(0, os.SEEK_END)
+
+    def start(self):
+        """ 启动写入线程
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """ 写完队列中的记录后停止写入线程
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def append(self, _id, content, direction=INBOUND, ts=None):
+        """ 追加一条记录, 只放入写入队列, 不会阻塞
+
+        :param _id: UniqueIds 分配的 id
+        :param content: 消息内容
+        :param direction: INBOUND 或 OUTBOUND
+        """
+        if _id is None:
+            return
+        ts = time.time() if ts is None else ts
+        try:
+            self._queue.put_nowait((_id, ts, direction, content))
+        except Full:
+            logger.warn(u"消息记录队列已满, 丢弃记录")
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            with self._lock:
+                try:
+                    self._write(*item)
+                except:
+                    logger.error(u"写入消息记录失败", exc_info=True)
+
+                if self._queue.empty():
+                    self._log.flush()
+                    self._idx.flush()
+
+        with self._lock:
+            self._log.flush()
+            self._idx.flush()
+
+    def _write(self, _id, ts, direction, content):
+        body = content.encode("utf-8")
+        if self._log.tell() + _HEADER.size + len(body) > self.segment_bytes\
+                and self._log.tell():
+            self._rotate()
+
+        segment = self._segments[-1]
+        offset = self._log.tell()
+        self._log.write(_HEADER.pack(_id, ts, direction, len(body)))
+        self._log.write(body)
+        array("I", [_id, offset, int(ts)]).tofile(self._idx)
+
+        item = self._index.get(_id)
+        if item is None:
+            item = self._index[_id] = _ContactIndex()
+        item.append(segment, offset, int(ts))
+
+    def _rotate(self):
+        segment = self._segments[-1] + 1
+        self._segments.append(segment)
+        self._open_segment(segment)
+        self._expire()
+
+    def _expire(self):
+        """ 按数量和时间淘汰旧的分段
+        """
+        expired = []
+        with self._lock:
+            while len(self._segments) > self.max_segments:
+                expired.append(self._segments.pop(0))
+
+            if self.max_age is not None:
+                deadline = time.time() - self.max_age
+                while len(self._segments) > 1:
+                    path = self._segment_path(self._segments[0], "log")
+                    if os.path.getmtime(path) >= deadline:
+                        break
+                    expired.append(self._segments.pop(0))
+
+            if not expired:
+                return
+
+            first = self._segments[0]
+            for key in list(self._index.keys()):
+                item = self._index[key]
+                item.drop_before(first)
+                if not item:
+                    del self._index[key]
+
+            for segment in expired:
+                m = self._mmaps.pop(segment, None)
+                if m is not None:
+                    m.close()
+
+        for segment in expired:
+            for ext in ("log", "idx"):
+                try:
+                    os.remove(self._segment_path(segment, ext))
+                except OSError:
+                    pass
+
+    def _map(self, segment, end):
+        """ 获取分段的 mmap, end 为需要读取到的位置
+        """
+        m = self._mmaps.get(segment)
+        if m is not None and len(m) >= end:
+            return m
+
+        if m is not None:
+            m.close()
+        with open(self._segment_path(segment, "log"), "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps[segment] = m
+        return m
+
+    def last(self, _id, n=10):
+        """ 获取 id 最近的 n 条记录
+
+        :rtype: [(时间戳, 方向, 内容), ...] 按时间先后排列
+        """
+        result = []
+        if n <= 0:
+            # segments[-0:] 是全部记录
+            return result
+        with self._lock:
+            item = self._index.get(_id)
+            if not item:
+                return result
+            positions = list(zip(item.segments[-n:], item.offsets[-n:]))
+
+            # 写入线程可能还没有将缓冲区写入文件
+            if positions[-1][0] == self._segments[-1]:
+                self._log.flush()
+
+            for segment, offset in positions:
+                m = self._map(segment, offset + _HEADER.size)
+                _, ts, direction, length = _HEADER.unpack_from(m, offset)
+                start = offset + _HEADER.size
+                if len(m) < start + length:
+                    m = self._map(segment, start + length)
+                result.append((ts, direction,
+                               m[start:start + length].decode("utf-8")))
+        return result
+
+    def count(self, _id):
+        with self._lock:
+            item = self._index.get(_id)
+            return len(item) if item else 0
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/28 11:47:02
+#   Desc    :   持久化唯一ID
+#
+""" 将 ~twqq.objects.UniqueIds 分配的 id 保存到文件, 重启后 id 保持不变.
+
+文件由连续的 64 位整数组成, 第 n 个整数对应 id n, 值为 ``uin << 3 | type``,
+启动时一次读入, 分配新 id 时追加一个整数.
+"""
+import os
+import logging
+
+from array import array
+
+from tornado.ioloop import IOLoop
+
+from twqq.objects import UniqueIds
+
+logger = logging.getLogger("magpie")
+
+_TYPE_BITS = 3
+_TYPE_MASK = (1 << _TYPE_BITS) - 1
+try:
+    array("q")
+    _TYPECODE = "q"
+except ValueError:
+    _TYPECODE = "l"   # Python 2 没有 q, 64 位 Linux 下 long 为 8 字节
+
+
+class IdTable(object):
+    """ 使用数组保存 id 到 uin 和类型的对应关系
+
+        :param path: 文件路径
+        :param io_loop: ~tornado.ioloop.IOLoop instance, 用于合并写入
+    """
+
+    def __init__(self, path, io_loop=None):
+        self.path = path
+        self.io_loop = io_loop or IOLoop.instance()
+        self._uins = array(_TYPECODE)
+        self._types = array("b")
+        self._ids = {}          # uin => id
+        self._dirty = False
+        self._load()
+        self._file = open(path, "ab")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        values = array(_TYPECODE)
+        with open(self.path, "rb") as f:
+            size = os.path.getsize(self.path) // values.itemsize
+            values.fromfile(f, size)
+
+        # 写入中断时末尾可能有不完整的整数, 不截掉的话之后追加的整数都会错位
+        if os.path.getsize(self.path) != size * values.itemsize:
+            logger.warn(u"唯一ID文件 {0} 末尾不完整, 截断".format(self.path))
+            with open(self.path, "r+b") as f:
+                f.truncate(size * values.itemsize)
+
+        for _id, value in enumerate(values):
+            uin, _type = value >> _TYPE_BITS, value & _TYPE_MASK
+            self._uins.append(uin)
+            self._types.append(_type)
+            self._ids.setdefault(uin, _id)
+        logger.info(u"加载 {0} 个唯一ID".format(len(values)))
+
+    def install(self):
+        """ 替换 UniqueIds 的方法, 使其使用此表分配和查找 id
+        """
+        table = self
+        UniqueIds.alloc = classmethod(
+            lambda cls, uin, _type: table.alloc(uin, _type))
+        UniqueIds.get = classmethod(lambda cls, _id: table.get(_id))
+        UniqueIds.get_type = classmethod(lambda cls, uin: table.get_type(uin))
+        UniqueIds.get_id = classmethod(lambda cls, uin: table.get_id(uin))
+        UniqueIds._last_id = len(self._uins)
+
+    def alloc(self, uin, _type):
+        """ 分配一个 id, uin 已经分配过则返回已分配的 id
+        """
+        assert _type in [UniqueIds.T_FRI, UniqueIds.T_TMP, UniqueIds.T_GRP,
+                         UniqueIds.T_DIS]
+        _id = self._ids.get(uin)
+        if _id is not None:
+            return _id
+
+        _id = len(self._uins)
+        self._uins.append(uin)
+        self._types.append(_type)
+        self._ids[uin] = _id
+        UniqueIds._last_id = _id + 1
+
+        array(_TYPECODE, [uin << _TYPE_BITS | _type]).tofile(self._file)
+        if not self._dirty:
+            self._dirty = True
+            self.io_loop.add_callback(self.flush)
+        return _id
+
+    def flush(self):
+        self._dirty = False
+        self._file.flush()
+
+    def get(self, _id):
+        """ 根据 id 获取 uin 和对应的类型
+        """
+        if 0 <= _id < len(self._uins):
+            return self._uins[_id], self._types[_id]
+        return None, None
+
+    def get_type(self, uin):
+        _id = self._ids.get(uin)
+        return None if _id is None else self._types[_id]
+
+    def get_id(self, uin):
+        return self._ids.get(uin)
+
+    def __len__(self):
+        return len(self._uins)
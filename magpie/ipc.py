@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/09 10:12:48
+#   Desc    :   进程间通信
+#
+""" 基于 unix socket 的分帧通信.
+
+每帧由 5 字节的头和内容组成, 头为大端的 4 字节内容长度和 1 字节类型, 内容
+由使用方定义(如序列化后的 XMPP 节).
+"""
+import os
+import socket
+import struct
+import logging
+
+from functools import partial
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.netutil import bind_unix_socket, add_accept_handler
+
+logger = logging.getLogger("magpie")
+
+HEADER = struct.Struct(">IB")
+
+
+class Channel(object):
+    """ 分帧的双向通道
+
+        :param stream: ~tornado.iostream.IOStream instance
+        :param on_frame: 收到帧时调用, 接收类型和内容两个参数
+        :param on_close: 连接关闭时调用
+    """
+
+    # 单帧内容的最大字节数, 超过认为数据损坏并关闭连接
+    MAX_FRAME = 16 * 1024 * 1024
+
+    def __init__(self, stream, on_frame, on_close=None):
+        self.stream = stream
+        self.on_frame = on_frame
+        self.on_close = on_close
+        self.stream.set_close_callback(self._on_close)
+        self._read_header()
+
+    @property
+    def closed(self):
+        return self.stream.closed()
+
+    def _read_header(self):
+        if not self.stream.closed():
+            self.stream.read_bytes(HEADER.size, self._on_header)
+
+    def _on_header(self, data):
+        length, kind = HEADER.unpack(data)
+        if length > self.MAX_FRAME:
+            logger.error(u"IPC 帧过大(%d 字节), 关闭连接", length)
+            self.stream.close()
+            return
+        if length == 0:
+            self._on_body(kind, b"")
+        else:
+            self.stream.read_bytes(length, partial(self._on_body, kind))
+
+    def _on_body(self, kind, data):
+        try:
+            self.on_frame(kind, data)
+        except:
+            logger.warn(u"处理 IPC 帧出错", exc_info=True)
+        self._read_header()
+
+    def write(self, kind, data=b""):
+        if self.stream.closed():
+            return False
+        self.stream.write(HEADER.pack(len(data), kind) + data)
+        return True
+
+    def close(self):
+        self.stream.close()
+
+    def _on_close(self):
+        if self.on_close is not None:
+            self.on_close()
+
+
+def listen(path, on_stream, io_loop=None):
+    """ 监听 unix socket
+
+    :param on_stream: 有新连接时调用, 接收 ~tornado.iostream.IOStream
+    :rtype: 监听的 socket, 关闭时调用 close
+    """
+    io_loop = io_loop or IOLoop.instance()
+    sock = bind_unix_socket(path, mode=0o600)
+
+    def accept(connection, address):
+        on_stream(IOStream(connection, io_loop=io_loop))
+
+    add_accept_handler(sock, accept, io_loop=io_loop)
+    return sock
+
+
+def stop_listening(sock, path, io_loop=None):
+    io_loop = io_loop or IOLoop.instance()
+    io_loop.remove_handler(sock.fileno())
+    sock.close()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def connect(path, callback, io_loop=None):
+    """ 连接 unix socket, 连接成功后以 IOStream 调用 callback, 失败时
+    调用 IOStream 的关闭回调
+
+    :rtype: ~tornado.iostream.IOStream instance
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stream = IOStream(sock, io_loop=io_loop or IOLoop.instance())
+    stream.connect(path, lambda: callback(stream))
+    return stream
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/13 14:02:36
+#   Desc    :   列表命令的分页, 缓存和差异
+#
+""" ``-list``, ``-glist`` 和 ``-dlist`` 的输出按行生成后缓存, 以联系人目录的
+版本作为缓存的版本, 数据没有变化时直接分页取出, 不再重新排序和拼接.
+每页的行数有上限, 避免单个节过大被服务器拒绝.
+"""
+from collections import OrderedDict
+
+
+class Listing(object):
+    """ 生成好的列表
+
+        :param sections: [(小节标题, [行])], 标题为 None 的小节没有标题
+        :param entries: {键: 行}, 用于比较两次列表的差异
+    """
+
+    def __init__(self, sections, entries=None):
+        self.sections = sections
+        self.entries = entries or {}
+        self.count = sum(len(lines) for _, lines in sections)
+        self._lines = []        # (小节序号, 行)
+        for i, (_, lines) in enumerate(sections):
+            self._lines.extend((i, line) for line in lines)
+
+    def pages(self, size):
+        return max(1, (len(self._lines) + size - 1) // size)
+
+    def page(self, n, size):
+        """ 取出第 n 页(从 1 开始), 页内第一行不是小节的开始时重复小节标题
+
+        :rtype: [行]
+        """
+        rows = self._lines[(n - 1) * size:n * size]
+        result = []
+        current = None
+        for i, line in rows:
+            if i != current:
+                current = i
+                title = self.sections[i][0]
+                if title is not None:
+                    result.append(u"== {0} ==".format(title))
+            result.append(line)
+        return result
+
+
+class ListCache(object):
+    """ 按版本缓存的列表
+
+        :param max_items: 最多缓存的列表数, 超过时淘汰最久没有使用的
+    """
+
+    def __init__(self, max_items=16):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()     # 键 => (版本, Listing)
+
+    def get(self, key, version, build):
+        """ 获取列表, 版本变化后调用 build 重新生成
+
+        :param key: 列表的键, 如 ("friends", 分组)
+        :param version: 生成列表所用数据的版本
+        :param build: 生成 Listing 的函数
+        """
+        item = self._items.pop(key, None)
+        if item is not None and item[0] == version:
+            self.hits += 1
+        else:
+            self.misses += 1
+            item = (version, build())
+        self._items[key] = item
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        return item[1]
+
+    def clear(self):
+        self._items.clear()
+
+
+def diff(old, new):
+    """ 比较两次列表的条目
+
+    :param old: 上次的 {键: 行}
+    :param new: 这次的 {键: 行}
+    :rtype: (新增的行, 去掉的行, 变化后的行)
+    """
+    added = [line for key, line in new.items() if key not in old]
+    removed = [line for key, line in old.items() if key not in new]
+    changed = [line for key, line in new.items()
+               if key in old and old[key] != line]
+    return sorted(added), sorted(removed), sorted(changed)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/02 14:35:19
+#   Desc    :   运行指标统计
+#
+""" 计数器, 直方图和仪表, 可以输出为 Prometheus 文本格式
+"""
+import time
+import bisect
+import logging
+
+from functools import wraps
+
+logger = logging.getLogger("magpie")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return u"{{{0}}}".format(u",".join(
+        u'{0}="{1}"'.format(k, _escape(v)) for k, v in key))
+
+
+def _escape(value):
+    value = value if isinstance(value, type(u"")) else str(value)
+    return value.replace("\\", "\\\\").replace('"', '\\"')\
+        .replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ 计数器
+    """
+    kind = "counter"
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self._values = {}
+
+    def inc(self, n=1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + n
+
+    def get(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, key, value
+
+    def summary(self):
+        for key, value in sorted(self._values.items()):
+            yield _format_labels(key), u"{0}".format(value)
+
+
+class Gauge(object):
+    """ 仪表, 输出时调用函数获取当前值
+
+        :param func: 返回当前值的函数, 或者返回 {标签字典的元组: 值} 的字典
+        :param kind: 值只增不减时可以输出为 counter
+    """
+
+    def __init__(self, name, doc, func, kind="gauge"):
+        self.name = name
+        self.doc = doc
+        self.func = func
+        self.kind = kind
+
+    def _values(self):
+        try:
+            value = self.func()
+        except:
+            logger.warn(u"获取 {0} 失败".format(self.name), exc_info=True)
+            return {}
+        if isinstance(value, dict):
+            return value
+        return {(): value}
+
+    def samples(self):
+        for key, value in sorted(self._values().items()):
+            yield self.name, key, value
+
+    def summary(self):
+        for key, value in sorted(self._values().items()):
+            yield _format_labels(key), u"{0}".format(value)
+
+
+class Histogram(object):
+    """ 直方图, 用于统计耗时
+
+        :param buckets: 各个桶的上限, 升序排列
+    """
+    kind = "histogram"
+
+    def __init__(self, name, doc, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self._values = {}   # 标签 => [各个桶的计数, 总和, 总数]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        item = self._values.get(key)
+        if item is None:
+            item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        item[0][bisect.bisect_left(self.buckets, value)] += 1
+        item[1] += value
+        item[2] += 1
+
+    def time(self, **labels):
+        """ 返回统计函数耗时的装饰器
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.time() - start, **labels)
+            return wrapper
+        return decorator
+
+    def quantile(self, q, **labels):
+        """ 根据桶的计数估算分位数, 返回所在桶的上限
+        """
+        item = self._values.get(_label_key(labels))
+        return self._quantile(item, q) if item else None
+
+    def _quantile(self, item, q):
+        counts, _, total = item
+        rank = q * total
+        acc = 0
+        for i, count in enumerate(counts):
+            acc += count
+            if acc >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) \
+                    else float("inf")
+        return float("inf")
+
+    def samples(self):
+        for key, (counts, total_sum, count) in sorted(self._values.items()):
+            acc = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                yield (self.name + "_bucket", key + (("le", bound),), acc)
+            yield self.name + "_sum", key, total_sum
+            yield self.name + "_count", key, count
+
+    def summary(self):
+        for key, item in sorted(self._values.items()):
+            counts, total_sum, count = item
+            yield (_format_labels(key),
+                   u"count={0} avg={1:.3f}s p50<={2}s p99<={3}s".format(
+                       count, total_sum / count, self._quantile(item, 0.5),
+                       self._quantile(item, 0.99)))
+
+
+class Registry(object):
+    """ 指标注册表
+    """
+
+    def __init__(self, prefix="magpie_"):
+        self.prefix = prefix
+        self._metrics = []
+        self._names = {}
+
+    def _add(self, metric):
+        if metric.name in self._names:
+            return self._names[metric.name]
+        self._names[metric.name] = metric
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc):
+        return self._add(Counter(self.prefix + name, doc))
+
+    def gauge(self, name, doc, func, kind="gauge"):
+        return self._add(Gauge(self.prefix + name, doc, func, kind))
+
+    def histogram(self, name, doc, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self.prefix + name, doc, buckets))
+
+    def get(self, name):
+        return self._names.get(self.prefix + name)
+
+    def render(self):
+        """ 输出 Prometheus 文本格式
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(u"# HELP {0} {1}".format(metric.name, metric.doc))
+            lines.append(u"# TYPE {0} {1}".format(metric.name, metric.kind))
+            for name, key, value in metric.samples():
+                key = [(k, _format_value(v) if k == "le" else v)
+                       for k, v in key]
+                lines.append(u"{0}{1} {2}".format(name, _format_labels(key),
+                                                  _format_value(value)))
+        lines.append(u"")
+        return u"\n".join(lines)
+
+    def summary(self):
+        """ 输出便于阅读的摘要
+        """
+        lines = []
+        for metric in self._metrics:
+            items = list(metric.summary())
+            if not items:
+                continue
+            lines.append(u"== {0} ==".format(metric.doc))
+            for labels, text in items:
+                lines.append(u"{0} {1}".format(labels, text).strip())
+        return u"\n".join(lines)
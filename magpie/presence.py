@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/14 10:47:52
+#   Desc    :   好友在线状态
+#
+""" 增量维护在线好友的集合, 按分组建立索引.
+
+在线状态来自两处: 登录后 FriendStatusRequest 返回的全部在线好友, 以及 Poll
+返回的 buddies_status_change 消息. 查询在线好友只需要遍历在线的好友, 不再
+扫描整个好友列表; 刷新好友列表时 twqq 会重新创建好友对象, 此时把已知的
+状态写回新的对象.
+"""
+import logging
+
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger("magpie")
+
+OFFLINE = "offline"
+ONLINE_STATUS = frozenset(["online", "away", "busy", "silent", "callme"])
+
+STATUS_NAMES = {"online": u"在线", "away": u"离开", "busy": u"忙碌",
+                "silent": u"请勿打扰", "callme": u"Q我吧",
+                "hidden": u"隐身", OFFLINE: u"离线"}
+
+
+class PresenceTracker(object):
+    """ 在线好友集合
+
+    监听函数接收 uin, 原状态, 新状态和是否为登录后的首次加载四个参数
+    """
+
+    def __init__(self):
+        self.version = 0            # 在线状态变化时加一
+        self.loaded = False         # 是否已经获取过全部在线好友
+        self._online = {}           # uin => (状态, 客户端类型)
+        self._categories = {}       # uin => 分组
+        self._by_category = {}      # 分组 => set(uin)
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._online)
+
+    def __contains__(self, uin):
+        return uin in self._online
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def status(self, uin):
+        return self._online.get(uin, (OFFLINE, None))[0]
+
+    def online(self, category=None):
+        """ 获取在线好友的 uin
+
+        :param category: 分组, 为 None 则返回全部在线好友
+        """
+        if category is None:
+            return list(self._online)
+        return list(self._by_category.get(category, ()))
+
+    def categories(self):
+        """ 有在线好友的分组
+        """
+        return [category for category, uins in self._by_category.items()
+                if uins]
+
+    def update_friends(self, friends):
+        """ 好友列表刷新后调用, 重建 uin 和分组的对应关系, 去掉不再是好友的
+        uin, 并把已知的状态写回新的好友对象
+        """
+        self._categories = dict((item.uin, item.categories)
+                                for item in friends.info)
+        self._by_category = {}
+        for uin in list(self._online):
+            if uin not in self._categories:
+                del self._online[uin]
+                continue
+            status, client_type = self._online[uin]
+            friends.set_status(uin, status, client_type)
+            self._by_category.setdefault(self._categories[uin],
+                                         set()).add(uin)
+        self.version += 1
+
+    def set_status(self, uin, status, client_type=None, initial=False):
+        """ 更新一个好友的状态
+
+        :rtype: 状态有变化返回 True
+        """
+        old = self.status(uin)
+        if status not in ONLINE_STATUS:
+            if uin not in self._online:
+                return False
+            del self._online[uin]
+            self._by_category.get(self._categories.get(uin), set())\
+                .discard(uin)
+        else:
+            self._online[uin] = (status, client_type)
+            if old not in ONLINE_STATUS:
+                self._by_category.setdefault(self._categories.get(uin),
+                                             set()).add(uin)
+        if old == status:
+            return False
+
+        self.version += 1
+        for callback in self._listeners:
+            try:
+                callback(uin, old, status, initial)
+            except:
+                logger.warn(u"在线状态监听函数出错", exc_info=True)
+        return True
+
+    def replace(self, items):
+        """ 使用 FriendStatusRequest 返回的全部在线好友更新, 不在其中的好友
+        认为已经离线
+
+        :param items: [{"uin": .., "status": .., "client_type": ..}]
+        """
+        initial = not self.loaded
+        self.loaded = True
+        current = set()
+        for item in items:
+            uin = item.get("uin")
+            current.add(uin)
+            self.set_status(uin, item.get("status"), item.get("client_type"),
+                            initial)
+        for uin in [uin for uin in self._online if uin not in current]:
+            self.set_status(uin, OFFLINE, initial=initial)
+
+
+class PresenceNotifier(object):
+    """ 合并一段时间内的好友状态变化, 一次发给控制账号, 期间状态变化后又
+    恢复的好友不提示
+
+        :param send: 发送提示的函数
+        :param name: 获取好友显示名的函数
+        :param interval: 合并的时间窗口(秒)
+        :param max_names: 单条提示中最多列出的好友数
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    def __init__(self, send, name, interval=30, max_names=30, io_loop=None):
+        self.send = send
+        self.name = name
+        self.interval = interval
+        self.max_names = max_names
+        self.io_loop = io_loop or IOLoop.instance()
+        self._pending = {}      # uin => 窗口开始时的状态
+        self._current = {}      # uin => 最新状态
+        self._timeout = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __call__(self, uin, old, status, initial=False):
+        # 登录后首次加载时所有好友都会"上线", 不提示
+        if initial:
+            return
+        self._pending.setdefault(uin, old)
+        self._current[uin] = status
+        if self._timeout is None:
+            self._timeout = self.io_loop.add_timeout(
+                self.io_loop.time() + self.interval, self.flush)
+
+    def flush(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        pending, self._pending = self._pending, {}
+        current, self._current = self._current, {}
+
+        lines = []
+        for uin, old in pending.items():
+            status = current[uin]
+            if status == old or (status not in ONLINE_STATUS and
+                                 old not in ONLINE_STATUS):
+                continue
+            if status not in ONLINE_STATUS:
+                action = u"下线"
+            elif old not in ONLINE_STATUS:
+                action = u"上线"
+            else:
+                action = STATUS_NAMES.get(status, status)
+            lines.append(u"{0} {1}".format(self.name(uin) or uin, action))
+        if not lines:
+            return
+
+        lines.sort()
+        more = len(lines) - self.max_names
+        text = u", ".join(lines[:self.max_names])
+        if more > 0:
+            text += u" 等 {0} 人".format(len(lines))
+        self.send(u"[S] 好友状态: {0}".format(text))
+
+    def clear(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._pending = {}
+        self._current = {}
@@ -6,79 +6,155 @@
 #   Date    :   14/04/17 15:28:50
 #   Desc    :   实现一个输入队列
 #
-from collections import deque
+import re
+
+from collections import OrderedDict
+
+from tornado.ioloop import IOLoop
+
+ANSWER_RE = re.compile(r"^!(\d+)(?:\s+(.*))?$", re.S)
+
+
+class _Prompt(object):
+    __slots__ = ("token", "tip", "callback", "default", "timeout")
+
+    def __init__(self, token, tip, callback, default):
+        self.token = token
+        self.tip = tip
+        self.callback = callback
+        self.default = default
+        self.timeout = None
 
 
 class InputQueue(object):
     """ 一个获取输入队列, 用于管理用户的输入, 按以下方式工作:
 
-    压入一个问题, 等待输入, 如输入正确则将此问题弹出, 处理下一个问题.
-
-    压入问题, 则调用方法给控制账号发送一个问题, 并传入一个函数用于判断,
-    输入, xmpp 账号获得消息时, 应首先判断是否有在等待输入, 如在等待,
-    则将获得的消息传递给此队列, 然后由相应的函数处理.
+    压入一个问题时分配一个编号, 给控制账号发送问题, 控制账号通过 ``!编号 内容``
+    回答, 多个问题可以同时等待并且不按顺序回答, 等待期间不影响命令的处理.
+    只有一个问题在等待时也可以直接回复内容.
 
     处理函数返回一个包含两个元素的列表, 第一个元素是结果, 第二个元素是消息
 
-    结果为True, 则弹出此问题, 继续处理下一个问题(如果有的话),
+    结果为True, 则弹出此问题, 如果结果为 False, 则给控制账号发送消息, 继续
+    等待此问题的输入.
 
-    如果结果为 False, 则给控制账号发送消息, 继续处理此输入.
+    每个问题都有超时时间, 超时后使用默认值调用处理函数, 没有默认值则直接放弃.
 
         :param send_cb: 发送xmpp消息的callback
+        :param timeout: 默认的超时时间(秒)
+        :param io_loop: ~tornado.ioloop.IOLoop instance
     """
 
-    def __init__(self, send_cb):
-        self._queue = deque()
+    def __init__(self, send_cb, timeout=300, io_loop=None):
         self._send_cb = send_cb
-        self.current_cb = None
-        self.current_tip = None
-        self.need_input = False
+        self.timeout = timeout
+        self.io_loop = io_loop or IOLoop.instance()
+        self._prompts = OrderedDict()   # 编号 => _Prompt
+        self._next = 1
 
-    def append(self, tip, callback):
-        """ 将要求输入的压入队列
+    def __len__(self):
+        return len(self._prompts)
+
+    @property
+    def need_input(self):
+        return bool(self._prompts)
+
+    def append(self, tip, callback, default=None, timeout=None):
+        """ 添加一个问题
 
         :param tip: 提示信息
         :param callback: 接收输入的函数, 函数应返回一个元组, 元组第一个元素标识
                     是否成功, 第二个元素是提示信息.
+        :param default: 超时后传给 callback 的默认值, 为 None 则超时后放弃
+        :param timeout: 超时时间(秒), 默认使用 self.timeout
+        :rtype: 问题的编号
         """
-        if self.is_idle():
-            self.current_tip, self.current_cb = tip, callback
-            self.need_input = True
-            self.send_tip()
+        token = self._next
+        self._next += 1
+        prompt = _Prompt(token, tip, callback, default)
+        timeout = self.timeout if timeout is None else timeout
+        prompt.timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + timeout, lambda: self._expire(token))
+        self._prompts[token] = prompt
+
+        if default is None:
+            action = u"将放弃"
         else:
-            self._queue.append((tip, callback))
+            action = u"默认为 {0}".format(default)
+        self._send_cb(u"{0}\n回复 !{1} 内容, {2} 秒内未回复{3}"
+                      .format(tip, token, int(timeout), action))
+        return token
 
     def send_tip(self):
-        if self.current_tip is not None:
-            self._send_cb(self.current_tip)
+        """ 重新发送所有等待回答的问题
+        """
+        for prompt in self._prompts.values():
+            self._send_cb(u"[!{0}] {1}".format(prompt.token, prompt.tip))
 
     def input(self, content):
-        r = self.current_cb(content)
-
-        if r is None:
-            r, msg = True, ""
+        """ 处理控制账号的输入
 
-        if msg.strip():
-            self._send_cb(msg)
-        if r:
-            if self.is_empty:
-                self.need_input = False
-                self.current_cb, self.current_tip = None, None
-            else:
-                self.consum()
-
-    def consum(self):
-        """ 消费一个输入
+        :rtype: 输入是对问题的回答返回 True
         """
-        self.current_tip, self.current_cb = self._queue.popleft()
-        self.send_tip()
+        match = ANSWER_RE.match(content.strip())
+        if match is None:
+            return False
+
+        token = int(match.group(1))
+        if token not in self._prompts:
+            self._send_cb(u"[S] 问题 !{0} 不存在或已超时".format(token))
+            return True
+        self.answer(token, match.group(2) or u"")
+        return True
 
-    def is_empty(self):
-        return not bool(self._queue)
+    def answer_only(self, content):
+        """ 只有一个问题等待时将输入作为它的回答
 
-    def is_idle(self):
-        """ 是否是空闲时间
+        :rtype: 作为回答处理返回 True
         """
-        if not self._queue and self.current_cb is None:
-            return True
-        return False
+        if len(self._prompts) != 1:
+            return False
+        token = next(iter(self._prompts))
+        self.answer(token, content)
+        return True
+
+    def answer(self, token, content):
+        prompt = self._prompts[token]
+        if self._call(prompt, content):
+            self._remove(token)
+
+    def _call(self, prompt, content):
+        r = prompt.callback(content)
+
+        if r is None:
+            r, msg = True, ""
+        else:
+            r, msg = r
+
+        if msg and msg.strip():
+            self._send_cb(msg)
+        return r
+
+    def _remove(self, token):
+        prompt = self._prompts.pop(token, None)
+        if prompt is not None and prompt.timeout is not None:
+            self.io_loop.remove_timeout(prompt.timeout)
+        return prompt
+
+    def _expire(self, token):
+        prompt = self._prompts.pop(token, None)
+        if prompt is None:
+            return
+
+        prompt.timeout = None
+        if prompt.default is None:
+            self._send_cb(u"[S] 问题 !{0} 超时未回复, 已放弃".format(token))
+            return
+
+        self._send_cb(u"[S] 问题 !{0} 超时未回复, 使用默认值 {1}"
+                      .format(token, prompt.default))
+        self._call(prompt, prompt.default)
+
+    def clear(self):
+        for token in list(self._prompts):
+            self._remove(token)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/04 09:47:12
+#   Desc    :   消息渲染
+#
+""" 将 QQ 消息渲染为转发到 XMPP 的文本.
+
+每种消息使用一个模板, 模板为 ``str.format`` 格式, 加载时预先解析出用到的
+字段, 渲染时只计算模板中用到的字段. 模板可以通过 JSON 文件配置::
+
+    {"group": "[{group}] {nick}: {content}",
+     "buddy": "{name}: {content}"}
+
+各类消息可用的字段见 FIELDS.
+"""
+import re
+import json
+import time
+import logging
+
+from string import Formatter
+
+from twqq.objects import UniqueIds
+
+from pyxmpp2.etree import ElementTree
+from pyxmpp2.stanzapayload import XMLPayload
+
+logger = logging.getLogger("magpie")
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str, )
+
+GROUP = "group"
+BUDDY = "buddy"
+SESS = "sess"
+DISCU = "discu"
+
+DEFAULT_TEMPLATES = {
+    GROUP: u"[Q][{group}({gid})][{nick}({uid})] {content}",
+    BUDDY: u"[F][{name}({uid})] {content}",
+    SESS: u"[T][{nick}({uid}) 来自 {group}({gid})] {content}",
+    DISCU: u"[D][{name}({did})][{nick}({uid})] {content}",
+}
+
+FIELDS = {
+    GROUP: set(["group", "gid", "nick", "uid", "uin", "content", "time"]),
+    BUDDY: set(["name", "uid", "uin", "content", "time"]),
+    SESS: set(["group", "gid", "nick", "uid", "uin", "content", "time"]),
+    DISCU: set(["name", "did", "nick", "uid", "uin", "content", "time"]),
+}
+
+# WebQQ 表情编号 => 名称, 文本模式下显示为 /名称
+FACES = {
+    0: u"惊讶", 1: u"撇嘴", 2: u"色", 3: u"发呆", 4: u"得意", 5: u"流泪",
+    6: u"害羞", 7: u"闭嘴", 8: u"睡", 9: u"大哭", 10: u"尴尬", 11: u"发怒",
+    12: u"调皮", 13: u"呲牙", 14: u"微笑", 15: u"难过", 16: u"酷",
+    18: u"抓狂", 19: u"吐", 20: u"偷笑", 21: u"可爱", 22: u"白眼",
+    23: u"傲慢", 24: u"饥饿", 25: u"困", 26: u"惊恐", 27: u"流汗",
+    28: u"憨笑", 29: u"大兵", 30: u"奋斗", 31: u"咒骂", 32: u"疑问",
+    33: u"嘘", 34: u"晕", 35: u"折磨", 36: u"衰", 37: u"骷髅", 38: u"敲打",
+    39: u"再见", 46: u"猪头", 49: u"拥抱", 53: u"蛋糕", 54: u"闪电",
+    55: u"炸弹", 56: u"刀", 57: u"足球", 59: u"便便", 60: u"咖啡",
+    61: u"饭", 63: u"玫瑰", 64: u"凋谢", 66: u"爱心", 67: u"心碎",
+    69: u"礼物", 74: u"太阳", 75: u"月亮", 76: u"强", 77: u"弱",
+    78: u"握手", 79: u"胜利", 89: u"西瓜", 96: u"冷汗", 97: u"擦汗",
+    98: u"抠鼻", 99: u"鼓掌", 100: u"糗大了", 101: u"坏笑", 102: u"左哼哼",
+    103: u"右哼哼", 104: u"哈欠", 105: u"鄙视", 106: u"委屈",
+    107: u"快哭了", 108: u"阴险", 109: u"亲亲", 110: u"吓", 111: u"可怜",
+    112: u"菜刀", 113: u"啤酒", 114: u"篮球", 115: u"乒乓", 116: u"示爱",
+    117: u"瓢虫", 118: u"抱拳", 119: u"勾引", 120: u"拳头", 121: u"差劲",
+    122: u"爱你", 123: u"NO", 124: u"OK",
+}
+
+# 有对应 emoji 的表情, emoji 模式下其他表情仍然显示为文本
+EMOJI = {
+    0: u"\U0001f632", 1: u"\U0001f615", 2: u"\U0001f60d", 3: u"\U0001f633",
+    4: u"\U0001f60e", 5: u"\U0001f622", 6: u"\U0001f60a", 7: u"\U0001f910",
+    8: u"\U0001f634", 9: u"\U0001f62d", 10: u"\U0001f605", 11: u"\U0001f621",
+    12: u"\U0001f61c", 13: u"\U0001f601", 14: u"\U0001f642",
+    15: u"\U0001f641", 16: u"\U0001f60e", 19: u"\U0001f92e",
+    20: u"\U0001f92d", 25: u"\U0001f62a", 26: u"\U0001f631",
+    27: u"\U0001f613", 34: u"\U0001f635", 37: u"\U0001f480",
+    39: u"\U0001f44b", 46: u"\U0001f437", 49: u"\U0001f917",
+    53: u"\U0001f382", 54: u"⚡", 55: u"\U0001f4a3", 56: u"\U0001f52a",
+    57: u"⚽", 59: u"\U0001f4a9", 60: u"☕", 61: u"\U0001f35a",
+    63: u"\U0001f339", 64: u"\U0001f940", 66: u"❤", 67: u"\U0001f494",
+    69: u"\U0001f381", 74: u"☀", 75: u"\U0001f319", 76: u"\U0001f44d",
+    77: u"\U0001f44e", 78: u"\U0001f91d", 79: u"✌", 89: u"\U0001f349",
+    99: u"\U0001f44f", 109: u"\U0001f618", 112: u"\U0001f52a",
+    113: u"\U0001f37a", 114: u"\U0001f3c0", 120: u"✊",
+    124: u"\U0001f44c",
+}
+
+_TIPS = (u"【提示：此用户正在使用Q+ Web：http://web.qq.com/】",
+         u"【提示：此用户正在使用Q+ Web：http://web3.qq.com/】")
+
+_PREFIX_RE = re.compile(r"^((?:\[[^\]]*\])+)(.*)$")
+
+XHTML_IM_NS = "http://jabber.org/protocol/xhtml-im"
+XHTML_NS = "http://www.w3.org/1999/xhtml"
+
+
+def build_faces(style="text"):
+    """ 生成表情编号到显示内容的映射
+
+    :param style: text 显示为 /名称, emoji 有对应 emoji 时显示 emoji
+    """
+    faces = dict((code, u"/" + name) for code, name in FACES.items())
+    if style == "emoji":
+        faces.update(EMOJI)
+    return faces
+
+
+class Template(object):
+    """ 预先解析的消息模板
+
+        :param kind: 消息类型
+        :param text: 模板文本
+    """
+
+    def __init__(self, kind, text):
+        self.kind = kind
+        self.text = text
+        self.fields = set()
+        for _, name, _, _ in Formatter().parse(text):
+            if name is None:
+                continue
+            # 渲染时只传入关键字参数, {} 和 {0} 要到渲染时才会出错
+            if not name or re.split(r"[.\[]", name)[0].isdigit():
+                raise ValueError(u"{0} 模板中的字段需要使用名称: {{{1}}}"
+                                 .format(kind, name))
+            self.fields.add(name)
+        unknown = self.fields - FIELDS[kind]
+        if unknown:
+            raise ValueError(u"{0} 模板中有未知的字段: {1}"
+                             .format(kind, u", ".join(sorted(unknown))))
+        self._format = text.format
+
+    def __call__(self, values):
+        return self._format(**values)
+
+
+class Renderer(object):
+    """ 消息渲染器
+
+        :param hub: ~twqq.hub.RequestHub instance, 用于获取图片
+        :param directory: ~magpie.directory.ContactDirectory instance
+        :param templates: {消息类型: 模板文本}, 没有的类型使用默认模板
+        :param face_style: 表情显示方式, text 或 emoji
+        :param images: ~magpie.cache.ImageFetcher instance, 设置时图片下载到
+                       缓存并显示为本地链接, 否则由 twqq 下载并上传到图床
+    """
+
+    def __init__(self, hub, directory, templates=None, face_style="text",
+                 images=None):
+        self.hub = hub
+        self.directory = directory
+        self.images = images
+        self.faces = build_faces(face_style)
+        self.templates = {}
+        for kind, text in DEFAULT_TEMPLATES.items():
+            if templates and templates.get(kind):
+                text = templates[kind]
+            self.templates[kind] = Template(kind, text)
+
+    @classmethod
+    def load_templates(cls, path):
+        """ 从 JSON 文件加载模板
+        """
+        with open(path) as f:
+            templates = json.load(f)
+        unknown = set(templates) - set(DEFAULT_TEMPLATES)
+        if unknown:
+            raise ValueError(u"未知的消息类型: {0}"
+                             .format(u", ".join(sorted(unknown))))
+        return templates
+
+    def contents(self, from_uin, contents, eid=None, _type=0):
+        """ 将消息内容渲染为文本, 用于替换
+        ~twqq.hub.RequestHub.handle_qq_msg_contents
+
+        :param from_uin: 消息发送人uin
+        :param contents: 内容
+        :param eid: 扩展id(群gid, 讨论组did)
+        """
+        parts = []
+        for row in contents:
+            if isinstance(row, string_types):
+                parts.append(row)
+                continue
+
+            if not isinstance(row, list) or len(row) != 2:
+                continue
+
+            kind, info = row
+            if kind == "face":
+                parts.append(self.faces.get(info, u"/表情"))
+            elif kind == "offpic":
+                getter = self.hub.get_msg_img
+                if self.images is not None:
+                    getter = self.images.offpic
+                parts.append(getter(from_uin, info.get("file_path")))
+            elif kind == "cface":
+                getter = self.hub.get_group_img
+                if self.images is not None:
+                    getter = self.images.cface
+                parts.append(getter(
+                    eid, from_uin, info.get("file_id"), info.get("server"),
+                    info.get("name"), info.get("key"), _type))
+
+        content = u"".join(parts)
+        if u"【提示" in content:
+            for tip in _TIPS:
+                content = content.replace(tip, u"")
+        if u"\r" in content:
+            content = content.replace(u"\r", u"\n")
+        if u"\n\n" in content:
+            content = content.replace(u"\n\n", u"\n")
+        return content
+
+    def group(self, gcode, uin, nick, content):
+        template = self.templates[GROUP]
+        fields = template.fields
+        values = {"nick": nick, "uin": uin, "content": content}
+        if "group" in fields:
+            values["group"] = self.directory.group_name(gcode)
+        if "gid" in fields:
+            values["gid"] = UniqueIds.get_id(gcode)
+        return self._render(template, uin, values)
+
+    def buddy(self, uin, content):
+        template = self.templates[BUDDY]
+        values = {"uin": uin, "content": content}
+        if "name" in template.fields:
+            values["name"] = self.directory.friend_name(uin)
+        return self._render(template, uin, values)
+
+    def sess(self, gcode, uin, content):
+        template = self.templates[SESS]
+        fields = template.fields
+        values = {"uin": uin, "content": content}
+        if "nick" in fields:
+            values["nick"] = self.directory.member_nick(gcode, uin)
+        if "group" in fields:
+            values["group"] = self.directory.group_name(gcode)
+        if "gid" in fields:
+            values["gid"] = UniqueIds.get_id(gcode)
+        return self._render(template, uin, values)
+
+    def discu(self, did, uin, nick, content):
+        template = self.templates[DISCU]
+        fields = template.fields
+        values = {"nick": nick, "uin": uin, "content": content}
+        if "name" in fields:
+            values["name"] = self.directory.discu_name(did)
+        if "did" in fields:
+            values["did"] = UniqueIds.get_id(did)
+        return self._render(template, uin, values)
+
+    def _render(self, template, uin, values):
+        if "uid" in template.fields:
+            values["uid"] = UniqueIds.get_id(uin)
+        if "time" in template.fields:
+            values["time"] = time.strftime("%H:%M:%S")
+        return template(values)
+
+
+def xhtml_payload(msg):
+    """ 生成 XHTML-IM(XEP-0071) 格式的消息, 每行前面的 [..] 前缀显示为灰色
+
+    :rtype: ~pyxmpp2.stanzapayload.XMLPayload
+    """
+    html = ElementTree.Element(u"{{{0}}}html".format(XHTML_IM_NS))
+    body = ElementTree.SubElement(html, u"{{{0}}}body".format(XHTML_NS))
+    last = None
+    for i, line in enumerate(msg.split(u"\n")):
+        if i:
+            last = ElementTree.SubElement(body, u"{{{0}}}br".format(XHTML_NS))
+        match = _PREFIX_RE.match(line)
+        if match:
+            span = ElementTree.SubElement(body,
+                                          u"{{{0}}}span".format(XHTML_NS))
+            span.set("style", "color: gray")
+            span.text = match.group(1)
+            span.tail = match.group(2)
+            last = span
+        elif last is None:
+            body.text = (body.text or u"") + line
+        else:
+            last.tail = (last.tail or u"") + line
+    return XMLPayload(html)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/05 10:36:58
+#   Desc    :   保存和恢复 WebQQ 会话
+#
+""" 登录成功后将 ptwebqq, vfwebqq, psessionid, clientid 和 Cookie 保存到文件,
+启动或者掉线时使用保存的会话直接发送 Login2Request, 不需要重新走验证码检查
+和密码登录的流程.
+"""
+import os
+import json
+import time
+import logging
+
+import pycurl
+
+logger = logging.getLogger("magpie")
+
+FIELDS = ("ptwebqq", "vfwebqq", "psessionid", "clientid")
+
+
+def get_cookies(http):
+    """ 获取 Netscape 格式的 Cookie 列表
+
+    :param http: ~tornadohttpclient.TornadoHTTPClient instance
+    """
+    lines = []
+    for curl in http._curls:
+        for line in curl.getinfo(pycurl.INFO_COOKIELIST):
+            if line not in lines:
+                lines.append(line)
+    return lines
+
+
+def set_cookies(http, lines):
+    """ 将 Netscape 格式的 Cookie 写入共享的 Cookie 存储
+    """
+    curl = pycurl.Curl()
+    try:
+        curl.setopt(pycurl.SHARE, http._share)
+        for line in lines:
+            if not isinstance(line, str):
+                line = line.encode("utf-8")
+            curl.setopt(pycurl.COOKIELIST, line)
+    finally:
+        curl.close()
+
+
+class SessionStore(object):
+    """ 会话文件
+
+        :param path: 文件路径
+        :param max_age: 会话最长有效时间(秒), 超过后不再尝试恢复
+    """
+
+    def __init__(self, path, max_age=2 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+
+    def save(self, hub):
+        """ 保存 hub 的当前会话
+        """
+        data = dict((field, getattr(hub, field)) for field in FIELDS)
+        data["qq"] = hub.qid
+        data["time"] = time.time()
+        try:
+            data["cookies"] = get_cookies(hub.http)
+        except:
+            logger.warn(u"获取 Cookie 失败", exc_info=True)
+            data["cookies"] = []
+
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp, self.path)
+
+    def load(self, hub):
+        """ 将保存的会话恢复到 hub
+
+        :rtype: 有可用的会话返回 True
+        """
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            logger.warn(u"读取会话文件 {0} 失败".format(self.path),
+                        exc_info=True)
+            return False
+
+        if str(data.get("qq")) != str(hub.qid):
+            return False
+        if time.time() - data.get("time", 0) > self.max_age:
+            logger.info(u"保存的会话已过期")
+            return False
+        if not all(data.get(field) for field in FIELDS):
+            return False
+
+        for field in FIELDS:
+            setattr(hub, field, data[field])
+        try:
+            set_cookies(hub.http, data.get("cookies", []))
+        except:
+            logger.warn(u"恢复 Cookie 失败", exc_info=True)
+        return True
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
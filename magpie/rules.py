@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/16 15:08:13
+#   Desc    :   群和讨论组消息的过滤规则
+#
+""" 在 Poll 返回的消息交给 twqq 处理之前按规则过滤群和讨论组消息, 被过滤的
+消息不再解析内容, 下载图片, 查找名称, 存储记录和转发到 XMPP.
+
+规则有三种:
+
+* 屏蔽: 屏蔽指定群/讨论组的全部消息
+* 只看提到我的: 只转发指定群/讨论组中提到自己(``@昵称``)的消息
+* 关键词: 屏蔽所有群/讨论组中包含关键词的消息, 不区分大小写
+
+所有关键词和提到自己的名称编译为一个 Aho-Corasick 自动机, 每条消息的文本
+只扫描一遍. 规则按唯一 id 保存在 JSON 文件中(需要使用 ~magpie.ids.IdTable
+保存唯一 id, 重启后 id 才不会变化), 可以直接编辑, 也可以通过命令修改::
+
+    {"mute": [2, 5], "only_mentions": [7], "block": ["广告", "代刷"],
+     "names": ["小明"]}
+
+names 为除了 QQ 昵称之外的其他名称(如群名片).
+"""
+import os
+import json
+import logging
+
+from collections import deque
+
+from twqq.objects import UniqueIds
+
+logger = logging.getLogger("magpie")
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+MUTE = "mute"
+BLOCK = "block"
+MENTION = "mention"
+
+# 消息类型 => 消息中群/讨论组的键
+_TARGETS = {"group_message": "group_code", "discu_message": "did"}
+
+
+class KeywordMatcher(object):
+    """ Aho-Corasick 多模式匹配
+
+        :param patterns: {模式: 值}, 匹配到模式时返回对应的值
+    """
+
+    def __init__(self, patterns):
+        self._goto = [{}]       # 状态 => {字符: 下一状态}
+        self._fail = [0]
+        self._output = [()]     # 状态 => 匹配到的值
+        for pattern, value in patterns.items():
+            if pattern:
+                self._add(pattern, value)
+        self._build()
+
+    def __len__(self):
+        return len(self._goto) - 1
+
+    def _add(self, pattern, value):
+        state = 0
+        for char in pattern:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = nxt
+        if value not in self._output[state]:
+            self._output[state] += (value,)
+
+    def _build(self):
+        # 按广度优先计算失败转移, 并合并失败状态的输出
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[nxt] = fail
+                for value in self._output[fail]:
+                    if value not in self._output[nxt]:
+                        self._output[nxt] += (value,)
+
+    def search(self, text, stop=None):
+        """ 扫描一遍文本
+
+        :param stop: 匹配到这个值时立即返回
+        :rtype: 匹配到的值的集合
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+                if stop in found:
+                    break
+        return found
+
+
+def message_text(contents):
+    """ 获取原始消息内容中的文本部分, 表情和图片忽略
+    """
+    return u"".join(row for row in contents if isinstance(row, string_types))
+
+
+class RuleSet(object):
+    """ 消息过滤规则
+
+        :param path: 保存规则的 JSON 文件, 为 None 则只保存在内存中
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.muted = set()              # 屏蔽的唯一 id
+        self.only_mentions = set()      # 只看提到我的唯一 id
+        self.keywords = set()           # 屏蔽的关键词
+        self.names = set()              # 除昵称外提到自己使用的名称
+        self.nickname = None
+        self.checked = 0
+        self.dropped = {}               # 原因 => 丢弃数
+        self._matcher = None
+        self._load()
+        self._compile()
+
+    def __len__(self):
+        return len(self.muted) + len(self.only_mentions) + len(self.keywords)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ValueError:
+            logger.warn(u"规则文件 {0} 已损坏, 忽略".format(self.path),
+                        exc_info=True)
+            return
+
+        self.muted = set(int(x) for x in data.get("mute", []))
+        self.only_mentions = set(int(x) for x in data.get("only_mentions", []))
+        self.keywords = set(x.lower() for x in data.get("block", []) if x)
+        self.names = set(x for x in data.get("names", []) if x)
+
+    def save(self):
+        if not self.path:
+            return
+        data = {"mute": sorted(self.muted),
+                "only_mentions": sorted(self.only_mentions),
+                "block": sorted(self.keywords), "names": sorted(self.names)}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=4)
+        os.rename(tmp, self.path)
+
+    def _compile(self):
+        patterns = dict((keyword, BLOCK) for keyword in self.keywords)
+        names = set(self.names)
+        if self.nickname:
+            names.add(self.nickname)
+        for name in names:
+            # 提到自己的名称同时是关键词时按屏蔽处理
+            patterns.setdefault(u"@" + name.lower(), MENTION)
+        self._matcher = KeywordMatcher(patterns) if patterns else None
+
+    def _changed(self):
+        self._compile()
+        try:
+            self.save()
+        except (IOError, OSError):
+            logger.warn(u"保存规则失败", exc_info=True)
+
+    def set_nickname(self, nickname):
+        """ 设置 QQ 昵称, 昵称变化时重新编译
+        """
+        if nickname != self.nickname:
+            self.nickname = nickname
+            self._compile()
+
+    def mute(self, _id):
+        self.only_mentions.discard(_id)
+        self.muted.add(_id)
+        self._changed()
+
+    def mention_only(self, _id):
+        self.muted.discard(_id)
+        self.only_mentions.add(_id)
+        self._changed()
+
+    def unmute(self, _id):
+        """ 去掉 id 的屏蔽和只看提到我的规则
+
+        :rtype: 有规则被去掉时返回 True
+        """
+        if _id not in self.muted and _id not in self.only_mentions:
+            return False
+        self.muted.discard(_id)
+        self.only_mentions.discard(_id)
+        self._changed()
+        return True
+
+    def block(self, keyword):
+        self.keywords.add(keyword.lower())
+        self._changed()
+
+    def unblock(self, keyword):
+        keyword = keyword.lower()
+        if keyword not in self.keywords:
+            return False
+        self.keywords.discard(keyword)
+        self._changed()
+        return True
+
+    def check(self, _id, contents):
+        """ 检查一条群/讨论组消息
+
+        :param _id: 群/讨论组的唯一 id
+        :param contents: 原始消息内容
+        :rtype: 需要丢弃时返回原因, 否则返回 None
+        """
+        if _id in self.muted:
+            return MUTE
+
+        mention_only = _id in self.only_mentions
+        if not self.keywords and not mention_only:
+            return None
+
+        found = ()
+        if self._matcher is not None:
+            found = self._matcher.search(message_text(contents).lower(),
+                                         BLOCK)
+        if BLOCK in found:
+            return BLOCK
+        if mention_only and MENTION not in found:
+            return MENTION
+        return None
+
+    def filter(self, messages):
+        """ 过滤一次 Poll 返回的消息列表
+
+        :rtype: 去掉被过滤的消息后的列表
+        """
+        if not len(self):
+            return messages
+
+        result = []
+        for message in messages:
+            key = _TARGETS.get(message.get("poll_type"))
+            value = message.get("value")
+            if key is None or not isinstance(value, dict):
+                result.append(message)
+                continue
+
+            self.checked += 1
+            reason = self.check(UniqueIds.get_id(value.get(key)),
+                                value.get("content", []))
+            if reason is not None:
+                self.dropped[reason] = self.dropped.get(reason, 0) + 1
+                continue
+            result.append(message)
+        return result
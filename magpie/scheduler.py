@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/30 11:02:47
+#   Desc    :   发送消息调度
+#
+""" 发往 QQ 的消息按接收对象排队, 每个对象和整个账号分别使用令牌桶限速,
+同一个对象同时只有一条消息在发送, 保证顺序. 发送失败的消息按指数退避重试,
+而不是重新登录.
+
+过长的消息(如粘贴的日志和代码)会在换行, 空白或标点处切分为多段, 每段作为
+一条消息排队, 逐段确认, 失败时只重发失败的那一段. 同一条消息的后续分段只
+受整个账号的限速, 上一段确认后立即发送下一段.
+"""
+import time
+import logging
+
+from collections import deque, OrderedDict
+
+from tornado.ioloop import IOLoop
+
+from magpie.backoff import Backoff
+
+logger = logging.getLogger("magpie")
+
+GROUP = "group"
+BUDDY = "buddy"
+DISCU = "discu"
+SESS = "sess"
+
+# 切分时优先使用的边界
+_SPACES = u" \t"
+_PUNCTUATION = u"。！？；，、.!?;,)]}>】）"
+
+
+def _is_high_surrogate(char):
+    return u"\ud800" <= char <= u"\udbff"
+
+
+def split_message(content, size):
+    """ 将消息切分为不超过 size 个字符的分段, 依次尝试在换行, 空白和标点
+    处切分, 都没有时直接切分(不会拆开 UTF-16 代理对). 切分处的换行和空白
+    被去掉, 只包含空白的分段被丢弃.
+
+    :param size: 每段的最大字符数, 为 0 则不切分
+    :rtype: [分段]
+    """
+    if not size or len(content) <= size:
+        return [content]
+
+    parts = []
+    while len(content) > size:
+        # 只在后半部分查找边界, 避免产生过短的分段
+        low = size // 2
+        cut = content.rfind(u"\n", low, size + 1)
+        skip = 1
+        if cut < 0:
+            cut = max(content.rfind(c, low, size + 1) for c in _SPACES)
+        if cut < 0:
+            cut = max(content.rfind(c, low, size) for c in _PUNCTUATION)
+            skip = 0
+            if cut >= 0:
+                cut += 1
+        if cut < 0:
+            cut = size
+            if _is_high_surrogate(content[cut - 1]):
+                cut -= 1
+
+        part, content = content[:cut], content[cut + skip:]
+        if part.strip():
+            parts.append(part)
+    if content.strip():
+        parts.append(content)
+    return parts
+
+
+class TokenBucket(object):
+    """ 令牌桶
+
+        :param rate: 每秒产生的令牌数
+        :param burst: 令牌上限
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now=None):
+        """ 获取到有可用令牌还需要等待的时间
+        """
+        now = time.time() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now=None):
+        now = time.time() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+
+
+class Job(object):
+    """ 一条待发送的消息或消息的一段
+
+        :param message: 所属消息的编号, 同一条消息的分段相同
+        :param part: 分段的序号, 从 0 开始
+        :param parts: 消息的分段数
+    """
+    __slots__ = ("kind", "target", "content", "args", "attempts",
+                 "not_before", "message", "part", "parts")
+
+    def __init__(self, kind, target, content, args=(), message=0, part=0,
+                 parts=1):
+        self.kind = kind
+        self.target = target
+        self.content = content
+        self.args = args
+        self.attempts = 0
+        self.not_before = 0
+        self.message = message
+        self.part = part
+        self.parts = parts
+
+
+class _Target(object):
+    __slots__ = ("jobs", "bucket", "inflight")
+
+    def __init__(self, bucket):
+        self.jobs = deque()
+        self.bucket = bucket
+        self.inflight = None
+
+
+class SendScheduler(object):
+    """ 发送消息调度器
+
+        :param hub: ~twqq.hub.RequestHub instance
+        :param notify: 发送失败时给控制账号发送提示的函数
+        :param rate: 每个对象每秒最多发送的消息数
+        :param burst: 每个对象允许的突发消息数
+        :param account_rate: 整个账号每秒最多发送的消息数
+        :param account_burst: 整个账号允许的突发消息数
+        :param max_retries: 最大重试次数
+        :param timeout: 发送请求没有返回多久后视为失败(秒)
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+        :param fragment_size: 单条消息的最大字符数, 超过时切分发送, 为 0 则
+                              不切分
+    """
+
+    def __init__(self, hub, notify=None, rate=1.0, burst=3, account_rate=3.0,
+                 account_burst=6, max_retries=3, timeout=60, io_loop=None,
+                 fragment_size=600):
+        self.hub = hub
+        self.fragment_size = fragment_size
+        self.notify = notify
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = Backoff(base=1, cap=30)
+        self.io_loop = io_loop or IOLoop.instance()
+        self._account = TokenBucket(account_rate, account_burst)
+        self._targets = OrderedDict()   # (kind, target) => _Target
+        self._requests = {}             # id(request) => (key, job, timeout)
+        self._timeout = None
+        self._next_message = 0
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.fragmented = 0
+
+    def send(self, kind, target, content, *args):
+        """ 将消息放入队列
+
+        :param kind: GROUP/BUDDY/DISCU/SESS
+        :param target: 接收对象, 群为 gcode, 好友为 uin, 讨论组为 did,
+                       临时消息为接收人 uin
+        :param content: 消息内容
+        :param args: 其他参数, 临时消息为群的 gid
+        """
+        key = (kind, target)
+        item = self._targets.get(key)
+        if item is None:
+            item = self._targets[key] = _Target(
+                TokenBucket(self.rate, self.burst))
+
+        self._next_message += 1
+        parts = split_message(content, self.fragment_size)
+        if len(parts) > 1:
+            self.fragmented += 1
+            logger.info(u"消息过长, 切分为 {0} 段发送".format(len(parts)))
+        for i, part in enumerate(parts):
+            item.jobs.append(Job(kind, target, part, args, self._next_message,
+                                 i, len(parts)))
+        self._pump()
+
+    def _dispatch(self, job):
+        if job.kind == GROUP:
+            return self.hub.send_group_msg(job.target, job.content)
+        elif job.kind == BUDDY:
+            return self.hub.send_buddy_msg(job.target, job.content)
+        elif job.kind == DISCU:
+            return self.hub.send_discu_msg(job.target, job.content)
+        elif job.kind == SESS:
+            return self.hub.send_sess_msg(job.args[0], job.target,
+                                          job.content)
+        raise ValueError(job.kind)
+
+    def _pump(self):
+        """ 发送所有可以发送的消息, 并在下一条消息可以发送时再次调用
+        """
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+        now = time.time()
+        wait = None
+        for key in list(self._targets.keys()):
+            item = self._targets[key]
+            if item.inflight is not None:
+                continue
+            if not item.jobs:
+                del self._targets[key]
+                continue
+
+            job = item.jobs[0]
+            # 后续分段只受账号的限速
+            bucket_wait = item.bucket.wait_time(now) if not job.part else 0
+            delay = max(job.not_before - now, bucket_wait,
+                        self._account.wait_time(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            item.jobs.popleft()
+            if not job.part:
+                item.bucket.consume(now)
+            self._account.consume(now)
+            item.inflight = job
+            try:
+                request = self._dispatch(job)
+            except:
+                logger.error(u"发送消息失败", exc_info=True)
+                request = None
+
+            if request is not None:
+                rid = id(request)
+                timeout = self.io_loop.add_timeout(
+                    self.io_loop.time() + self.timeout,
+                    lambda: self._on_timeout(rid))
+                self._requests[rid] = (key, job, timeout)
+            elif self._failed(key, job, pump=False):
+                delay = job.not_before - now
+                wait = delay if wait is None else min(wait, delay)
+
+        if wait is not None:
+            self._timeout = self.io_loop.add_timeout(
+                self.io_loop.time() + wait, self._pump)
+
+    def on_response(self, request, data):
+        """ 发送消息请求返回时调用
+
+        :rtype: 是此调度器发送的消息且已处理返回 True, 重试次数用完返回
+                False
+        """
+        r = self._requests.pop(id(request), None)
+        if r is None:
+            return False
+
+        key, job, timeout = r
+        self.io_loop.remove_timeout(timeout)
+        if isinstance(data, dict) and data.get("retcode") == 0:
+            self.sent += 1
+            self._release(key)
+            return True
+        logger.warn(u"发送消息失败: {0!r}".format(data))
+        return self._failed(key, job)
+
+    def _on_timeout(self, rid):
+        r = self._requests.pop(rid, None)
+        if r is not None:
+            logger.warn(u"发送消息超时: {0}".format(r[1].content))
+            self._failed(r[0], r[1])
+
+    def _release(self, key, pump=True):
+        item = self._targets.get(key)
+        if item is not None:
+            item.inflight = None
+        if pump:
+            self._pump()
+
+    def _failed(self, key, job, pump=True):
+        """ 处理发送失败的消息, 还可以重试时重新放入队列并返回 True
+        """
+        job.attempts += 1
+        item = self._targets.get(key)
+        if job.attempts <= self.max_retries and item is not None:
+            self.retried += 1
+            job.not_before = time.time() + self.backoff.delay(job.attempts - 1)
+            item.jobs.appendleft(job)
+            self._release(key, pump)
+            return True
+
+        self.failed += 1
+        dropped = 0
+        if job.parts > 1 and item is not None:
+            # 缺少一段后余下的分段没有意义
+            rest = [j for j in item.jobs if j.message != job.message]
+            dropped = len(item.jobs) - len(rest)
+            item.jobs = deque(rest)
+        if self.notify:
+            if job.parts > 1:
+                self.notify(u"[S] 消息第 {0}/{1} 段发送失败, 余下 {2} 段不再"
+                            u"发送: {3}".format(job.part + 1, job.parts,
+                                                dropped, job.content))
+            else:
+                self.notify(u"[S] 消息发送失败: {0}".format(job.content))
+        self._release(key, pump)
+        return False
+
+    def depth(self):
+        """ 获取每个对象的队列长度
+
+        :rtype: {(kind, target): 排队的消息数(包括正在发送的)}
+        """
+        return dict((key, len(item.jobs) + (item.inflight is not None))
+                    for key, item in self._targets.items())
+
+    def __len__(self):
+        return sum(self.depth().values())
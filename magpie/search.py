@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/07 10:05:33
+#   Desc    :   好友和群成员搜索
+#
+""" 好友, 群成员, 群和讨论组的内存索引.
+
+昵称, 备注名, 群名片和拼音首字母按二元组(单个字符也作为一元组, 用于单字查询)
+建立倒排索引, 查询时取各个二元组倒排表的交集再验证是否包含查询词; 全拼只按前两个字母建立
+索引, 用于前缀匹配. 安装了 pypinyin 时才会索引拼音.
+
+索引通过 ~magpie.directory.ContactDirectory 的更新通知增量维护.
+"""
+import heapq
+import logging
+
+try:
+    from pypinyin import lazy_pinyin, FIRST_LETTER
+except ImportError:
+    lazy_pinyin = None
+
+logger = logging.getLogger("magpie")
+
+FRIEND = "friend"
+MEMBER = "member"
+GROUP = "group"
+DISCU = "discu"
+
+
+def _is_ascii(text):
+    return all(ord(char) < 128 for char in text)
+
+
+def _grams(term):
+    """ 二元组, 每个字符同时作为一元组
+    """
+    grams = set(term[i:i + 2] for i in range(len(term) - 1))
+    grams.update(term)
+    return grams
+
+
+class _Doc(object):
+    __slots__ = ("kind", "owner", "uin", "names", "terms", "pinyin")
+
+    def __init__(self, kind, owner, uin, names, terms, pinyin):
+        self.kind = kind
+        self.owner = owner
+        self.uin = uin
+        self.names = names
+        self.terms = terms
+        self.pinyin = pinyin
+
+
+class SearchIndex(object):
+    """ 搜索索引
+
+        :param directory: ~magpie.directory.ContactDirectory instance
+        :param use_pinyin: 是否索引拼音, 需要安装 pypinyin
+    """
+
+    def __init__(self, directory, use_pinyin=True):
+        self.directory = directory
+        self.hub = directory.hub
+        self.use_pinyin = use_pinyin and lazy_pinyin is not None
+        self._docs = {}         # 文档 id => _Doc
+        self._keys = {}         # (kind, owner, uin) => 文档 id
+        self._owned = {}        # (kind, owner) => set(文档 id)
+        self._grams = {}        # 二元组 => set(文档 id)
+        self._heads = {}        # 全拼前两个字母 => set(文档 id)
+        self._next = 0
+        directory.add_listener(self._on_change)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _terms(self, names):
+        terms, pinyin = set(), set()
+        for name in names:
+            terms.add(name.lower())
+            if self.use_pinyin and not _is_ascii(name):
+                terms.add(u"".join(lazy_pinyin(name, style=FIRST_LETTER))
+                          .lower())
+                pinyin.add(u"".join(lazy_pinyin(name)).lower())
+        return tuple(terms), tuple(pinyin)
+
+    def add(self, kind, owner, uin, names):
+        """ 添加或替换一个文档
+
+        :param kind: FRIEND/MEMBER/GROUP/DISCU
+        :param owner: 所属的群 gcode, 其他类型为 None
+        :param uin: 好友/群成员的 uin, 群的 gcode, 讨论组的 did
+        :param names: 可以搜索的名字
+        """
+        key = (kind, owner, uin)
+        self.remove(key)
+        names = tuple(name for name in names if name)
+        if not names:
+            return
+
+        terms, pinyin = self._terms(names)
+        did = self._next
+        self._next += 1
+        self._docs[did] = _Doc(kind, owner, uin, names, terms, pinyin)
+        self._keys[key] = did
+        self._owned.setdefault((kind, owner), set()).add(did)
+        for term in terms:
+            for gram in _grams(term):
+                self._grams.setdefault(gram, set()).add(did)
+        for item in pinyin:
+            self._heads.setdefault(item[:2], set()).add(did)
+
+    def remove(self, key):
+        did = self._keys.pop(key, None)
+        if did is not None:
+            self._remove_doc(did)
+
+    def _remove_doc(self, did):
+        doc = self._docs.pop(did)
+        self._keys.pop((doc.kind, doc.owner, doc.uin), None)
+        owned = self._owned.get((doc.kind, doc.owner))
+        if owned is not None:
+            owned.discard(did)
+            if not owned:
+                del self._owned[(doc.kind, doc.owner)]
+        for term in doc.terms:
+            for gram in _grams(term):
+                self._discard(self._grams, gram, did)
+        for item in doc.pinyin:
+            self._discard(self._heads, item[:2], did)
+
+    def _discard(self, index, key, did):
+        dids = index.get(key)
+        if dids is not None:
+            dids.discard(did)
+            if not dids:
+                del index[key]
+
+    def remove_owner(self, kind, owner):
+        """ 删除某个群的全部成员等
+        """
+        for did in list(self._owned.get((kind, owner), ())):
+            self._remove_doc(did)
+
+    def _on_change(self, kind, key):
+        if kind == "friends":
+            self.index_friends()
+        elif kind == "groups":
+            self.index_groups()
+        elif kind == "group":
+            self.index_group(key)
+        elif kind in ("discus", "discu"):
+            self.index_discus()
+
+    def index_friends(self):
+        friends = self.hub.get_friends()
+        if friends is None:
+            return
+        self.remove_owner(FRIEND, None)
+        for item in friends.info:
+            self.add(FRIEND, None, item.uin, (item.markname, item.nick))
+
+    def index_groups(self):
+        groups = self.hub.get_groups()
+        if groups is None:
+            return
+        self.remove_owner(GROUP, None)
+        gcodes = set()
+        for group in groups:
+            gcodes.add(group.code)
+            self.index_group(group.code)
+
+        for kind, owner in list(self._owned.keys()):
+            if kind == MEMBER and owner not in gcodes:
+                self.remove_owner(MEMBER, owner)
+
+    def index_group(self, gcode):
+        """ 重建一个群的成员索引
+        """
+        groups = self.hub.get_groups()
+        group = groups.find_group(gcode) if groups else None
+        self.remove_owner(MEMBER, gcode)
+        if group is None:
+            return
+        self.add(GROUP, None, gcode, (group.name, ))
+        for uin, info in group._uin_map.items():
+            self.add(MEMBER, gcode, uin, (info.card, info.nick))
+
+    def index_discus(self):
+        discu = self.hub.get_discu()
+        if discu is None:
+            return
+        self.remove_owner(DISCU, None)
+        for item in discu.discus:
+            self.add(DISCU, None, item.did, (item.name, ))
+
+    def search(self, term, limit=10, kind=None, owner=None):
+        """ 搜索
+
+        :param term: 搜索词
+        :param limit: 最多返回的结果数
+        :param kind: 只搜索该类型
+        :param owner: 只搜索该群的成员
+        :rtype: [(kind, owner, uin, names)], 完全匹配, 前缀匹配, 包含的
+                顺序排列
+        """
+        term = term.strip().lower()
+        if not term:
+            return []
+
+        candidates = self._candidates(term)
+        results = []
+        for did in candidates:
+            doc = self._docs[did]
+            if kind is not None and doc.kind != kind:
+                continue
+            if owner is not None and doc.owner != owner:
+                continue
+            score = self._score(doc, term)
+            if score is not None:
+                results.append((score, min(len(n) for n in doc.names), did))
+
+        return [(doc.kind, doc.owner, doc.uin, doc.names)
+                for doc in (self._docs[did] for _, _, did in
+                            heapq.nsmallest(limit, results))]
+
+    def _candidates(self, term):
+        if len(term) == 1:
+            grams = [term]
+        else:
+            # 一元组都包含在二元组中, 只取二元组
+            grams = [g for g in _grams(term) if len(g) == 2]
+
+        postings = sorted((self._grams.get(g, ()) for g in grams), key=len)
+        if not postings or not postings[0]:
+            candidates = set()
+        else:
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates &= posting
+                if not candidates:
+                    break
+
+        if len(term) >= 2 and _is_ascii(term):
+            candidates.update(self._heads.get(term[:2], ()))
+        return candidates
+
+    def _score(self, doc, term):
+        best = None
+        for item in doc.terms:
+            if item == term:
+                return 0
+            if item.startswith(term):
+                best = 1
+            elif best is None and term in item:
+                best = 2
+        for item in doc.pinyin:
+            if item.startswith(term):
+                best = 1 if best is None else min(best, 1)
+        return best
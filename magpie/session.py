@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/26 10:31:16
+#   Desc    :   单独会话模式
+#
+""" 单独会话模式下每个好友/群/讨论组都有一个对应的 JID, 收到的消息从对应的
+JID 发出, 回复该 JID 的消息直接发送给对应的对象, 不需要解析命令.
+
+配置了 domain 时 JID 为 ``<id>@<domain>``, 需要服务器允许使用这些地址(如
+组件模式); 否则使用 XMPP 账号的资源 ``<account>/<id>``, 由于大部分服务器
+会改写客户端发出消息的 from, 此时同时将 id 放在消息的 thread 里, 回复时
+通过 thread 找到对应的对象.
+"""
+from pyxmpp2.jid import JID
+
+from twqq.objects import UniqueIds
+
+
+class SessionRouter(object):
+    """ 维护 id 和 JID 的对应关系
+
+        :param base_jid: XMPP 账号的 JID
+        :param domain: 对应 JID 使用的域, 为 None 则使用 base_jid 的资源
+        :param owns: 判断 id 是否为此账号的联系人的函数, 多个账号共享一个域
+                     时用于区分没有发过消息的对象
+    """
+
+    def __init__(self, base_jid, domain=None, owns=None):
+        self.base_jid = base_jid
+        self.domain = domain
+        self.owns = owns
+        self._jids = {}       # id => JID
+        self._routes = {}     # JID 字符串 => id
+
+    def contact_jid(self, _id):
+        """ 获取 id 对应的 JID
+        """
+        jid = self._jids.get(_id)
+        if jid is None:
+            if self.domain:
+                jid = JID(str(_id), self.domain)
+            else:
+                jid = JID(self.base_jid.local, self.base_jid.domain, str(_id))
+            self._jids[_id] = jid
+            self._routes[jid.as_unicode()] = _id
+        return jid
+
+    def lookup(self, jid):
+        """ 根据消息的接收人查找 id, 找不到返回 None
+        """
+        # 账号自己的 JID 可能也在这个域下, 发给它的是命令
+        if not jid or jid.bare() == self.base_jid.bare():
+            return None
+        _id = self._routes.get(jid.as_unicode())
+        # 使用独立的域时可以直接给没有发过消息的对象发送消息
+        if _id is None and self.domain and jid.domain == self.domain\
+                and jid.local and jid.local.isdigit():
+            _id = int(jid.local)
+            if self.owns is not None and not self.owns(_id):
+                return None
+        return _id
+
+    def issued(self, jid):
+        """ 是否从 jid 给控制账号发送过消息
+        """
+        if not jid:
+            return False
+        return jid.as_unicode() in self._routes or\
+            jid.bare().as_unicode() in self._routes
+
+    def lookup_thread(self, thread):
+        """ 根据消息的 thread 查找 id, 找不到返回 None
+        """
+        if thread and thread.isdigit() and int(thread) in self._jids:
+            return int(thread)
+
+    def target(self, _id):
+        """ 获取 id 对应的 uin 和类型
+
+        :rtype: (uin, type) 找不到返回 None
+        """
+        uin, _type = UniqueIds.get(_id)
+        if uin is None:
+            return None
+        return uin, _type
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/12 09:18:40
+#   Desc    :   联系人快照
+#
+""" 保存好友(含分组), 群, 群成员, 讨论组和讨论组成员的原始数据, 启动时一次性
+读入并交给 hub, 名称解析和 ``-list`` 等命令在获取到最新数据之前就可以使用.
+
+快照保存的是 WebQQ 返回的 result 部分, 加载时调用与请求回调相同的函数
+(set_friends, set_groups, set_group_detail 等), 获取到最新数据后照常替换,
+并在数据停止变化一段时间后合并保存一次. 文件为 zlib 压缩的 JSON.
+
+uin 只在一段时间内有效, 快照中的 uin 可能已经失效, 所以只作为获取到最新
+数据之前的临时数据.
+"""
+import os
+import json
+import time
+import zlib
+import logging
+
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger("magpie")
+
+
+class ContactSnapshot(object):
+    """ 联系人快照
+
+        :param path: 文件路径
+        :param qq: 快照所属的 QQ 号
+        :param max_age: 快照最长有效时间(秒), 超过后不再加载
+        :param delay: 数据变化后多久保存(秒), 期间的变化合并为一次保存
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, qq, max_age=7 * 24 * 3600, delay=10,
+                 io_loop=None):
+        self.path = path
+        self.qq = qq
+        self.max_age = max_age
+        self.delay = delay
+        self.io_loop = io_loop or IOLoop.instance()
+        self.friends = None
+        self.groups = None
+        self.members = {}       # gcode => 群成员数据
+        self.discus = None
+        self.discu_details = {}     # did => 讨论组详细信息
+        self._save_timeout = None
+
+    def load(self, hub):
+        """ 读取快照并设置到 hub
+
+        :rtype: 加载成功返回 True
+        """
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        except (IOError, ValueError, zlib.error):
+            logger.warn(u"读取联系人快照 {0} 失败".format(self.path),
+                        exc_info=True)
+            return False
+
+        if data.get("version") != self.VERSION or\
+                str(data.get("qq")) != str(self.qq):
+            return False
+        if time.time() - data.get("time", 0) > self.max_age:
+            logger.info(u"联系人快照已过期")
+            return False
+
+        self.friends = data.get("friends")
+        self.groups = data.get("groups")
+        self.members = dict(data.get("members", []))
+        self.discus = data.get("discus")
+        self.discu_details = dict(data.get("discu_details", []))
+
+        if self.friends is not None:
+            hub.set_friends(self.friends)
+        if self.groups is not None:
+            hub.set_groups(self.groups)
+            groups = hub.get_groups()
+            for gcode, members in self.members.items():
+                group = groups.find_group(gcode)
+                if group is not None:
+                    group.set_group_detail(members)
+        if self.discus is not None:
+            hub.set_discu(self.discus)
+            discu = hub.get_discu()
+            for did, detail in self.discu_details.items():
+                if did in discu._did_map:
+                    discu.set_detail(did, detail)
+        return True
+
+    def set_friends(self, data):
+        self.friends = data
+        self._changed()
+
+    def set_groups(self, data):
+        self.groups = data
+        codes = set(item.get("code") for item in data.get("gnamelist", []))
+        self.members = dict((gcode, members) for gcode, members
+                            in self.members.items() if gcode in codes)
+        self._changed()
+
+    def set_members(self, gcode, data):
+        self.members[gcode] = data
+        self._changed()
+
+    def set_discus(self, data):
+        self.discus = data
+        dids = set(item.get("did") for item in data.get("dnamelist", []))
+        self.discu_details = dict((did, detail) for did, detail
+                                  in self.discu_details.items()
+                                  if did in dids)
+        self._changed()
+
+    def set_discu_detail(self, did, data):
+        self.discu_details[did] = data
+        self._changed()
+
+    def _changed(self):
+        if self._save_timeout is not None:
+            self.io_loop.remove_timeout(self._save_timeout)
+        self._save_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + self.delay, self._save)
+
+    def _save(self):
+        self._save_timeout = None
+        try:
+            self.save()
+        except (IOError, OSError):
+            logger.warn(u"保存联系人快照失败", exc_info=True)
+
+    def flush(self):
+        """ 立即保存等待中的变化
+        """
+        if self._save_timeout is not None:
+            self.io_loop.remove_timeout(self._save_timeout)
+            self._save()
+
+    def save(self):
+        # JSON 对象的键只能是字符串, gcode 和 did 保存为列表
+        data = {"version": self.VERSION, "qq": self.qq, "time": time.time(),
+                "friends": self.friends, "groups": self.groups,
+                "members": list(self.members.items()),
+                "discus": self.discus,
+                "discu_details": list(self.discu_details.items())}
+        raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(zlib.compress(raw))
+        os.rename(tmp, self.path)
+        logger.debug(u"保存联系人快照 {0} ({1} 字节)"
+                     .format(self.path, len(raw)))
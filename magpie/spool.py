@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/06 15:12:40
+#   Desc    :   XMPP 断开时暂存待发送的消息
+#
+""" XMPP 断开期间要发送的消息暂存在内存队列中, 指定了文件时同时追加写入文件
+(每行一条 JSON 记录), 进程重启后仍然可以补发. 重复的消息只保存一条, 超过
+数量或大小上限时丢弃最早的消息, 补发时丢弃超过保存时间的消息.
+
+每条记录带有时间和序号, 只有同一条记录被重复暂存时才去重, 先后发送的相同
+内容的消息都会保留.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+
+from collections import deque
+
+logger = logging.getLogger("magpie")
+
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def _digest(record):
+    key = u"\0".join([repr(record.get("t")), repr(record.get("n"))] +
+                     [record.get(k) or u"" for k in ("f", "to", "th", "body")])
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def _valid(record):
+    """ 检查并补全从文件中读取的记录, 兼容旧版本和手工编辑的记录
+    """
+    if not isinstance(record, dict):
+        return False
+    for key in ("f", "to"):
+        if not isinstance(record.get(key), string_types):
+            return False
+    for key in ("body", "th"):
+        if record.get(key) is not None and \
+                not isinstance(record[key], string_types):
+            return False
+    if not isinstance(record.get("t"), (int, float)):
+        record["t"] = time.time()
+    record.setdefault("type", "chat")
+    return True
+
+
+class Spool(object):
+    """ 待发送消息队列
+
+    每条记录是一个字典: ``{"t": 时间, "n": 序号, "f": 发送人, "to": 接收人,
+    "type": 消息类型, "body": 内容, "th": thread}``
+
+        :param path: 文件路径, 为 None 则只保存在内存中
+        :param max_items: 最多保存的消息数
+        :param max_bytes: 最多保存的字节数
+        :param max_age: 消息最长保存时间(秒), 为 None 则不限制
+    """
+
+    def __init__(self, path=None, max_items=10000, max_bytes=16 * 1024 * 1024,
+                 max_age=24 * 3600):
+        self.path = path
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._items = deque()       # (摘要, 记录, 字节数)
+        self._digests = set()
+        self._bytes = 0
+        self._file = None
+        self._file_bytes = 0
+        self._seq = 0
+
+        self.dropped = 0
+        self.expired = 0
+        self.duplicated = 0
+
+        if path:
+            self._load()
+            self._file = open(path, "ab")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    logger.warn(u"忽略损坏的暂存记录: %r", line)
+                    continue
+                if not _valid(record):
+                    logger.warn(u"忽略无效的暂存记录: %r", line)
+                    continue
+                if isinstance(record.get("n"), int):
+                    self._seq = max(self._seq, record["n"] + 1)
+                self._push(record, len(line))
+        self._rewrite()
+        if self._items:
+            logger.info(u"加载 %d 条暂存的消息", len(self._items))
+
+    def _push(self, record, size):
+        digest = _digest(record)
+        if digest in self._digests:
+            self.duplicated += 1
+            return False
+
+        self._items.append((digest, record, size))
+        self._digests.add(digest)
+        self._bytes += size
+        while len(self._items) > self.max_items or \
+                self._bytes > self.max_bytes:
+            self._pop()
+            self.dropped += 1
+        return True
+
+    def _pop(self):
+        digest, record, size = self._items.popleft()
+        self._digests.discard(digest)
+        self._bytes -= size
+        return record
+
+    def _rewrite(self):
+        """ 用内存中的记录重写文件, 去掉已经丢弃的记录
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            for _, record, _ in self._items:
+                f.write(self._encode(record))
+        os.rename(tmp, self.path)
+        self._file_bytes = self._bytes
+        if self._file is not None:
+            self._file.close()
+            self._file = open(self.path, "ab")
+
+    def _encode(self, record):
+        return (json.dumps(record) + "\n").encode("utf-8")
+
+    def append(self, record):
+        """ 暂存一条消息
+
+        :rtype: 重复的消息返回 False
+        """
+        record.setdefault("t", time.time())
+        if "n" not in record:
+            record["n"] = self._seq
+            self._seq += 1
+        line = self._encode(record)
+        if not self._push(record, len(line)):
+            return False
+
+        if self._file is not None:
+            self._file.write(line)
+            self._file.flush()
+            self._file_bytes += len(line)
+            # 丢弃的记录仍然在文件中, 文件过大时重写
+            if self._file_bytes > 2 * self.max_bytes:
+                self._rewrite()
+        return True
+
+    def drain(self):
+        """ 取出全部未过期的消息并清空队列
+
+        :rtype: 按暂存顺序排列的记录列表
+        """
+        now = time.time()
+        records = []
+        while self._items:
+            record = self._pop()
+            if self.max_age and now - record["t"] > self.max_age:
+                self.expired += 1
+                continue
+            records.append(record)
+
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file_bytes = 0
+        return records
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self._items)
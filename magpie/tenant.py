@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/04/23 15:40:08
+#   Desc    :   在同一个进程中运行多个账号
+#
+""" 多账号模式, 配置文件为 JSON 格式::
+
+    {
+        "tenants": [
+            {"name": "work", "qq": 123456, "xmpp": "a@jabber.org",
+             "control": "me@jabber.org", "qq_pwd": "...", "xmpp_pwd": "..."},
+            {"name": "home", "qq": 654321, "xmpp": "b@jabber.org",
+             "control": "me@jabber.org", "coalesce_interval": 0.2}
+        ]
+    }
+
+没有填写的密码会在启动时提示输入, 除上述字段外的其他字段会作为参数传递给
+~magpie.client.MagpieClient.
+
+所有账号共享一个本地 HTTP 服务(指标和缓存), 各账号挂载在 ``/<name>/`` 下,
+如 ``/work/metrics``; 监听端口为账号配置的 metrics_port, 各账号配置的端口
+必须相同.
+
+配置了 ``component`` 时所有账号共享一个外部组件连接, 账号不需要 XMPP 密码,
+没有填写 xmpp 时使用 ``<name>@<组件域>``, name 为纯数字时使用
+``qq<name>@<组件域>``, 避免与单独会话模式下联系人的 JID 冲突::
+
+    {
+        "component": {"jid": "qq.example.org", "secret": "...",
+                      "server": "127.0.0.1:5347"},
+        "tenants": [
+            {"name": "work", "qq": 123456, "control": "me@jabber.org"}
+        ]
+    }
+"""
+import json
+import logging
+
+from tornado.ioloop import IOLoop
+
+from magpie.web import WebServer, DEFAULT_PORT
+
+logger = logging.getLogger("magpie")
+
+
+class Tenant(object):
+    """ 一个账号的配置和运行状态, 每次启动都会创建新的
+    ~magpie.client.MagpieClient, 所以输入队列和命令的状态是隔离的
+
+        :param name: 名称
+        :param qq: QQ号
+        :param qq_pwd: QQ密码
+        :param xmpp: XMPP 账号
+        :param xmpp_pwd: XMPP 密码
+        :param control: XMPP 控制账号
+        :param options: 其他传递给 MagpieClient 的参数
+    """
+
+    def __init__(self, name, qq, qq_pwd, xmpp, xmpp_pwd, control, **options):
+        self.name = name
+        self.qq = qq
+        self.qq_pwd = qq_pwd
+        self.xmpp = xmpp
+        self.xmpp_pwd = xmpp_pwd
+        self.control = control
+        self.options = options
+        self.client = None
+
+    @property
+    def running(self):
+        return self.client is not None
+
+    @property
+    def uses_web(self):
+        """ 是否需要本地 HTTP 服务
+        """
+        return bool(self.options.get("metrics_port") or
+                    self.options.get("cache_dir"))
+
+    def start(self, io_loop, web=None):
+        """ 启动账号
+
+        :param web: 共享的 ~magpie.web.WebServer instance
+        """
+        from magpie.client import MagpieClient
+
+        if self.running:
+            return
+        logger.info(u"Start tenant {0}".format(self.name))
+        self.client = MagpieClient(self.qq, self.qq_pwd, self.xmpp,
+                                   self.xmpp_pwd, self.control,
+                                   io_loop=io_loop, quit_on_disconnect=False,
+                                   web=web, web_prefix=u"/" + self.name,
+                                   **self.options)
+        self.client.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        logger.info(u"Stop tenant {0}".format(self.name))
+        try:
+            self.client.stop()
+        finally:
+            self.client = None
+
+
+class TenantManager(object):
+    """ 在一个 IOLoop 上运行多个账号
+
+        :param tenants: ~Tenant instance 列表
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+        :param web: 共享的 ~magpie.web.WebServer instance, 为 None 时有账号
+                    需要 HTTP 服务则按账号的 metrics_port 创建
+    """
+
+    def __init__(self, tenants, io_loop=None, web=None):
+        self.io_loop = io_loop or IOLoop.instance()
+        self._tenants = {}
+        self._order = []
+        for tenant in tenants:
+            self.add(tenant)
+        self.web = web
+        if web is None:
+            self.web = self._make_web()
+
+    def _make_web(self):
+        """ 每个账号单独监听会导致端口冲突, 所有账号共享一个 HTTP 服务
+        """
+        tenants = [tenant for tenant in self.tenants if tenant.uses_web]
+        if not tenants:
+            return None
+        ports = set(t.options.get("metrics_port") for t in tenants
+                    if t.options.get("metrics_port"))
+        addresses = set(t.options.get("metrics_address") for t in tenants
+                        if t.options.get("metrics_address"))
+        if len(ports) > 1 or len(addresses) > 1:
+            raise ValueError(u"All tenants share one HTTP server, "
+                             u"metrics_port and metrics_address must be "
+                             u"the same")
+        port = ports.pop() if ports else DEFAULT_PORT
+        address = addresses.pop() if addresses else "127.0.0.1"
+        return WebServer(port, address, self.io_loop)
+
+    @classmethod
+    def from_config(cls, path, password_cb=None, io_loop=None):
+        """ 从配置文件加载
+
+        :param path: 配置文件路径
+        :param password_cb: 密码未配置时获取密码的函数, 接收提示信息
+        """
+        with open(path) as f:
+            config = json.load(f)
+
+        component = None
+        if config.get("component"):
+            from magpie.component import default_jid
+
+            component = cls._make_component(config["component"], password_cb,
+                                            io_loop)
+
+        tenants = []
+        for i, item in enumerate(config.get("tenants", [])):
+            item = dict(item)
+            item.setdefault("name", str(item.get("qq", i)))
+            if component is not None:
+                item["component"] = component
+                item.setdefault("xmpp", default_jid(item["name"],
+                                                    component.jid))
+                item.setdefault("xmpp_pwd", None)
+            for key, tip in (("xmpp_pwd", u"XMPP Password"),
+                             ("qq_pwd", u"QQ Password")):
+                if key == "xmpp_pwd" and component is not None:
+                    continue
+                if not item.get(key) and password_cb:
+                    item[key] = password_cb(u"Enter {0} for {1}: "
+                                            .format(tip, item["name"]))
+            tenants.append(Tenant(**item))
+        return cls(tenants, io_loop)
+
+    @staticmethod
+    def _make_component(config, password_cb=None, io_loop=None):
+        from magpie.component import ComponentStream, parse_address
+
+        secret = config.get("secret")
+        if not secret and password_cb:
+            secret = password_cb(u"Enter Component Secret for {0}: "
+                                 .format(config["jid"]))
+        host, port = parse_address(config.get("server", "127.0.0.1:5347"))
+        return ComponentStream(config["jid"], secret, host, port, io_loop)
+
+    def add(self, tenant):
+        if tenant.name in self._tenants:
+            raise ValueError(u"Duplicate tenant {0}".format(tenant.name))
+        self._tenants[tenant.name] = tenant
+        self._order.append(tenant.name)
+
+    def get(self, name):
+        return self._tenants.get(name)
+
+    @property
+    def tenants(self):
+        return [self._tenants[name] for name in self._order]
+
+    def start(self, name=None):
+        """ 启动账号, name 为 None 则启动全部
+        """
+        if self.web is not None:
+            self.web.start()
+        for tenant in self._select(name):
+            tenant.start(self.io_loop, self.web)
+
+    def stop(self, name=None):
+        """ 停止账号, name 为 None 则停止全部
+        """
+        for tenant in self._select(name):
+            try:
+                tenant.stop()
+            except:
+                logger.warn(u"Stop tenant {0} failed".format(tenant.name),
+                            exc_info=True)
+        if name is None and self.web is not None:
+            self.web.stop()
+
+    def restart(self, name=None):
+        """ 重启账号, name 为 None 则重启全部
+        """
+        for tenant in self._select(name):
+            self.stop(tenant.name)
+            self.start(tenant.name)
+
+    def _select(self, name):
+        if name is None:
+            return self.tenants
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            raise KeyError(name)
+        return [tenant]
+
+    def run(self):
+        self.start()
+        self.io_loop.start()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/02 16:08:44
+#   Desc    :   本地 HTTP 服务
+#
+import logging
+
+from tornado.web import Application, RequestHandler
+from tornado.httpserver import HTTPServer
+
+logger = logging.getLogger("magpie")
+
+DEFAULT_PORT = 9180
+
+
+class MetricsHandler(RequestHandler):
+    """ 以 Prometheus 文本格式输出指标
+    """
+
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; "
+                        "charset=utf-8")
+        self.write(self.registry.render().encode("utf-8"))
+
+
+class WebServer(object):
+    """ 运行在主循环上的 HTTP 服务, 其他模块通过 add_handler 挂载处理器,
+    多账号模式下所有账号共享一个服务, 账号停止时通过 remove_handlers 移除
+    自己的处理器
+
+        :param port: 监听端口
+        :param address: 监听地址, 默认只监听本地
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    def __init__(self, port, address="127.0.0.1", io_loop=None):
+        self.port = port
+        self.address = address
+        self.io_loop = io_loop
+        self.application = Application()
+        self._handlers = []     # (所有者, 模式, 处理器, 参数)
+        self._server = None
+
+    def add_handler(self, pattern, handler, kwargs=None, owner=None):
+        self._handlers.append((owner, pattern, handler, kwargs or {}))
+        self._rebuild()
+
+    def remove_handlers(self, owner):
+        self._handlers = [item for item in self._handlers
+                          if item[0] is not owner]
+        self._rebuild()
+
+    def _rebuild(self):
+        # Application 不支持移除处理器, 重新创建后替换正在监听的服务的回调
+        self.application = Application([item[1:]
+                                        for item in self._handlers])
+        if self._server is not None:
+            self._server.request_callback = self.application
+
+    def url(self, path):
+        return u"http://{0}:{1}{2}".format(self.address, self.port, path)
+
+    def start(self):
+        if self._server is not None:
+            return
+        if self.io_loop is not None:
+            self._server = HTTPServer(self.application, io_loop=self.io_loop)
+        else:
+            self._server = HTTPServer(self.application)
+        self._server.listen(self.port, self.address)
+        logger.info(u"HTTP server listening on {0}:{1}"
+                    .format(self.address, self.port))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
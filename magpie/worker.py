@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/09 11:03:27
+#   Desc    :   WebQQ 和 XMPP 分进程运行
+#
+""" 分进程模式下 WebQQ 和 XMPP 分别运行在两个进程中, 由父进程监控, 退出后
+自动重启:
+
+* WebQQ 进程运行 MagpieClient 的全部逻辑(拉取消息, 命令, 消息记录等), 使用
+  IPCLink 代替 XMPP 连接, 监听 unix socket.
+* XMPP 进程运行 XMPPWorker, 只负责 XMPP 连接(普通账号或者组件), 连接 WebQQ
+  进程的 unix socket, 在两边之间转发序列化后的节.
+
+XMPP 进程的 TLS, 序列化和解析等工作不会再阻塞 WebQQ 的拉取. 任意一边重启时
+另一边看到的都是 XMPP 断开又重新连接, WebQQ 进程在断开期间暂存消息.
+"""
+import logging
+
+from collections import deque
+
+from tornado import process
+from tornado.ioloop import IOLoop
+
+from pyxmpp2.jid import JID
+from pyxmpp2.client import Client
+from pyxmpp2.etree import ElementTree
+from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.constants import STANZA_CLIENT_QNP
+from pyxmpp2.exceptions import NoRouteError
+from pyxmpp2.interfaces import EventHandler, event_handler
+from pyxmpp2.interfaces import XMPPFeatureHandler
+from pyxmpp2.interfaces import presence_stanza_handler, message_stanza_handler
+from pyxmpp2.streamevents import AuthorizedEvent, DisconnectedEvent
+from pyxmpp2.stanzaprocessor import StanzaProcessor, stanza_factory
+from pyxmpp2.ext.version import VersionProvider
+from pyxmpp2.mainloop.tornado import TornadoMainLoop
+
+from magpie import __version__
+from magpie import ipc
+from magpie.backoff import Backoff
+
+logger = logging.getLogger("magpie")
+
+# 帧类型
+STANZA = 1      # 序列化后的节
+ONLINE = 2      # XMPP 已连接
+OFFLINE = 3     # XMPP 已断开
+
+
+def encode_stanza(stanza):
+    return stanza.serialize().encode("utf-8")
+
+
+def decode_stanza(data, return_path=None):
+    """ 序列化时省略了默认的 jabber:client 名字空间, 解析后补上
+    """
+    element = ElementTree.XML(data)
+    for child in element.iter():
+        if not child.tag.startswith("{"):
+            child.tag = STANZA_CLIENT_QNP + child.tag
+    return stanza_factory(element, return_path=return_path)
+
+
+class IPCLink(object):
+    """ WebQQ 进程中代替 XMPP 连接, 接口与 ~magpie.component.ComponentStream
+    相同, 作为 component 参数传给 ~magpie.client.MagpieClient
+
+        :param path: unix socket 路径
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    def __init__(self, path, io_loop=None):
+        self.path = path
+        self.io_loop = io_loop or IOLoop.instance()
+        self.jid = None
+        self.authorized = False
+        self._client = None
+        self._processor = None
+        self._channel = None
+        self._socket = None
+
+    def attach(self, client, handlers):
+        self._client = client
+        self._processor = StanzaProcessor()
+        self._processor.me = client.jid
+        self._processor.uplink = self
+        self._processor.setup_stanza_handlers(handlers, "post-auth")
+        if self._socket is None:
+            self._socket = ipc.listen(self.path, self._on_stream, self.io_loop)
+            logger.info(u"等待 XMPP 进程连接 %s", self.path)
+
+    def detach(self, client):
+        self._client = None
+        if self._socket is not None:
+            ipc.stop_listening(self._socket, self.path, self.io_loop)
+            self._socket = None
+        if self._channel is not None:
+            self._channel.close()
+
+    def _on_stream(self, stream):
+        if self._channel is not None:
+            logger.warn(u"新的 XMPP 进程连接, 关闭旧连接")
+            self._channel.on_close = None
+            self._channel.close()
+            self._on_close()
+        self._channel = ipc.Channel(stream, self._on_frame, self._on_close)
+
+    def _on_frame(self, kind, data):
+        if kind == STANZA:
+            self.uplink_receive(decode_stanza(data, self))
+        elif kind == ONLINE:
+            self.authorized = True
+            if self._client is not None:
+                self._client.handle_component_authorized()
+        elif kind == OFFLINE:
+            self._set_offline()
+
+    def _on_close(self):
+        self._channel = None
+        self._set_offline()
+
+    def _set_offline(self):
+        if self.authorized:
+            self.authorized = False
+            if self._client is not None:
+                self._client.handle_component_disconnected()
+
+    def send(self, stanza):
+        if not self.authorized or self._channel is None:
+            raise NoRouteError(u"XMPP 进程未连接")
+        self._channel.write(STANZA, encode_stanza(stanza))
+
+    def uplink_receive(self, stanza):
+        if self._processor is not None:
+            self._processor.process_stanza(stanza)
+
+
+class XMPPWorker(EventHandler, XMPPFeatureHandler):
+    """ XMPP 进程, 维护 XMPP 连接并和 WebQQ 进程转发节
+
+        :param xmpp_account: XMPP 账号, 组件模式下为组件域下的 JID
+        :param xmpp_pwd: XMPP 密码
+        :param control_account: 控制账号
+        :param path: WebQQ 进程的 unix socket 路径
+        :param component: ~magpie.component.ComponentStream instance
+        :param io_loop: ~tornado.ioloop.IOLoop instance
+    """
+
+    # 重新连接后多久没有登录成功则再次重连(秒)
+    RECONNECT_TIMEOUT = 60
+    # XMPP 断开期间最多暂存的节数, WebQQ 进程收到断开通知后会自己暂存
+    PENDING_MAX = 1000
+
+    def __init__(self, xmpp_account, xmpp_pwd, control_account, path,
+                 component=None, io_loop=None):
+        self.jid = JID(xmpp_account + '/Bridge')
+        self.control_account = control_account
+        self.path = path
+        self.component = component
+        self.io_loop = io_loop or IOLoop.instance()
+        self.online = False
+        self.reconnect_backoff = Backoff(base=1, cap=120)
+        self.ipc_backoff = Backoff(base=0.1, cap=5)
+        self._reconnect_timeout = None
+        self._channel = None
+        self._pending = deque(maxlen=self.PENDING_MAX)
+
+        settings = XMPPSettings(
+            {"software_name": "Magpie",
+             "software_version": ".".join(str(x) for x in __version__),
+             "software_os": "Linux",
+             "tls_verify_peer": False,
+             "starttls": True,
+             "ipv6": False,
+             "password": xmpp_pwd,
+             "poll_interval": 10})
+        self._handlers = [self, VersionProvider(settings)]
+        if component is not None:
+            self.client = None
+        else:
+            mainloop = TornadoMainLoop(settings, io_loop=self.io_loop)
+            self.client = Client(self.jid, self._handlers, settings, mainloop)
+
+    @property
+    def stream(self):
+        if self.component is not None:
+            return self.component
+        return self.client.stream
+
+    def run(self):
+        self._connect_ipc()
+        if self.component is not None:
+            self.component.attach(self, self._handlers)
+            self.io_loop.start()
+        else:
+            self.client.connect()
+            self.client.run()
+
+    def _connect_ipc(self):
+        stream = ipc.connect(self.path, self._on_ipc_connected, self.io_loop)
+        stream.set_close_callback(self._on_ipc_failed)
+
+    def _on_ipc_failed(self):
+        delay = self.ipc_backoff.delay()
+        logger.debug(u"连接 WebQQ 进程失败, %.1f 秒后重试", delay)
+        self.io_loop.add_timeout(self.io_loop.time() + delay,
+                                 self._connect_ipc)
+
+    def _on_ipc_connected(self, stream):
+        logger.info(u"已连接 WebQQ 进程")
+        self.ipc_backoff.reset()
+        self._channel = ipc.Channel(stream, self._on_frame,
+                                    self._on_ipc_closed)
+        if self.online:
+            self._channel.write(ONLINE)
+
+    def _on_ipc_closed(self):
+        logger.warn(u"与 WebQQ 进程的连接断开")
+        self._channel = None
+        self._on_ipc_failed()
+
+    def _on_frame(self, kind, data):
+        if kind != STANZA:
+            return
+        self._send(data)
+
+    def _send(self, data):
+        stream = self.stream
+        if not self.online or stream is None:
+            self._pending.append(data)
+            return
+        try:
+            stream.send(decode_stanza(data))
+        except:
+            logger.warn(u"发送失败, 暂存等待重新连接", exc_info=True)
+            self._pending.append(data)
+
+    def _forward(self, stanza):
+        if self._channel is None:
+            logger.warn(u"WebQQ 进程未连接, 丢弃 %s", stanza.serialize())
+            return True
+        self._channel.write(STANZA, encode_stanza(stanza))
+        return True
+
+    @message_stanza_handler()
+    def handle_message(self, stanza):
+        return self._forward(stanza)
+
+    @presence_stanza_handler("subscribe")
+    def handle_presence_subscribe(self, stanza):
+        return self._forward(stanza)
+
+    @presence_stanza_handler("subscribed")
+    def handle_presence_subscribed(self, stanza):
+        return self._forward(stanza)
+
+    @presence_stanza_handler("unsubscribe")
+    def handle_presence_unsubscribe(self, stanza):
+        return self._forward(stanza)
+
+    @presence_stanza_handler("unsubscribed")
+    def handle_presence_unsubscribed(self, stanza):
+        return self._forward(stanza)
+
+    @presence_stanza_handler("probe")
+    def handle_presence_probe(self, stanza):
+        return self._forward(stanza)
+
+    def _set_online(self):
+        self.online = True
+        pending, self._pending = self._pending, deque(maxlen=self.PENDING_MAX)
+        for data in pending:
+            self._send(data)
+        if self._channel is not None:
+            self._channel.write(ONLINE)
+
+    def _set_offline(self):
+        self.online = False
+        if self._channel is not None:
+            self._channel.write(OFFLINE)
+
+    def handle_component_authorized(self):
+        self._set_online()
+
+    def handle_component_disconnected(self):
+        self._set_offline()
+
+    @event_handler(AuthorizedEvent)
+    def handle_authorized(self, event):
+        self.reconnect_backoff.reset()
+        if self._reconnect_timeout is not None:
+            self.io_loop.remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        self._set_online()
+
+    @event_handler(DisconnectedEvent)
+    def handle_disconnected(self, event):
+        self._set_offline()
+        if self._reconnect_timeout is not None:
+            return
+        delay = self.reconnect_backoff.delay()
+        logger.warn(u"XMPP 连接断开, %.1f 秒后重新连接", delay)
+        self._reconnect_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + delay, self._reconnect)
+
+    def _reconnect(self):
+        self._reconnect_timeout = None
+        if self.online:
+            return
+        try:
+            self.client.connect()
+        except:
+            logger.warn(u"连接 XMPP 失败", exc_info=True)
+        self._reconnect_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + self.RECONNECT_TIMEOUT, self._check)
+
+    def _check(self):
+        self._reconnect_timeout = None
+        if not self.online:
+            self.handle_disconnected(None)
+
+    @event_handler()
+    def handle_all(self, event):
+        logger.info(u"-- %s", event)
+
+
+def run_split(qq_factory, xmpp_factory, max_restarts=1000):
+    """ 分进程运行, 父进程监控两个子进程, 子进程异常退出后自动重启, 不会
+    返回
+
+    :param qq_factory: 在 WebQQ 进程中调用, 返回设置了 IPCLink 的
+                       ~magpie.client.MagpieClient
+    :param xmpp_factory: 在 XMPP 进程中调用, 返回 XMPPWorker
+    :param max_restarts: 最多重启的次数
+    """
+    task_id = process.fork_processes(2, max_restarts)
+    if task_id == 0:
+        logger.info(u"WebQQ 进程启动")
+        qq_factory().run()
+    else:
+        logger.info(u"XMPP 进程启动")
+        xmpp_factory().run()
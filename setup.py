@@ -9,7 +9,8 @@
 import magpie
 from setuptools import setup
 
-requires = ["tornado", "pycurl", "tornadohttpclient", "twqq==0.2.4",
+# 使用 io_loop 参数; tornadohttpclient 1.x 不接受 twqq 传入的 delay 参数
+requires = ["tornado<5", "pycurl", "tornadohttpclient<1.0", "twqq==0.2.4",
             "pyxmpp2"]
 
 packages = ["magpie"]
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Author  :   cold
+#   E-mail  :   wh_linux@126.com
+#   Date    :   14/05/17 10:12:40
+#   Desc    :   多账号的 HTTP 客户端隔离
+#
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from tornado.ioloop import IOLoop
+
+from twqq.requests import BeforeLoginRequest
+
+from magpie.client import QQClient
+from magpie.resume import SessionStore, set_cookies
+
+
+class IsolatedHTTPTest(unittest.TestCase):
+    """ 同一个 IOLoop 上的两个账号先后登录, 各自保留自己的 ptwebqq
+    """
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.dir = tempfile.mkdtemp()
+        self.clients = [QQClient(10001, "pwd", io_loop=self.io_loop),
+                        QQClient(10002, "pwd", io_loop=self.io_loop)]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.hub.http.close()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+        shutil.rmtree(self.dir)
+
+    def login(self, client, ptwebqq):
+        """ 模拟 ptlogin2 返回: 服务器设置 ptwebqq 后 twqq 从 Cookie 中读取
+        """
+        client.activate()
+        client.hub.check_code = "!abc"
+        set_cookies(client.hub.http,
+                    ["Set-Cookie: ptwebqq={0}; domain=.qq.com; path=/"
+                     .format(ptwebqq)])
+        request = BeforeLoginRequest("pwd")
+        ok, _ = request.check("0", "0", "http://web2.qq.com/loginproxy.html",
+                              "0", "ok", "nick")
+        self.assertTrue(ok)
+
+    def ptwebqq(self, client):
+        return client.hub.http.cookie[".qq.com"]["/"]["ptwebqq"].value
+
+    def test_separate_clients(self):
+        a, b = self.clients
+        self.assertIsNot(a.hub.http, b.hub.http)
+        self.assertIsNot(a.hub.http._share, b.hub.http._share)
+        self.assertFalse(a.hub.http.validate_cert)
+        self.assertEqual(a.hub.http._user_agent, b.hub.http._user_agent)
+
+    def test_login_keeps_ptwebqq(self):
+        a, b = self.clients
+        self.login(a, "ptwebqq_a")
+        self.login(b, "ptwebqq_b")
+
+        self.assertEqual(a.hub.ptwebqq, "ptwebqq_a")
+        self.assertEqual(b.hub.ptwebqq, "ptwebqq_b")
+        # b 登录后 a 的请求仍然携带 a 的 Cookie
+        self.assertEqual(self.ptwebqq(a), "ptwebqq_a")
+        self.assertEqual(self.ptwebqq(b), "ptwebqq_b")
+
+    def test_session_saves_own_cookies(self):
+        a, b = self.clients
+        self.login(a, "ptwebqq_a")
+        self.login(b, "ptwebqq_b")
+
+        path = os.path.join(self.dir, "session_a")
+        a.hub.vfwebqq = a.hub.psessionid = "x"
+        SessionStore(path).save(a.hub)
+        with open(path) as f:
+            cookies = u"\n".join(json.load(f)["cookies"])
+        self.assertIn(u"ptwebqq_a", cookies)
+        self.assertNotIn(u"ptwebqq_b", cookies)
+
+
+if __name__ == "__main__":
+    unittest.main()